@@ -0,0 +1,185 @@
+# %%
+# Vectorized density and histogram curves for the EDA charts.
+#
+# Instead of shipping raw rows to Vega's transform_density, curves are computed
+# here over Polars columns for every group at once and returned as small
+# (group, x, value) tables that can be charted directly. Inputs can be raw
+# values or pre-aggregated (value, count) rows through `weight`.
+import numpy as np
+import polars as pl
+
+# Above this many rows the KDE is binned and FFT-convolved instead of summed
+FFT_THRESHOLD = 10_000
+GRID_SIZE = 256
+
+
+def _groups(
+    df: pl.DataFrame, value: str, by: list[str], weight: str | None
+) -> tuple[pl.DataFrame, int, np.ndarray, np.ndarray, np.ndarray]:
+    # Rows sorted by group plus the group index of every row
+    df = df.filter(pl.col(value).is_not_null())
+    w = pl.col(weight).cast(pl.Float64) if weight else pl.lit(1.0)
+    df = df.select(*by, pl.col(value).cast(pl.Float64).alias("__x"), w.alias("__w"))
+    if by:
+        df = df.sort(by).with_columns(pl.struct(by).rank("dense").alias("__g") - 1)
+    else:
+        df = df.with_columns(pl.lit(0, dtype=pl.UInt32).alias("__g"))
+    keys = df.select(*by, "__g").unique("__g", keep="first").sort("__g").drop("__g")
+    # Groups are ranked densely from 0
+    n_groups = df["__g"].n_unique()
+    return (
+        keys,
+        n_groups,
+        df["__x"].to_numpy(),
+        df["__w"].to_numpy(),
+        df["__g"].cast(pl.Int64).to_numpy(),
+    )
+
+
+def _extent(
+    x: np.ndarray, extent: tuple[float, float] | None
+) -> tuple[float, float]:
+    # Without values, like the empty frames of a dry run, there are no groups
+    # and so no curves, whatever the extent
+    if extent is not None:
+        return extent
+    return (x.min(), x.max()) if len(x) else (0.0, 0.0)
+
+
+def _curves(
+    keys: pl.DataFrame, x: np.ndarray, y: np.ndarray, name: str
+) -> pl.DataFrame:
+    # Long table with one row per (group, grid point)
+    n_groups, n_points = y.shape
+    return (
+        keys.select(pl.all().repeat_by(n_points).explode())
+        .with_columns(
+            pl.Series("x", np.tile(x, n_groups)),
+            pl.Series(name, y.ravel()),
+        )
+        if keys.width
+        else pl.DataFrame({"x": np.tile(x, n_groups), name: y.ravel()})
+    )
+
+
+def histogram(
+    df: pl.DataFrame,
+    value: str,
+    by: list[str] | str | None = None,
+    bins: int = 30,
+    extent: tuple[float, float] | None = None,
+    weight: str | None = None,
+    density: bool = False,
+) -> pl.DataFrame:
+    by = [by] if isinstance(by, str) else list(by or [])
+    keys, n_groups, x, w, g = _groups(df, value, by, weight)
+
+    lo, hi = _extent(x, extent)
+    edges = np.linspace(lo, hi, bins + 1)
+    index = np.clip(((x - lo) / (hi - lo or 1) * bins).astype(np.int64), 0, bins - 1)
+    inside = (x >= lo) & (x <= hi)
+
+    # One bincount over (group, bin) pairs covers every group
+    counts = np.bincount(
+        g[inside] * bins + index[inside], weights=w[inside], minlength=n_groups * bins
+    ).reshape(n_groups, bins)
+    if density:
+        totals = counts.sum(axis=1, keepdims=True)
+        counts = counts / np.where(totals > 0, totals, 1) / np.diff(edges)
+
+    curves = _curves(keys, edges[:-1], counts, "density" if density else "count")
+    return curves.with_columns(
+        pl.col("x").alias("bin_start"),
+        (pl.col("x") + (hi - lo) / bins).alias("bin_end"),
+    ).drop("x")
+
+
+def scott_bandwidth(
+    x: np.ndarray, w: np.ndarray, g: np.ndarray, n_groups: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # Weighted Scott's rule per group, the same default Vega uses
+    n = np.bincount(g, weights=w, minlength=n_groups)
+    mean = np.bincount(g, weights=w * x, minlength=n_groups) / np.maximum(n, 1)
+    var = np.bincount(g, weights=w * (x - mean[g]) ** 2, minlength=n_groups)
+    var /= np.maximum(n, 1)
+    h = 1.06 * np.sqrt(var) * np.maximum(n, 1) ** (-1 / 5)
+    # Constant groups still get a visible bump
+    return np.where(h > 0, h, 1.0), n
+
+
+def _kde_exact(x, w, g, grid, h, n, n_groups, chunk: int = 4096):
+    # Direct sum of Gaussian kernels, in chunks of rows to bound memory
+    out = np.zeros((n_groups, len(grid)))
+    for start in range(0, len(x), chunk):
+        rows = slice(start, start + chunk)
+        xs, ws, gs = x[rows], w[rows], g[rows]
+        z = (grid[None, :] - xs[:, None]) / h[gs][:, None]
+        contrib = ws[:, None] * np.exp(-0.5 * z**2)
+        np.add.at(out, gs, contrib)
+    return out / (np.sqrt(2 * np.pi) * h[:, None] * np.maximum(n, 1)[:, None])
+
+
+def _kde_fft(x, w, g, grid, h, n, n_groups, max_size: int = 1 << 14):
+    # Linear binning onto a grid fine enough for the narrowest kernel, followed
+    # by an FFT convolution with each group's kernel, batched over groups along
+    # the first axis. The output grid is every `step`-th point of the fine one.
+    step = int(np.ceil((grid[1] - grid[0]) / (h.min() / 4)))
+    step = max(1, min(step, max_size // len(grid)))
+    fine = np.linspace(grid[0], grid[-1], (len(grid) - 1) * step + 1)
+    y = _kde_binned(x, w, g, fine, h, n, n_groups)
+    return y[:, ::step]
+
+
+def _kde_binned(x, w, g, grid, h, n, n_groups):
+    m = len(grid)
+    delta = grid[1] - grid[0]
+    pos = (x - grid[0]) / delta
+    left = np.clip(np.floor(pos).astype(np.int64), 0, m - 1)
+    frac = np.clip(pos - left, 0, 1)
+    right = np.minimum(left + 1, m - 1)
+
+    cells = n_groups * m
+    binned = np.bincount(g * m + left, weights=w * (1 - frac), minlength=cells)
+    binned += np.bincount(g * m + right, weights=w * frac, minlength=cells)
+    binned = binned.reshape(n_groups, m)
+
+    offsets = np.arange(-(m - 1), m) * delta
+    kernels = np.exp(-0.5 * (offsets[None, :] / h[:, None]) ** 2)
+    kernels /= np.sqrt(2 * np.pi) * h[:, None]
+
+    size = 1 << int(np.ceil(np.log2(3 * m)))
+    conv = np.fft.irfft(
+        np.fft.rfft(binned, size, axis=1) * np.fft.rfft(kernels, size, axis=1),
+        size,
+        axis=1,
+    )
+    return conv[:, m - 1 : 2 * m - 1] / np.maximum(n, 1)[:, None]
+
+
+def kde(
+    df: pl.DataFrame,
+    value: str,
+    by: list[str] | str | None = None,
+    grid_size: int = GRID_SIZE,
+    extent: tuple[float, float] | None = None,
+    bandwidth: float | None = None,
+    weight: str | None = None,
+) -> pl.DataFrame:
+    by = [by] if isinstance(by, str) else list(by or [])
+    keys, n_groups, x, w, g = _groups(df, value, by, weight)
+
+    lo, hi = _extent(x, extent)
+    grid = np.linspace(lo, hi, grid_size)
+    if not n_groups:
+        return _curves(keys, grid, np.empty((0, grid_size)), "density")
+    h, n = scott_bandwidth(x, w, g, n_groups)
+    if bandwidth is not None:
+        h = np.full(n_groups, bandwidth, dtype=np.float64)
+
+    # Small inputs are summed exactly, large ones binned onto the grid first
+    if len(x) > FFT_THRESHOLD:
+        y = _kde_fft(x, w, g, grid, h, n, n_groups)
+    else:
+        y = _kde_exact(x, w, g, grid, h, n, n_groups)
+
+    return _curves(keys, grid, y, "density")
@@ -1,9 +1,16 @@
 # %%
+import json
+import os
+import time
+from typing import Any
+
 import polars as pl
 import altair as alt
 
 from google.cloud import bigquery
 
+import analytics
+
 alt.data_transformers.enable("vegafusion")
 
 # %%
@@ -35,13 +42,13 @@ job_config = bigquery.QueryJobConfig()
 # folio                          Type: STRING     Mode: NULLABLE
 # latitud                        Type: FLOAT      Mode: NULLABLE
 # longitud                       Type: FLOAT      Mode: NULLABLE
-# punto_1                        Type: STRING     Mode: REQUIRED
-# punto_2                        Type: STRING     Mode: NULLABLE
-# colonia                        Type: STRING     Mode: REQUIRED
+# punto_1                        Type: INTEGER    Mode: REQUIRED
+# punto_2                        Type: INTEGER    Mode: NULLABLE
+# colonia                        Type: INTEGER    Mode: REQUIRED
 # alcaldia                       Type: INTEGER    Mode: REQUIRED
 # zona_vial                      Type: INTEGER    Mode: REQUIRED
-# sector                         Type: STRING     Mode: REQUIRED
-# unidad_cargo                   Type: STRING     Mode: NULLABLE
+# sector                         Type: INTEGER    Mode: REQUIRED
+# unidad_cargo                   Type: INTEGER    Mode: NULLABLE
 # tipo_interseccion              Type: INTEGER    Mode: REQUIRED
 # interseccion_semaforizada      Type: BOOLEAN    Mode: REQUIRED
 # clasificacion_vialidad         Type: INTEGER    Mode: NULLABLE
@@ -54,6 +61,12 @@ job_config = bigquery.QueryJobConfig()
 # trasladado_lesionados          Type: BOOLEAN    Mode: REQUIRED
 # personas_fallecidas            Type: INTEGER    Mode: REQUIRED
 # personas_lesionadas            Type: INTEGER    Mode: REQUIRED
+# geohash_5                      Type: INTEGER    Mode: NULLABLE
+# geohash_6                      Type: INTEGER    Mode: NULLABLE
+# geohash_7                      Type: INTEGER    Mode: NULLABLE
+# interseccion_id                Type: INTEGER    Mode: NULLABLE
+# date_key                       Type: INTEGER    Mode: REQUIRED
+# hora                           Type: INTEGER    Mode: NULLABLE
 
 events_ref = client.dataset("traffic_data").table("events")
 events_table = client.get_table(events_ref)
@@ -62,23 +75,226 @@ for field in events_table.schema:
 
 
 # %%
-def query(query: str) -> pl.DataFrame:
+# Dimension tables are tiny (id, label) pairs, loaded once per session
+dimensions: dict[str, pl.DataFrame] = {}
+
+
+def dimension(name: str) -> pl.DataFrame:
+    if name not in dimensions:
+        dimensions[name] = query(
+            f"SELECT id, {name} FROM `#.{name}`", tag=f"dimension[{name}]"
+        )
+    return dimensions[name]
+
+
+# Cost of every query, tagged with the analysis that issued it. With
+# EDA_DRY_RUN=1 queries are only priced and return empty frames of their result
+# schema, so the whole notebook can be costed for free. EDA_BUDGET_BYTES refuses
+# any query a dry run says would process more than that.
+DRY_RUN = os.environ.get("EDA_DRY_RUN") == "1"
+BUDGET_BYTES = (
+    int(os.environ["EDA_BUDGET_BYTES"]) if "EDA_BUDGET_BYTES" in os.environ else None
+)
+query_log: list[dict[str, Any]] = []
+# Entries of query_log already written by save_query_log
+saved_entries = 0
+
+BQ_TYPES = {
+    "INTEGER": pl.Int64,
+    "FLOAT": pl.Float64,
+    "NUMERIC": pl.Float64,
+    "BOOLEAN": pl.Boolean,
+    "STRING": pl.Utf8,
+    "DATE": pl.Date,
+    "TIME": pl.Time,
+    "TIMESTAMP": pl.Datetime,
+}
+
+
+class QueryOverBudget(Exception):
+    pass
+
+
+def dry_run(sql: str) -> bigquery.QueryJob:
+    # Free, and without the cache the estimate is what an uncached run would scan
+    config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(sql, job_config=config)
+
+
+def query(
+    query: str, decode: dict[str, str] | None = None, tag: str = "adhoc"
+) -> pl.DataFrame:
     global client, traffic
 
-    query_job = client.query(query.replace("#", f"{traffic}"), job_config=job_config)
-    return pl.DataFrame(pl.from_arrow(query_job.result().to_arrow()))
+    sql = query.replace("#", f"{traffic}")
+    entry: dict[str, Any] = {"tag": tag, "sql": sql}
+    query_log.append(entry)
+
+    if DRY_RUN or BUDGET_BYTES is not None:
+        estimate = dry_run(sql)
+        estimated = estimate.total_bytes_processed or 0
+        entry["estimated_bytes"] = estimated
+        if BUDGET_BYTES is not None and estimated > BUDGET_BYTES:
+            entry["refused"] = True
+            raise QueryOverBudget(
+                f"{tag} would process {estimated:,} bytes, "
+                f"over the budget of {BUDGET_BYTES:,}"
+            )
+        if DRY_RUN:
+            return pl.DataFrame(
+                schema={
+                    field.name: BQ_TYPES.get(field.field_type, pl.Utf8)
+                    for field in estimate.schema or []
+                }
+            )
+
+    start = time.perf_counter()
+    query_job = client.query(sql, job_config=job_config)
+    res = pl.DataFrame(pl.from_arrow(query_job.result().to_arrow()))
+    entry |= {
+        "bytes_processed": query_job.total_bytes_processed or 0,
+        "bytes_billed": query_job.total_bytes_billed or 0,
+        "slot_ms": query_job.slot_millis or 0,
+        "cache_hit": bool(query_job.cache_hit),
+        "elapsed_s": (query_job.ended - query_job.started).total_seconds()
+        if query_job.ended and query_job.started
+        else None,
+        "wall_s": time.perf_counter() - start,
+        "rows": res.height,
+    }
+
+    # ID columns are mapped to their labels locally instead of joined in the
+    # warehouse, so queries only scan `events`: {column: dimension table}
+    for column, name in (decode or {}).items():
+        table = dimension(name)
+        res = res.with_columns(
+            pl.col(column).replace_strict(table["id"], table[name], default=None)
+        )
+    return res
+
+
+def query_report() -> pl.DataFrame:
+    # Heaviest analyses first, what is worth optimizing or pre-aggregating
+    columns = {
+        "estimated_bytes": pl.Int64,
+        "bytes_processed": pl.Int64,
+        "bytes_billed": pl.Int64,
+        "slot_ms": pl.Int64,
+        "cache_hit": pl.Boolean,
+        "refused": pl.Boolean,
+        "elapsed_s": pl.Float64,
+    }
+    log = pl.DataFrame(
+        [{name: entry.get(name) for name in ["tag", *columns]} for entry in query_log],
+        schema={"tag": pl.Utf8, **columns},
+    )
+    return (
+        log.group_by("tag")
+        .agg(
+            pl.len().alias("queries"),
+            pl.col("cache_hit").sum().alias("cache_hits"),
+            pl.col("refused").sum(),
+            pl.col("estimated_bytes", "bytes_processed", "bytes_billed", "slot_ms").sum(),
+            pl.col("elapsed_s").sum(),
+        )
+        .sort(
+            "bytes_billed", "estimated_bytes", "slot_ms", descending=True, nulls_last=True
+        )
+    )
+
+
+def save_query_log(path: str = "query_log.jsonl"):
+    # Appends the entries logged since the last save, query_report still sees all
+    global saved_entries
+    with open(path, "a") as f:
+        for entry in query_log[saved_entries:]:
+            f.write(json.dumps({"timestamp": time.time(), **entry}) + "\n")
+    saved_entries = len(query_log)
+
+
+# %%
+# Grouped metrics over `events`.
+#
+# Many charts aggregate the same grouping and only differ in the metric. Cells
+# declare what they need up front with `plan`, and the first `metrics` call for
+# a grouping issues a single scan computing every planned aggregate at once;
+# each chart then slices its columns from the shared result. A grouping whose
+# keys are a subset of a planned one is rolled up locally instead of scanned
+# again (all metrics are sums or counts).
+
+# name: (SELECT expression, dimension table decoding it)
+GROUP_KEYS = {
+    "anio": ("DIV(date_key, 10000)", None),
+    "hora": ("hora", None),
+    "trasladado_lesionados": ("trasladado_lesionados", None),
+    "tipo": ("tipo_evento", "tipo_evento"),
+    "alcaldia": ("alcaldia", "alcaldia"),
+    "origen": ("origen", "origen"),
+}
+METRICS = {
+    "eventos": "COUNT(*)",
+    "fallecidos": "SUM(personas_fallecidas)",
+    "lesionados": "SUM(personas_lesionadas)",
+    "eventos_con_fallecidos": "COUNTIF(personas_fallecidas > 0)",
+    "traslados": "COUNTIF(trasladado_lesionados)",
+}
+
+planned: dict[frozenset[str], set[str]] = {}
+scans: dict[frozenset[str], pl.DataFrame] = {}
+
+
+def plan(keys: list[str], *names: str):
+    planned.setdefault(frozenset(keys), set()).update(names)
+
+
+def scan_for(keys: frozenset[str]) -> frozenset[str]:
+    # Largest planned grouping that can be rolled up into `keys`
+    candidates = [other for other in planned if other >= keys]
+    return max(candidates, key=lambda other: (len(other), sorted(other)))
+
+
+def run_scan(keys: frozenset[str]) -> pl.DataFrame:
+    # Every metric planned for a grouping this scan serves
+    names = sorted(
+        {name for other, names in planned.items() if scan_for(other) == keys for name in names}
+    )
+    columns = sorted(keys)
+    select = [f"{GROUP_KEYS[k][0]} as {k}" for k in columns]
+    select += [f"{METRICS[name]} as {name}" for name in names]
+    decode = {k: GROUP_KEYS[k][1] for k in columns if GROUP_KEYS[k][1] is not None}
+    # Grouping by position, the aliases would clash with the events columns
+    positions = ", ".join(str(i + 1) for i in range(len(columns)))
+
+    sql = "SELECT\n    " + ",\n    ".join(select) + "\nFROM `#.events`\n"
+    tag = f"metrics[{','.join(columns)}]"
+    return query(sql + f"GROUP BY {positions}\n", decode=decode, tag=tag)
+
+
+def metrics(keys: list[str], *names: str) -> pl.DataFrame:
+    plan(keys, *names)
+    source = scan_for(frozenset(keys))
+
+    # Scan again only if this grouping asks for a metric the last scan didn't have
+    if source not in scans or not set(names) <= set(scans[source].columns):
+        scans[source] = run_scan(source)
+
+    res = scans[source]
+    if source != frozenset(keys):
+        res = res.group_by(keys).agg(pl.col(name).sum() for name in names)
+    return res.select(*keys, *names).sort(keys)
+
+
+# Every grouping used below, so each distinct one is scanned once
+plan(["anio", "hora", "tipo"], "eventos", "fallecidos", "lesionados")
+plan(["anio", "hora", "alcaldia"], "eventos", "eventos_con_fallecidos", "traslados")
+plan(["anio", "origen"], "eventos")
+plan(["anio", "trasladado_lesionados"], "eventos")
 
 # %%
 # Number of fallecimientos and lesionados per year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    SUM(personas_fallecidas) as total_fallecidos,
-    SUM(personas_lesionadas) as total_lesionados
-FROM `#.events`
-GROUP BY anio
-ORDER BY anio
-""")
+res = metrics(["anio"], "fallecidos", "lesionados").rename(
+    {"fallecidos": "total_fallecidos", "lesionados": "total_lesionados"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -133,23 +349,15 @@ chart
 
 # %%
 # peoplpe injured per accidents / deaths ratio by year
-res = query("""
-WITH accidents_by_year AS (
-    SELECT
-        EXTRACT(YEAR FROM fecha_evento) as anio,
-        COUNT(*) as total_accidents,
-        SUM(personas_fallecidas) as total_deaths
-    FROM `#.events`
-    GROUP BY anio
+res = (
+    metrics(["anio"], "eventos", "fallecidos")
+    .rename({"eventos": "total_accidents", "fallecidos": "total_deaths"})
+    .with_columns(
+        pl.when(pl.col("total_deaths") > 0)
+        .then(pl.col("total_accidents") / pl.col("total_deaths"))
+        .alias("ratio")
+    )
 )
-SELECT
-    anio,
-    total_accidents,
-    total_deaths,
-    CAST(total_accidents AS FLOAT64) / NULLIF(total_deaths, 0) as ratio
-FROM accidents_by_year
-ORDER BY anio
-""")
 
 res_alt = res.with_columns(pl.col("anio").alias("Año")).with_columns(
     pl.col("ratio").alias("Ratio")
@@ -197,26 +405,15 @@ chart
 
 # %%
 # Ratio of injured people per death by year and tipo
-res = query("""
-WITH accidents_by_year_tipo AS (
-    SELECT
-        EXTRACT(YEAR FROM fecha_evento) as anio,
-        t.tipo_evento as tipo,
-        SUM(personas_fallecidas) as total_deaths,
-        SUM(personas_lesionadas) as total_lesionados
-    FROM `#.events` e
-    JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-    GROUP BY anio, tipo
+res = (
+    metrics(["anio", "tipo"], "fallecidos", "lesionados")
+    .rename({"fallecidos": "total_deaths", "lesionados": "total_lesionados"})
+    .with_columns(
+        pl.when(pl.col("total_deaths") > 0)
+        .then(pl.col("total_lesionados") / pl.col("total_deaths"))
+        .alias("ratio")
+    )
 )
-SELECT
-    anio,
-    tipo,
-    total_deaths,
-    total_lesionados,
-    CAST(total_lesionados AS FLOAT64) / NULLIF(total_deaths, 0) as ratio
-FROM accidents_by_year_tipo
-ORDER BY anio, tipo
-""")
 
 res_alt = (
     res
@@ -264,26 +461,15 @@ chart
 
 # %%
 # Probability of dying if you have an accident per each type of accident per year
-res = query("""
-WITH accidents_by_year_tipo AS (
-    SELECT
-        EXTRACT(YEAR FROM fecha_evento) as anio,
-        t.tipo_evento as tipo,
-        COUNT(*) as total_accidents,
-        SUM(personas_fallecidas) as total_deaths
-    FROM `#.events` e
-    JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-    GROUP BY anio, tipo
+res = (
+    metrics(["anio", "tipo"], "eventos", "fallecidos")
+    .rename({"eventos": "total_accidents", "fallecidos": "total_deaths"})
+    .with_columns(
+        pl.when(pl.col("total_accidents") > 0)
+        .then(pl.col("total_deaths") / pl.col("total_accidents"))
+        .alias("probability")
+    )
 )
-SELECT
-    anio,
-    tipo,
-    total_accidents,
-    total_deaths,
-    CAST(total_deaths AS FLOAT64) / NULLIF(total_accidents, 0) as probability
-FROM accidents_by_year_tipo
-ORDER BY anio, tipo
-""")
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -311,24 +497,24 @@ chart
 # Probability distribution curve of the number of injured people on accidents per year
 res = query("""
 SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    personas_lesionadas
+    DIV(date_key, 10000) as anio,
+    personas_lesionadas,
+    COUNT(*) as total
 FROM `#.events`
 WHERE personas_lesionadas > 0
-""")
+GROUP BY anio, personas_lesionadas
+""", tag="lesionados_kde")
 
+# The density is computed locally from the (value, count) pairs
 res_alt = (
-    res.with_columns(pl.col("anio").alias("Año"))
-    .with_columns(pl.col("personas_lesionadas").alias("Lesionados"))
+    analytics.kde(res, "personas_lesionadas", by="anio", weight="total")
+    .with_columns(pl.col("anio").alias("Año"))
+    .with_columns(pl.col("x").alias("Lesionados"))
+    .with_columns(pl.col("density").alias("Density"))
 )
 
 chart = (
     alt.Chart(res_alt)
-    .transform_density(
-        density="Lesionados",
-        groupby=["Año"],
-        as_=["Lesionados", "Density"]
-    )
     .mark_line()
     .encode(
         x=alt.X("Lesionados:Q", title="Número de Lesionados"),
@@ -345,33 +531,13 @@ chart
 
 # %%
 # plot for percentage of accidents that resulted in deaths by alcaldia
-res = query("""
-WITH total_by_alcaldia AS (
-    SELECT
-        a.alcaldia,
-        COUNT(*) as total
-    FROM `#.events` e
-    JOIN `#.alcaldia` a ON e.alcaldia = a.id
-    GROUP BY a.alcaldia
-),
-deaths_by_alcaldia AS (
-    SELECT
-        a.alcaldia,
-        COUNT(*) as deaths
-    FROM `#.events` e
-    JOIN `#.alcaldia` a ON e.alcaldia = a.id
-    WHERE personas_fallecidas > 0
-    GROUP BY a.alcaldia
+res = (
+    metrics(["alcaldia"], "eventos_con_fallecidos", "eventos")
+    .rename({"eventos_con_fallecidos": "deaths", "eventos": "total"})
+    .filter(pl.col("deaths") > 0)
+    .with_columns((pl.col("deaths") / pl.col("total")).alias("porcentaje"))
+    .sort("porcentaje", descending=True)
 )
-SELECT
-    d.alcaldia,
-    d.deaths,
-    ta.total,
-    d.deaths / ta.total as porcentaje
-FROM deaths_by_alcaldia d
-JOIN total_by_alcaldia ta ON d.alcaldia = ta.alcaldia
-ORDER BY porcentaje DESC
-""")
 
 res_alt = (
     res.filter(pl.col("alcaldia") != pl.lit("GUSTAVO A. MADERO"))
@@ -426,15 +592,9 @@ chart
 
 # %%
 # Gráfica de líneas que muestra el número de fallecimientos por tipo de evento a lo largo de años.
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    t.tipo_evento as tipo,
-    SUM(personas_fallecidas) as personas_fallecidas,
- FROM `#.events` e
- JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-GROUP BY anio, tipo
-""")
+res = metrics(["anio", "tipo"], "fallecidos").rename(
+    {"fallecidos": "personas_fallecidas"}
+)
 
 
 res_alt = (
@@ -469,15 +629,9 @@ chart
 
 # %%
 # Gráfica de líneas que muestra el número de heridos por tipo de evento a lo largo de años.
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    t.tipo_evento as tipo,
-    SUM(personas_lesionadas) as personas_lesionadas,
- FROM `#.events` e
- JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-GROUP BY anio, tipo
-""")
+res = metrics(["anio", "tipo"], "lesionados").rename(
+    {"lesionados": "personas_lesionadas"}
+)
 
 
 res_alt = (
@@ -510,14 +664,12 @@ chart
 
 # %%
 # Gráfica de frecuencia de eventos por origen
-res = query("""
-SELECT
-    o.origen,
-    COUNT(*) as total_eventos
-FROM `#.events` e
-JOIN `#.origen` o ON e.origen = o.id
-GROUP BY o.origen
-""")
+# Events without an origen are left out of its charts
+res = (
+    metrics(["origen"], "eventos")
+    .drop_nulls("origen")
+    .rename({"eventos": "total_eventos"})
+)
 
 # Group small values into "Otros"
 THRESHOLD = 700  # Adjust this threshold as needed
@@ -550,15 +702,11 @@ chart = (
 chart
 
 # Distribution of events by origen over time
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    o.origen,
-    COUNT(*) as total_eventos
-FROM `#.events` e
-JOIN `#.origen` o ON e.origen = o.id
-GROUP BY anio, o.origen
-""")
+res = (
+    metrics(["anio", "origen"], "eventos")
+    .drop_nulls("origen")
+    .rename({"eventos": "total_eventos"})
+)
 
 # Group small values into "Otros"
 total_by_origen = res.group_by("origen").agg(pl.col("total_eventos").sum())
@@ -605,15 +753,11 @@ chart
 
 # %%
 # Distribution of events by origen over time
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    o.origen,
-    COUNT(*) as total_eventos
-FROM `#.events` e
-JOIN `#.origen` o ON e.origen = o.id
-GROUP BY anio, o.origen
-""")
+res = (
+    metrics(["anio", "origen"], "eventos")
+    .drop_nulls("origen")
+    .rename({"eventos": "total_eventos"})
+)
 
 # Group small values into "Otros"
 total_by_origen = res.group_by("origen").agg(pl.col("total_eventos").sum())
@@ -664,14 +808,7 @@ chart
 
 # %%
 # Number of accidents per hour
-res = query("""
-SELECT
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    COUNT(*) as total_accidents
-FROM `#.events` e
-GROUP BY hora
-ORDER BY hora
-""")
+res = metrics(["hora"], "eventos").rename({"eventos": "total_accidents"})
 
 res_alt = res.with_columns(pl.col("hora").alias("Hora")).with_columns(
     pl.col("total_accidents").alias("Total")
@@ -694,14 +831,7 @@ chart
 
 # %%
 # Deaths per hour
-res = query("""
-SELECT
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    SUM(personas_fallecidas) as total_fallecidos
-FROM `#.events` e
-GROUP BY hora
-ORDER BY hora
-""")
+res = metrics(["hora"], "fallecidos").rename({"fallecidos": "total_fallecidos"})
 
 res_alt = res.with_columns(pl.col("hora").alias("Hora")).with_columns(
     pl.col("total_fallecidos").alias("Total")
@@ -724,14 +854,7 @@ chart
 
 # %%
 # Injured per hour
-res = query("""
-SELECT
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    SUM(personas_lesionadas) as total_lesionados
-FROM `#.events` e
-GROUP BY hora
-ORDER BY hora
-""")
+res = metrics(["hora"], "lesionados").rename({"lesionados": "total_lesionados"})
 
 res_alt = res.with_columns(pl.col("hora").alias("Hora")).with_columns(
     pl.col("total_lesionados").alias("Total")
@@ -754,15 +877,7 @@ chart
 
 # %%
 # Accidents per hour by year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    COUNT(*) as total_accidentes
-FROM `#.events` e
-GROUP BY anio, hora
-ORDER BY anio, hora
-""")
+res = metrics(["anio", "hora"], "eventos").rename({"eventos": "total_accidentes"})
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -792,15 +907,9 @@ chart
 
 # %%
 # Deaths per hour by year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    SUM(personas_fallecidas) as total_fallecidos
-FROM `#.events` e
-GROUP BY anio, hora
-ORDER BY anio, hora
-""")
+res = metrics(["anio", "hora"], "fallecidos").rename(
+    {"fallecidos": "total_fallecidos"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -830,15 +939,9 @@ chart
 
 # %%
 # Injured per hour by year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    SUM(personas_lesionadas) as total_lesionados
-FROM `#.events` e
-GROUP BY anio, hora
-ORDER BY anio, hora
-""")
+res = metrics(["anio", "hora"], "lesionados").rename(
+    {"lesionados": "total_lesionados"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -868,16 +971,7 @@ chart
 
 # %%
 # Number of incidents by tipo at each hour
-res = query("""
-SELECT
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    t.tipo_evento as tipo,
-    COUNT(*) as total_incidentes
-FROM `#.events` e
-JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-GROUP BY hora, tipo
-ORDER BY hora, tipo
-""")
+res = metrics(["hora", "tipo"], "eventos").rename({"eventos": "total_incidentes"})
 
 res_alt = (
     res.with_columns(pl.col("hora").alias("Hora"))
@@ -909,17 +1003,9 @@ chart
 
 # %%
 # Number of incidents by tipo at each hour by year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    t.tipo_evento as tipo,
-    COUNT(*) as total_incidentes
-FROM `#.events` e
-JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-GROUP BY anio, hora, tipo
-ORDER BY anio, hora, tipo
-""")
+res = metrics(["anio", "hora", "tipo"], "eventos").rename(
+    {"eventos": "total_incidentes"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -966,15 +1052,9 @@ facet_chart
 
 # %%
 # Number of accidents per year by whether there was a transport to hospital
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    trasladado_lesionados,
-    COUNT(*) as total_accidentes
-FROM `#.events` e
-GROUP BY anio, trasladado_lesionados
-ORDER BY anio, trasladado_lesionados
-""")
+res = metrics(["anio", "trasladado_lesionados"], "eventos").rename(
+    {"eventos": "total_accidentes"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -1010,16 +1090,12 @@ chart = (
 chart
 
 # Number of accidents per alcaldia that had a trasladado_lesionados to hospital
-res = query("""
-SELECT
-    a.alcaldia,
-    COUNT(*) as total_accidentes
-FROM `#.events` e
-JOIN `#.alcaldia` a ON e.alcaldia = a.id
-WHERE trasladado_lesionados = TRUE
-GROUP BY a.alcaldia
-ORDER BY total_accidentes DESC
-""")
+res = (
+    metrics(["alcaldia"], "traslados")
+    .rename({"traslados": "total_accidentes"})
+    .filter(pl.col("total_accidentes") > 0)
+    .sort("total_accidentes", descending=True)
+)
 
 res_alt = res.with_columns(
     pl.when(pl.col("alcaldia") == "GUSTAVO A MADERO")
@@ -1048,33 +1124,13 @@ chart
 
 # %%
 # plot for percentage of accidents that required trasladado_lesionados by alcaldia
-res = query("""
-WITH total_by_alcaldia AS (
-    SELECT
-        a.alcaldia,
-        COUNT(*) as total
-    FROM `#.events` e
-    JOIN `#.alcaldia` a ON e.alcaldia = a.id
-    GROUP BY a.alcaldia
-),
-traslados_by_alcaldia AS (
-    SELECT
-        a.alcaldia,
-        COUNT(*) as traslados
-    FROM `#.events` e
-    JOIN `#.alcaldia` a ON e.alcaldia = a.id
-    WHERE trasladado_lesionados = TRUE
-    GROUP BY a.alcaldia
+res = (
+    metrics(["alcaldia"], "traslados", "eventos")
+    .rename({"eventos": "total"})
+    .filter(pl.col("traslados") > 0)
+    .with_columns((pl.col("traslados") / pl.col("total")).alias("porcentaje"))
+    .sort("porcentaje", descending=True)
 )
-SELECT
-    t.alcaldia,
-    t.traslados,
-    ta.total,
-    t.traslados / ta.total as porcentaje
-FROM traslados_by_alcaldia t
-JOIN total_by_alcaldia ta ON t.alcaldia = ta.alcaldia
-ORDER BY porcentaje DESC
-""")
 
 res_alt = (
     res.filter(pl.col("alcaldia") != pl.lit("GUSTAVO A. MADERO"))
@@ -1129,24 +1185,7 @@ chart
 
 # %%
 # Average number of incidents happening in the same hour period of the day for each alcaldia
-res = query("""
-WITH incidents_by_hour_alcaldia AS (
-    SELECT
-        EXTRACT(HOUR FROM hora_evento) as hora,
-        a.alcaldia,
-        COUNT(*) as total_incidents
-    FROM `#.events` e
-    JOIN `#.alcaldia` a ON e.alcaldia = a.id
-    GROUP BY hora, a.alcaldia
-)
-SELECT
-    hora,
-    alcaldia,
-    AVG(total_incidents) as avg_incidents
-FROM incidents_by_hour_alcaldia
-GROUP BY hora, alcaldia
-ORDER BY hora, alcaldia
-""")
+res = metrics(["hora", "alcaldia"], "eventos").rename({"eventos": "avg_incidents"})
 
 res_alt = (
     res.with_columns(pl.col("hora").alias("Hora"))
@@ -1178,16 +1217,9 @@ chart
 
 # %%
 # Total number of accidents in each alcaldia per each year
-res = query("""
-SELECT
-    EXTRACT(YEAR FROM fecha_evento) as anio,
-    a.alcaldia,
-    COUNT(*) as total_accidentes
-FROM `#.events` e
-JOIN `#.alcaldia` a ON e.alcaldia = a.id
-GROUP BY anio, a.alcaldia
-ORDER BY anio, a.alcaldia
-""")
+res = metrics(["anio", "alcaldia"], "eventos").rename(
+    {"eventos": "total_accidentes"}
+)
 
 res_alt = (
     res.with_columns(pl.col("anio").alias("Año"))
@@ -1219,16 +1251,9 @@ chart
 
 # %%
 # Number of deceased people by hour and by tipo
-res = query("""
-SELECT
-    EXTRACT(HOUR FROM hora_evento) as hora,
-    t.tipo_evento as tipo,
-    SUM(personas_fallecidas) as total_fallecidos
-FROM `#.events` e
-JOIN `#.tipo_evento` t ON e.tipo_evento = t.id
-GROUP BY hora, tipo
-ORDER BY hora, tipo
-""")
+res = metrics(["hora", "tipo"], "fallecidos").rename(
+    {"fallecidos": "total_fallecidos"}
+)
 
 res_alt = (
     res.with_columns(pl.col("hora").alias("Hora"))
@@ -1257,3 +1282,8 @@ chart = (
 )
 
 chart
+
+# %%
+# Cost of the queries above, heaviest first
+save_query_log()
+query_report()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The notebook's modules are imported as top-level modules, as in eda.py
+sys.path.insert(0, str(Path(__file__).parent.parent))
@@ -0,0 +1,35 @@
+import numpy as np
+import polars as pl
+import pytest
+
+import analytics
+
+EMPTY = pl.DataFrame(schema={"anio": pl.Int64, "valor": pl.Int64, "total": pl.Int64})
+
+
+def test_kde_integrates_to_one_per_group():
+    df = pl.DataFrame({"anio": [2023] * 50 + [2024] * 50, "valor": range(100)})
+
+    curves = analytics.kde(df, "valor", by="anio", grid_size=512, extent=(-100, 200))
+
+    for _, group in curves.group_by("anio"):
+        area = np.trapezoid(group["density"], group["x"])
+        assert area == pytest.approx(1.0, abs=1e-3)
+
+
+def test_histogram_counts_weighted_rows():
+    df = pl.DataFrame({"valor": [1, 2, 2, 3], "total": [1, 2, 3, 4]})
+
+    curves = analytics.histogram(df, "valor", bins=3, weight="total")
+
+    assert curves["count"].to_list() == [1.0, 5.0, 4.0]
+
+
+def test_empty_frames_give_empty_curves():
+    # As query() returns them on a dry run
+    for by in [None, "anio"]:
+        kde = analytics.kde(EMPTY, "valor", by=by, weight="total")
+        histogram = analytics.histogram(EMPTY, "valor", by=by, weight="total")
+
+        assert kde.is_empty() and {"x", "density"} <= set(kde.columns)
+        assert histogram.is_empty() and "count" in histogram.columns
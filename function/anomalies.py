@@ -0,0 +1,186 @@
+# %%
+# Spikes in daily incidents and deaths per alcaldia and tipo_evento.
+#
+# Every (alcaldia, tipo_evento, metrica) series keeps an exponentially weighted
+# mean and variance of its daily value. Both recurrences are first-order linear
+# filters, so a batch of new days runs through scipy's lfilter for all series at
+# once, as rows of a single array, starting from the state saved by the previous
+# ingest. Days up to the last processed one are never looked at again.
+import datetime
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import cast
+
+import numpy as np
+import polars as pl
+
+import files
+
+STATE_DIR = Path(
+    os.environ.get("ANOMALY_STATE_DIR", Path(tempfile.gettempdir()) / "anomalies")
+)
+
+KEYS = ["alcaldia", "tipo_evento"]
+METRICS = {
+    "eventos": pl.len(),
+    "fallecidos": pl.col("personas_fallecidas").sum(),
+}
+
+HALFLIFE_DAYS = 28
+ALPHA = 1 - 0.5 ** (1 / HALFLIFE_DAYS)
+# Days a series needs before it can be flagged
+WARMUP_DAYS = 28
+Z_THRESHOLD = 4.0
+# Tiny counts are noise even when far from the mean
+MIN_VALUE = 3
+
+BASELINE_SCHEMA = {
+    "alcaldia": pl.Utf8,
+    "tipo_evento": pl.Utf8,
+    "metrica": pl.Utf8,
+    "fecha": pl.Date,
+    "dias": pl.Int64,
+    "media": pl.Float64,
+    "varianza": pl.Float64,
+}
+ANOMALY_SCHEMA = {
+    "fecha": pl.Date,
+    "alcaldia": pl.Utf8,
+    "tipo_evento": pl.Utf8,
+    "metrica": pl.Utf8,
+    "valor": pl.Float64,
+    "esperado": pl.Float64,
+    "z": pl.Float64,
+}
+
+
+@dataclass
+class State:
+    # One row per series with the last processed day, plus every anomaly so far
+    baselines: pl.DataFrame
+    anomalies: pl.DataFrame
+
+    @property
+    def last_day(self) -> datetime.date | None:
+        return cast(datetime.date | None, self.baselines["fecha"].max())
+
+
+def load(path: Path = STATE_DIR) -> State:
+    baselines = path / "baselines.parquet"
+    anomalies = path / "anomalias.parquet"
+    if not baselines.exists():
+        return State(
+            pl.DataFrame(schema=BASELINE_SCHEMA), pl.DataFrame(schema=ANOMALY_SCHEMA)
+        )
+    return State(pl.read_parquet(baselines), pl.read_parquet(anomalies))
+
+
+def save(state: State, path: Path = STATE_DIR):
+    files.atomic_write(path / "baselines.parquet", state.baselines.write_parquet)
+    files.atomic_write(path / "anomalias.parquet", state.anomalies.write_parquet)
+
+
+def daily(
+    df: pl.DataFrame, tables: dict[str, pl.DataFrame], after: datetime.date | None
+) -> pl.DataFrame:
+    # Daily values per series, grouped on the encoded IDs and labelled afterwards
+    # so series survive the IDs changing between ingests
+    lf = df.lazy()
+    if after is not None:
+        lf = lf.filter(pl.col("fecha_evento") > after)
+    counts = (
+        lf.group_by("fecha_evento", *KEYS)
+        .agg(expr.alias(name) for name, expr in METRICS.items())
+        .collect()
+    )
+    return counts.with_columns(
+        pl.col(key).replace_strict(tables[key]["id"], tables[key][key])
+        for key in KEYS
+        if key in tables
+    ).unpivot(
+        index=["fecha_evento", *KEYS], variable_name="metrica", value_name="valor"
+    )
+
+
+def detect(
+    df: pl.DataFrame, tables: dict[str, pl.DataFrame], state: State
+) -> tuple[pl.DataFrame, State]:
+    from scipy.signal import lfilter
+
+    series_keys = [*KEYS, "metrica"]
+    # Events without a date can't be placed on any day of a series
+    counts = daily(df, tables, state.last_day).drop_nulls(
+        ["fecha_evento", *series_keys]
+    )
+    if counts.height == 0:
+        return state.anomalies, state
+
+    # Dense (series, day) matrix, days without events are zeros
+    series = (
+        pl.concat(
+            [
+                state.baselines.select(series_keys),
+                counts.select(series_keys).cast(pl.Utf8),
+            ]
+        )
+        .unique()
+        .sort(series_keys)
+        .with_row_index("serie")
+    )
+    last = cast(datetime.date, counts["fecha_evento"].max())
+    first = (
+        state.last_day + datetime.timedelta(days=1)
+        if state.last_day
+        else cast(datetime.date, counts["fecha_evento"].min())
+    )
+    days = pl.date_range(first, last, eager=True)
+
+    cells = counts.cast({key: pl.Utf8 for key in KEYS}).join(series, on=series_keys)
+    x = np.zeros((series.height, len(days)))
+    x[
+        cells["serie"].to_numpy(),
+        (cells["fecha_evento"] - first).dt.total_days().to_numpy(),
+    ] = cells["valor"].to_numpy()
+
+    previous = series.join(state.baselines, on=series_keys, how="left").sort("serie")
+    mean0 = previous["media"].fill_null(0).to_numpy()[:, None]
+    var0 = previous["varianza"].fill_null(0).to_numpy()[:, None]
+    seen = previous["dias"].fill_null(0).to_numpy()
+
+    # m_t = a x_t + (1 - a) m_{t-1}
+    # v_t = (1 - a) (v_{t-1} + a (x_t - m_{t-1})^2)
+    decay = 1 - ALPHA
+    mean, _ = lfilter([ALPHA], [1, -decay], x, axis=1, zi=decay * mean0)
+    expected = np.concatenate([mean0, mean[:, :-1]], axis=1)
+    deviation = x - expected
+    var, _ = lfilter(
+        [ALPHA * decay], [1, -decay], deviation**2, axis=1, zi=decay * var0
+    )
+    spread = np.sqrt(np.maximum(np.concatenate([var0, var[:, :-1]], axis=1), 1.0))
+    z = deviation / spread
+
+    age = seen[:, None] + np.arange(len(days))[None, :]
+    flagged = (age >= WARMUP_DAYS) & (z > Z_THRESHOLD) & (x >= MIN_VALUE)
+    rows, cols = np.nonzero(flagged)
+    found = (
+        series[rows]
+        .select(series_keys)
+        .with_columns(
+            pl.Series("fecha", days.to_numpy()[cols]),
+            pl.Series("valor", x[rows, cols]),
+            pl.Series("esperado", expected[rows, cols]),
+            pl.Series("z", z[rows, cols]),
+        )
+        .select(ANOMALY_SCHEMA.keys())
+    )
+
+    baselines = series.select(series_keys).with_columns(
+        pl.lit(days[-1]).alias("fecha"),
+        pl.Series("dias", seen + len(days)),
+        pl.Series("media", mean[:, -1]),
+        pl.Series("varianza", var[:, -1]),
+    )
+    anomalies = pl.concat([state.anomalies, found]).sort("fecha", *series_keys)
+    return anomalies, State(baselines, anomalies)
@@ -0,0 +1,287 @@
+# %%
+# Load test of the CloudEvent entry point, run locally.
+#
+#   rye run python -m bench.load --rows 100k --events 20 --rate 0.5
+#
+# Synthetic dumps are served from a local HTTP server and the function runs
+# under functions-framework with SINK_DIR set, so nothing reaches BigQuery.
+# Events are posted at a fixed rate whatever the latency of earlier ones (open
+# loop). The report has latency percentiles, the failure rate and the memory
+# high-water mark of the function's processes, the numbers `--memory` and
+# `--timeout` of `just deploy` are sized from.
+import argparse
+import base64
+import functools
+import http.server
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from bench import synth
+from bench.run import SIZES, git_revision
+
+RESULTS = Path(__file__).parent / "load_results.jsonl"
+FUNCTION_DIR = Path(__file__).parent.parent
+SAMPLE_S = 0.05
+# Memory sizes Cloud Functions can be deployed with, in MB
+MEMORY_TIERS = [128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+MAX_TIMEOUT_S = 540
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # The download probe hangs up after the first byte, this server has no ranges
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(directory: Path) -> tuple[http.server.ThreadingHTTPServer, str]:
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid: int, field: str = "VmRSS") -> int:
+    # Resident memory of a process and its children (gunicorn forks its worker)
+    total = 0
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith(field + ":"):
+                total += int(line.split()[1])
+        children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+    except (FileNotFoundError, ProcessLookupError):
+        return total
+    return total + sum(rss_kb(int(child), field) for child in children)
+
+
+class Sampler:
+    # Resident memory of the function over time, sampled in the background
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.samples: list[tuple[float, int]] = []
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_S):
+            self.samples.append((time.perf_counter(), rss_kb(self.pid)))
+
+    def peak_mb(self, start: float, end: float) -> float:
+        during = [kb for t, kb in self.samples if start <= t <= end]
+        return max(during, default=0) / 1024
+
+
+def start_function(port: int, state: Path) -> subprocess.Popen:
+    # All of the function's state lives in `state`, runs don't see each other's
+    env = {
+        **os.environ,
+        "SINK_DIR": str(state / "sink"),
+        "CHECKPOINT_DIR": str(state / "checkpoints"),
+        "LEASE_DIR": str(state / "leases"),
+        "DEDUP_INDEX": str(state / "seen_keys.npz"),
+        "ANOMALY_STATE_DIR": str(state / "anomalies"),
+        "QUARANTINE_DIR": str(state / "quarantine"),
+        "DEFERRED_DIR": str(state / "deferred"),
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "functions_framework",
+            "--target",
+            "my_cloudevent_function",
+            "--port",
+            str(port),
+        ],
+        cwd=FUNCTION_DIR,
+        env=env,
+        stdout=open(state / "function.log", "w"),
+        stderr=subprocess.STDOUT,
+    )
+    for _ in range(600):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit(f"Function exited, see {state / 'function.log'}")
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit("Function didn't start in 60s")
+
+
+def post_event(port: int, url: str, timeout_s: float) -> int:
+    # A Pub/Sub push as functions-framework receives it, in binary mode
+    body = json.dumps(
+        {"message": {"data": base64.b64encode(url.encode()).decode()}}
+    ).encode()
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/",
+        data=body,
+        headers={
+            "Content-Type": "application/json",
+            "ce-id": uuid.uuid4().hex,
+            "ce-specversion": "1.0",
+            "ce-source": "//pubsub.googleapis.com/projects/local/topics/traffic",
+            "ce-type": "google.cloud.pubsub.topic.v1.messagePublished",
+        },
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout_s) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "p50": round(p50, 3),
+        "p90": round(p90, 3),
+        "p99": round(p99, 3),
+        "max": round(max(values), 3),
+    }
+
+
+def run_load(
+    rows: int, events: int, rate: float, distinct: int, timeout_s: float
+) -> dict:
+    # Every distinct seed is a dump with its own folios, a full ingest. Events
+    # beyond that repeat earlier dumps and exercise the skip paths.
+    paths = [synth.csv_path(rows, seed) for seed in range(distinct)]
+    server, base = serve(synth.DATA_DIR)
+
+    with tempfile.TemporaryDirectory() as state:
+        port = free_port()
+        process = start_function(port, Path(state))
+        sampler = Sampler(process.pid)
+        invocations = []
+
+        def invoke(i: int):
+            url = f"{base}/{paths[i % distinct].name}"
+            start = time.perf_counter()
+            try:
+                status = post_event(port, url, timeout_s)
+            except (urllib.error.URLError, TimeoutError) as e:
+                status = repr(e)
+            end = time.perf_counter()
+            invocations.append(
+                {
+                    "latency_s": end - start,
+                    "ok": status in (200, 204),
+                    "status": status,
+                    "peak_rss_mb": sampler.peak_mb(start, end),
+                }
+            )
+
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(events) as pool:
+                for i in range(events):
+                    time.sleep(max(0.0, started + i / rate - time.perf_counter()))
+                    pool.submit(invoke, i)
+            elapsed = time.perf_counter() - started
+            high_water_mb = rss_kb(process.pid, "VmHWM") / 1024
+        finally:
+            sampler.stopped.set()
+            process.terminate()
+            process.wait()
+            server.shutdown()
+
+    ok = [r for r in invocations if r["ok"]]
+    return {
+        "rows": rows,
+        "events": events,
+        "rate": rate,
+        "distinct": distinct,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_eps": round(len(ok) / elapsed, 3),
+        "failure_rate": round(1 - len(ok) / events, 4),
+        "failures": sorted({str(r["status"]) for r in invocations if not r["ok"]}),
+        "latency_s": percentiles([r["latency_s"] for r in ok]),
+        "peak_rss_mb": percentiles([r["peak_rss_mb"] for r in invocations]),
+        "high_water_mb": round(high_water_mb, 1),
+    }
+
+
+def suggest(result: dict) -> dict:
+    # Headroom over what was measured, rounded up to what can be deployed
+    memory = next(
+        (tier for tier in MEMORY_TIERS if tier >= result["high_water_mb"] * 1.25),
+        MEMORY_TIERS[-1],
+    )
+    timeout = min(MAX_TIMEOUT_S, int(result["latency_s"].get("max", 0) * 2) + 1)
+    return {"memory": f"{memory}MB", "timeout": f"{timeout}s"}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Load test the local function")
+    parser.add_argument("--rows", default="100k", choices=SIZES)
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=0.5, help="events per second")
+    parser.add_argument(
+        "--distinct", type=int, help="distinct dumps, one per event by default"
+    )
+    parser.add_argument("--timeout", type=float, default=MAX_TIMEOUT_S)
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    result = run_load(
+        SIZES[args.rows],
+        args.events,
+        args.rate,
+        min(args.distinct or args.events, args.events),
+        args.timeout,
+    )
+    latency, rss = result["latency_s"], result["peak_rss_mb"]
+    print(
+        f"{args.events} events of {args.rows} rows at {args.rate}/s: "
+        f"{result['throughput_eps']:.3f} ok/s, "
+        f"{result['failure_rate']:.1%} failed {result['failures'] or ''}"
+    )
+    print(f"latency  {'  '.join(f'{k} {v:>8.3f}s' for k, v in latency.items())}")
+    print(f"rss      {'  '.join(f'{k} {v:>8.1f}MB' for k, v in rss.items())}")
+    print(f"high-water mark {result['high_water_mb']:.1f}MB")
+    suggested = suggest(result)
+    print(f">> Suggested: --memory {suggested['memory']} --timeout {suggested['timeout']}")
+
+    if not args.no_save:
+        run = {
+            "revision": git_revision(),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(RESULTS, "a") as f:
+            f.write(json.dumps({**run, **result, "suggested": suggested}) + "\n")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,154 @@
+# %%
+# Benchmark the ingest pipeline on synthetic incident dumps.
+#
+#   rye run python -m bench.run --rows 100k 1M --repeat 3
+#
+# Every run is appended to bench/results.jsonl and compared against the best
+# earlier median for the same case and size; `--check` exits non-zero when a
+# case is slower than that by more than `--threshold`.
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import polars as pl
+
+import main
+import profiling
+import telemetry
+from bench import synth
+
+RESULTS = Path(__file__).parent / "results.jsonl"
+SIZES = {"100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        # The pipeline logs column summaries, keep them out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return {
+        "median_s": round(statistics.median(times), 4),
+        "min_s": round(min(times), 4),
+        "peak_rss_mb": round(telemetry.peak_rss_mb(), 1),
+    }
+
+
+def serialize(df: pl.DataFrame, tables: dict[str, pl.DataFrame], sink: Path):
+    # Local stand-in for the BigQuery upload: the same Parquet payload, on disk
+    for name, table in {"events": df, **tables}.items():
+        (sink / f"{name}.parquet").write_bytes(main.to_parquet(table).getbuffer())
+
+
+def run_size(label: str, rows: int, repeat: int) -> list[dict]:
+    path = synth.csv_path(rows)
+    raw = path.read_bytes()
+    with contextlib.redirect_stdout(io.StringIO()):
+        decoded = main.decode(raw)
+        profiles = profiling.profile(decoded)
+        df, tables = main.extract_dimensions(decoded, profiles)
+    columns = main.dimension_columns(profiles) + main.dictionary_columns(
+        profiles, decoded.height
+    )
+
+    with tempfile.TemporaryDirectory() as sink:
+        cases = {
+            "create_table": lambda: main.create_tables(decoded, columns),
+            "transform": lambda: main.transform(raw),
+            "transform_file": lambda: main.build(main.decode_file(str(path))),
+            # Parsing alone, and on one thread to see what the parallel chunks buy
+            "decode": lambda: main.decode(raw),
+            "decode_file": lambda: main.decode_file(str(path)),
+            "decode_file_1": lambda: main.decode_file(str(path), workers=1),
+            "serialize": lambda: serialize(df, tables, Path(sink)),
+        }
+        results = []
+        for case, fn in cases.items():
+            result = {"case": case, "size": label, "rows": rows, **measure(fn, repeat)}
+            results.append(result)
+    return results
+
+
+def previous_best(history: list[dict], case: str, size: str) -> float | None:
+    # Only runs from this machine are comparable
+    medians = [
+        r["median_s"]
+        for r in history
+        if r["case"] == case and r["size"] == size and r["host"] == platform.node()
+    ]
+    return min(medians) if medians else None
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest pipeline")
+    parser.add_argument("--rows", nargs="+", default=["100k"], choices=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    history = []
+    if RESULTS.exists():
+        history = [json.loads(line) for line in RESULTS.read_text().splitlines()]
+
+    run = {
+        "revision": git_revision(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+    regressions = []
+    results = []
+    for label in args.rows:
+        for result in run_size(label, SIZES[label], args.repeat):
+            best = previous_best(history, result["case"], result["size"])
+            change = None if best is None else result["median_s"] / best - 1
+            if change is not None and change > args.threshold:
+                regressions.append(result)
+
+            change_str = "" if change is None else f"{change:+.1%}"
+            print(
+                f"{result['case']:<14} {label:>5} "
+                f"median {result['median_s']:>8.3f}s  min {result['min_s']:>8.3f}s  "
+                f"rss {result['peak_rss_mb']:>8.1f}MB  {change_str}"
+            )
+            results.append({**run, **result})
+
+    if not args.no_save:
+        with open(RESULTS, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if regressions:
+        print(f">> {len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+        if args.check:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,225 @@
+# %%
+# Synthetic generator for the CDMX traffic incident CSV.
+#
+# Mirrors the column layout of the published dump and roughly its cardinalities
+# (16 alcaldias, ~1,800 colonias, ~20,000 street names, unique folios) so the
+# ingest pipeline can be benchmarked without downloading the real data.
+import datetime
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+DATA_DIR = Path(__file__).parent / "data"
+
+COLUMNS = [
+    "fecha_evento",
+    "hora_evento",
+    "tipo_evento",
+    "fecha_captura",
+    "folio",
+    "latitud",
+    "longitud",
+    "punto_1",
+    "punto_2",
+    "colonia",
+    "alcaldia",
+    "zona_vial",
+    "sector",
+    "unidad_a_cargo",
+    "tipo_de_interseccion",
+    "interseccion_semaforizada",
+    "clasificacion_de_la_vialidad",
+    "sentido_de_circulacion",
+    "dia",
+    "prioridad",
+    "origen",
+    "unidad_medica_de_apoyo",
+    "matricula_unidad_medica",
+    "trasladado_lesionados",
+    "personas_fallecidas",
+    "personas_lesionadas",
+]
+
+# Alcaldia name and approximate centroid (lat, lon)
+ALCALDIAS = {
+    "ALVARO OBREGON": (19.359, -99.236),
+    "AZCAPOTZALCO": (19.487, -99.184),
+    "BENITO JUAREZ": (19.380, -99.160),
+    "COYOACAN": (19.330, -99.151),
+    "CUAJIMALPA": (19.357, -99.299),
+    "CUAUHTEMOC": (19.433, -99.149),
+    "GUSTAVO A. MADERO": (19.493, -99.112),
+    "IZTACALCO": (19.395, -99.097),
+    "IZTAPALAPA": (19.355, -99.063),
+    "MAGDALENA CONTRERAS": (19.306, -99.241),
+    "MIGUEL HIDALGO": (19.430, -99.201),
+    "MILPA ALTA": (19.192, -99.023),
+    "TLAHUAC": (19.286, -99.004),
+    "TLALPAN": (19.287, -99.167),
+    "VENUSTIANO CARRANZA": (19.430, -99.094),
+    "XOCHIMILCO": (19.257, -99.103),
+}
+TIPO_EVENTO = [
+    "CHOQUE",
+    "ATROPELLADO",
+    "DERRAPADO",
+    "VOLCADURA",
+    "CAIDA DE PASAJERO",
+    "CAIDA DE CICLISTA",
+    "PERSONA ATRAPADA / DESBARRANCADA",
+]
+TIPO_INTERSECCION = ["CRUZ", "T", "Y", "GLORIETA", "DESNIVEL", "RECTA", "CURVA"]
+CLASIFICACION = ["PRIMARIA", "SECUNDARIA", "ACCESO CONTROLADO", "EJE VIAL", None]
+SENTIDO = ["UN SENTIDO", "DOBLE SENTIDO", None]
+PRIORIDAD = ["ALTA", "MEDIA", "BAJA"]
+ORIGEN = [
+    "LLAMADA DEL 911",
+    "911 CDMX",
+    "RADIO",
+    "BOTON DE AUXILIO",
+    "CAMARA",
+    "REDES SOCIALES",
+    "APP 911",
+    "ZELLO",
+    "LLAMADA APP911",
+    "MILENIO",
+]
+# Weekday as spelled in the dump, including the unaccented variants
+DIAS = [
+    ["Lunes"],
+    ["Martes"],
+    ["Miércoles", "Miercoles"],
+    ["Jueves"],
+    ["Viernes"],
+    ["Sábado", "Sabado"],
+    ["Domingo"],
+]
+
+N_COLONIAS = 1_800
+N_CALLES = 20_000
+N_SECTORES = 80
+N_UNIDADES = 300
+N_UNIDADES_MEDICAS = 40
+N_MATRICULAS = 250
+
+START_DATE = datetime.date(2019, 1, 1)
+N_DAYS = 6 * 365
+
+
+def zipf_choice(rng: np.random.Generator, n: int, size: int, a: float = 1.1):
+    # Skewed categorical draw: a few values dominate, like real street names
+    weights = 1 / np.arange(1, n + 1) ** a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def labels(prefix: str, ids: np.ndarray) -> pl.Series:
+    return pl.select(
+        pl.concat_str(pl.lit(f"{prefix} "), pl.Series(ids).cast(pl.Utf8))
+    ).to_series()
+
+
+def pick(values: list, ids: np.ndarray) -> pl.Series:
+    return pl.Series(values, dtype=pl.Utf8).gather(ids)
+
+
+def generate(rows: int, seed: int = 0) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    days = rng.integers(0, N_DAYS, rows)
+    offsets = pl.duration(days=pl.lit(pl.Series(days)))
+    fecha = pl.select(pl.lit(START_DATE) + offsets).to_series()
+    weekday = (START_DATE.weekday() + days) % 7
+
+    seconds = rng.integers(0, 24 * 3600, rows)
+    hora = (pl.Series(seconds) * 1_000_000_000).cast(pl.Time).dt.to_string("%H:%M:%S")
+
+    # Pick one of the spellings of each weekday
+    spellings = [spelling for day in DIAS for spelling in day]
+    offsets = np.cumsum([0] + [len(day) for day in DIAS[:-1]])
+    counts = np.array([len(day) for day in DIAS])
+    dia = offsets[weekday] + rng.integers(0, 2, rows) % counts[weekday]
+
+    # Coordinates scattered around the centroid of the event's alcaldia
+    alcaldia = rng.integers(0, len(ALCALDIAS), rows)
+    centroids = np.array(list(ALCALDIAS.values()))
+    latitud = centroids[alcaldia, 0] + rng.normal(0, 0.02, rows)
+    longitud = centroids[alcaldia, 1] + rng.normal(0, 0.02, rows)
+
+    # Colonias and sectores belong to a single alcaldia
+    per_alcaldia = N_COLONIAS // len(ALCALDIAS)
+    colonia = alcaldia * per_alcaldia + zipf_choice(rng, per_alcaldia, rows)
+    sectores = N_SECTORES // len(ALCALDIAS)
+    sector = alcaldia * sectores + rng.integers(0, sectores, rows)
+
+    folio = pl.select(
+        pl.concat_str(
+            pl.lit(f"C5/{seed:02}"),
+            pl.int_range(rows, eager=True).cast(pl.Utf8).str.zfill(9),
+        )
+    ).to_series()
+
+    df = pl.DataFrame(
+        {
+            "fecha_evento": fecha,
+            "hora_evento": hora,
+            "tipo_evento": pick(TIPO_EVENTO, zipf_choice(rng, len(TIPO_EVENTO), rows)),
+            "fecha_captura": fecha,
+            "folio": folio,
+            "latitud": latitud.round(6),
+            "longitud": longitud.round(6),
+            "punto_1": labels("CALLE", zipf_choice(rng, N_CALLES, rows)),
+            "punto_2": labels("CALLE", zipf_choice(rng, N_CALLES, rows)),
+            "colonia": labels("COLONIA", colonia),
+            "alcaldia": pick(list(ALCALDIAS), alcaldia),
+            "zona_vial": rng.integers(1, 6, rows),
+            "sector": labels("SECTOR", sector),
+            "unidad_a_cargo": labels("UNIDAD", rng.integers(0, N_UNIDADES, rows)),
+            "tipo_de_interseccion": pick(
+                TIPO_INTERSECCION, zipf_choice(rng, len(TIPO_INTERSECCION), rows)
+            ),
+            "interseccion_semaforizada": pick(["SI", "NO"], rng.integers(0, 2, rows)),
+            "clasificacion_de_la_vialidad": pick(
+                CLASIFICACION, rng.integers(0, len(CLASIFICACION), rows)
+            ),
+            "sentido_de_circulacion": pick(SENTIDO, rng.integers(0, len(SENTIDO), rows)),
+            "dia": pick(spellings, dia),
+            "prioridad": pick(PRIORIDAD, rng.integers(0, len(PRIORIDAD), rows)),
+            "origen": pick(ORIGEN, zipf_choice(rng, len(ORIGEN), rows)),
+            "unidad_medica_de_apoyo": labels(
+                "AMBULANCIA", rng.integers(0, N_UNIDADES_MEDICAS, rows)
+            ),
+            "matricula_unidad_medica": labels(
+                "MAT", rng.integers(0, N_MATRICULAS, rows)
+            ),
+            "trasladado_lesionados": pick(
+                ["NO", "SI"], (rng.random(rows) < 0.8).astype(np.int64)
+            ),
+            "personas_fallecidas": rng.binomial(1, 0.01, rows),
+            "personas_lesionadas": rng.poisson(0.6, rows),
+        }
+    )
+
+    # Optional fields are missing in part of the real dump
+    optional = [
+        "punto_2",
+        "unidad_a_cargo",
+        "unidad_medica_de_apoyo",
+        "matricula_unidad_medica",
+    ]
+    return df.with_columns(
+        pl.when(pl.Series(rng.random(rows) < 0.3))
+        .then(None)
+        .otherwise(pl.col(name))
+        .alias(name)
+        for name in optional
+    ).select(COLUMNS)
+
+
+def csv_path(rows: int, seed: int = 0) -> Path:
+    # Generated files are cached on disk, generating 10M rows takes a while
+    path = DATA_DIR / f"incidentes_{rows}_{seed}.csv"
+    if not path.exists():
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        generate(rows, seed).write_csv(path, null_value="NA")
+    return path
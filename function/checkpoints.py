@@ -0,0 +1,130 @@
+# %%
+# Stage outputs of an ingest, so a retry resumes where the failed run stopped.
+#
+# Each source gets a directory named after the SHA-256 of its bytes with one
+# Parquet file per frame of a finished stage and a manifest listing the stages
+# and the tables already loaded into BigQuery. A pointer from the URL to the
+# directory lets a retry find it before downloading anything.
+#
+# A retry may land on another instance, and /tmp of a deployed function is its
+# memory, gone with the instance. Deployments point CHECKPOINT_DIR at a mounted
+# bucket (see `just deploy`); without it checkpoints still work within an
+# instance, and every ingest logs a warning.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import polars as pl
+
+import files
+import telemetry
+
+CHECKPOINT_DIR = Path(
+    os.environ.get("CHECKPOINT_DIR", Path(tempfile.gettempdir()) / "checkpoints")
+)
+# Set by the Cloud Functions (and Cloud Run) runtime
+DEPLOYED = "K_SERVICE" in os.environ
+
+
+def check_persistent():
+    if DEPLOYED and "CHECKPOINT_DIR" not in os.environ:
+        telemetry.warn(
+            "CHECKPOINT_DIR is not set, checkpoints are kept in instance memory "
+            "and a retry on another instance starts over",
+            checkpoint_dir=str(CHECKPOINT_DIR),
+        )
+
+
+def new_version() -> str:
+    # When the load started, in UTC so versions sort by it, and a suffix for
+    # loads of different URLs that start within the same second
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime()) + uuid.uuid4().hex[:6]
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+class Checkpoint:
+    def __init__(self, url: str, key: str, root: Path = CHECKPOINT_DIR):
+        self.url = url
+        self.key = key
+        self.root = root
+        self.path = root / key
+        manifest = self.path / "manifest.json"
+        if manifest.exists():
+            self.manifest = json.loads(manifest.read_text())
+        else:
+            self.manifest = {"url": url, "stages": [], "uploaded": []}
+        # Retries load into the same versioned tables as the first attempt
+        self.manifest.setdefault("version", new_version())
+
+    def _write_manifest(self):
+        text = json.dumps(self.manifest)
+        files.atomic_write(self.path / "manifest.json", lambda f: f.write_text(text))
+
+    def has(self, stage: str) -> bool:
+        return stage in self.manifest["stages"]
+
+    def save(self, stage: str, frames: dict[str, pl.DataFrame]):
+        directory = self.path / stage
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, df in frames.items():
+            df.write_parquet(directory / f"{name}.parquet")
+        # The stage only counts once all of its frames are on disk
+        self.manifest["stages"].append(stage)
+        self._write_manifest()
+
+    def load(self, stage: str) -> dict[str, pl.DataFrame]:
+        return {
+            file.stem: pl.read_parquet(file)
+            for file in sorted((self.path / stage).glob("*.parquet"))
+        }
+
+    @property
+    def version(self) -> str:
+        return self.manifest["version"]
+
+    @property
+    def uploaded(self) -> set[str]:
+        return set(self.manifest["uploaded"])
+
+    def mark_uploaded(self, table: str):
+        self.manifest["uploaded"].append(table)
+        self._write_manifest()
+
+    def finish(self):
+        # Nothing left to resume, drop the frames and the URL pointer
+        (self.root / "pending" / url_key(self.url)).unlink(missing_ok=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def start(url: str, source: Path, root: Path = CHECKPOINT_DIR) -> Checkpoint:
+    # The same bytes map to the same checkpoint, whatever run produced it
+    digest = hashlib.sha256()
+    with source.open("rb") as f:
+        while block := f.read(2**20):
+            digest.update(block)
+    checkpoint = Checkpoint(url, digest.hexdigest(), root)
+    checkpoint.path.mkdir(parents=True, exist_ok=True)
+    checkpoint._write_manifest()
+
+    pointer = root / "pending" / url_key(url)
+    pointer.parent.mkdir(parents=True, exist_ok=True)
+    pointer.write_text(checkpoint.key)
+    return checkpoint
+
+
+def pending(url: str, root: Path = CHECKPOINT_DIR) -> Checkpoint | None:
+    # Unfinished checkpoint of an earlier run on this URL that got past parsing
+    check_persistent()
+    pointer = root / "pending" / url_key(url)
+    if not pointer.exists():
+        return None
+    checkpoint = Checkpoint(url, pointer.read_text().strip(), root)
+    return checkpoint if checkpoint.has("decoded") else None
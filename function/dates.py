@@ -0,0 +1,96 @@
+# %%
+# Calendar dimension and the date and hour keys of every event.
+#
+# Events carry `date_key` (the date as the integer YYYYMMDD) and `hora`, so
+# queries group on small integers instead of extracting parts of a DATE and a
+# TIME per row. `calendario` has one row per date_key, in whole years around
+# the data so micro-batches of the current year find their dates, with the
+# parts of the date and the official holidays (Ley Federal del Trabajo, art. 74).
+import datetime
+
+import polars as pl
+
+DATE_KEY_DTYPE = pl.UInt32
+
+
+def date_key(column: str = "fecha_evento") -> pl.Expr:
+    date = pl.col(column)
+    return (
+        date.dt.year().cast(DATE_KEY_DTYPE) * 10000
+        + date.dt.month().cast(DATE_KEY_DTYPE) * 100
+        + date.dt.day().cast(DATE_KEY_DTYPE)
+    )
+
+
+def add_keys(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(
+        date_key().alias("date_key"),
+        pl.col("hora_evento").dt.hour().cast(pl.UInt8).alias("hora"),
+    )
+
+
+def nth_monday(year: int, month: int, n: int) -> datetime.date:
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(days=(7 - first.weekday()) % 7 + 7 * (n - 1))
+
+
+def holidays(year: int) -> dict[datetime.date, str]:
+    days = {
+        datetime.date(year, 1, 1): "Año Nuevo",
+        nth_monday(year, 2, 1): "Día de la Constitución",
+        nth_monday(year, 3, 3): "Natalicio de Benito Juárez",
+        datetime.date(year, 5, 1): "Día del Trabajo",
+        datetime.date(year, 9, 16): "Día de la Independencia",
+        nth_monday(year, 11, 3): "Día de la Revolución",
+        datetime.date(year, 12, 25): "Navidad",
+    }
+    # Every six years (2018, 2024, ...), the day the new president takes office
+    if year % 6 == 2:
+        inauguration = (10, 1) if year >= 2024 else (12, 1)
+        days[datetime.date(year, *inauguration)] = "Transmisión del Poder Ejecutivo"
+    return days
+
+
+def calendar(df: pl.DataFrame, column: str = "fecha_evento") -> pl.DataFrame:
+    first, last = df[column].min(), df[column].max()
+    if not isinstance(first, datetime.date) or not isinstance(last, datetime.date):
+        # No dated events, micro-batches of this year still find their dates
+        first = last = datetime.date.today()
+    years = range(first.year, last.year + 1)
+    festivos = {day: name for year in years for day, name in holidays(year).items()}
+
+    return (
+        pl.DataFrame(
+            {
+                "fecha": pl.date_range(
+                    datetime.date(years[0], 1, 1),
+                    datetime.date(years[-1], 12, 31),
+                    eager=True,
+                )
+            }
+        )
+        .with_columns(
+            date_key("fecha").alias("date_key"),
+            pl.col("fecha").dt.year().cast(pl.UInt16).alias("anio"),
+            pl.col("fecha").dt.quarter().cast(pl.UInt8).alias("trimestre"),
+            pl.col("fecha").dt.month().cast(pl.UInt8).alias("mes"),
+            pl.col("fecha").dt.week().cast(pl.UInt8).alias("semana_iso"),
+            # 0 is Monday, as in `dia`
+            (pl.col("fecha").dt.weekday() - 1).cast(pl.UInt8).alias("dia_semana"),
+            pl.col("fecha")
+            .replace_strict(festivos, default=None, return_dtype=pl.Utf8)
+            .alias("festivo"),
+        )
+        .with_columns(pl.col("festivo").is_not_null().alias("es_festivo"))
+        .select(
+            "date_key",
+            "fecha",
+            "anio",
+            "trimestre",
+            "mes",
+            "semana_iso",
+            "dia_semana",
+            "es_festivo",
+            "festivo",
+        )
+    )
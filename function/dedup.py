@@ -0,0 +1,132 @@
+# %%
+# Duplicate incidents within a dump and across ingests.
+#
+# An incident is the same as an earlier one if it has the same folio, or, as a
+# near-duplicate, if it happened on the same day and time bucket, in the same
+# ~150m cell and with the same tipo_evento. Every loaded incident leaves a
+# 64-bit key in a sorted on-disk array, so a later ingest can tell which of its
+# rows were already loaded with one binary search per row. The array describes
+# one published version of the tables: a full load replaces it, micro-batches
+# add to it, and it says nothing about any other version. Both functions share
+# it on the state mount (see `just deploy`).
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+import files
+
+# Polars hashes are only stable within a version, each version keeps its own index
+INDEX_PATH = Path(
+    os.environ.get(
+        "DEDUP_INDEX",
+        Path(tempfile.gettempdir()) / f"seen_keys-{pl.__version__}.npz",
+    )
+)
+KEY_SEED = 0x5EED
+
+NEAR_BUCKET_MINUTES = 10
+NEAR_CELL = "geohash_7"
+NEAR_COLUMNS = ["fecha_evento", "hora_evento", NEAR_CELL, "tipo_evento"]
+
+
+def near_key() -> pl.Expr:
+    bucket = (
+        pl.col("hora_evento").dt.hour().cast(pl.Int32) * 60
+        + pl.col("hora_evento").dt.minute()
+    ) // NEAR_BUCKET_MINUTES
+    complete = pl.all_horizontal(pl.col(NEAR_COLUMNS).is_not_null())
+    return pl.when(complete).then(
+        pl.struct(
+            pl.col("fecha_evento"), bucket, pl.col(NEAR_CELL), pl.col("tipo_evento")
+        ).hash(KEY_SEED)
+    )
+
+
+def incident_key() -> pl.Expr:
+    # The folio identifies an incident, the near-duplicate key stands in without one
+    return pl.coalesce(pl.col("folio").hash(KEY_SEED), near_key())
+
+
+def duplicated(key: pl.Expr) -> pl.Expr:
+    # Every occurrence after the first, rows without a key are never duplicates
+    return key.is_not_null() & ~key.is_first_distinct()
+
+
+def deduplicate(df: pl.DataFrame) -> tuple[pl.DataFrame, dict[str, int]]:
+    rows = df.height
+    df = df.filter(~duplicated(pl.col("folio")))
+    exact = rows - df.height
+    df = df.filter(~duplicated(near_key()))
+    return df, {"exact": exact, "near": rows - exact - df.height}
+
+
+def keys(df: pl.DataFrame, tables: dict[str, pl.DataFrame]) -> np.ndarray:
+    # Keys are computed on the labels, dimension IDs can change between ingests
+    labels = df.lazy().select(
+        pl.col(name).replace_strict(tables[name]["id"], tables[name][name])
+        if name in tables
+        else pl.col(name)
+        for name in ["folio", *NEAR_COLUMNS]
+    )
+    return (
+        labels.select(incident_key()).collect().to_series().drop_nulls().to_numpy()
+    )
+
+
+class SeenIndex:
+    # Sorted unique keys of every incident in the published tables, and which
+    # version of them that is
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = path
+        self.keys = np.array([], dtype=np.uint64)
+        self.version: str | None = None
+        if path.exists():
+            with np.load(path) as saved:
+                # Keys hashed by another Polars mean nothing to this one
+                hasher = str(saved["polars"]) if "polars" in saved else pl.__version__
+                if hasher == pl.__version__:
+                    self.keys = saved["keys"]
+                    self.version = str(saved["version"]) or None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        index = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        inside = index < len(self.keys)
+        found[inside] = self.keys[index[inside]] == keys[inside]
+        return found
+
+    def describes(self, version: str | None) -> bool:
+        # None is for tables that have no version, from before versioning
+        return self.version == version
+
+    def add(self, keys: np.ndarray):
+        self.keys = np.union1d(self.keys, keys.astype(np.uint64))
+
+    def reset(self, keys: np.ndarray, version: str | None):
+        # The tables were replaced and hold exactly these incidents now
+        self.keys = np.unique(keys.astype(np.uint64))
+        self.version = version
+
+    def save(self):
+        # Keys another writer added to the same version meanwhile are kept
+        saved = SeenIndex(self.path)
+        if saved.version == self.version:
+            self.add(saved.keys)
+
+        def write(tmp: Path):
+            # To an open file, np.savez would add .npz to a path
+            with open(tmp, "wb") as f:
+                np.savez(
+                    f,
+                    keys=self.keys,
+                    version=np.array(self.version or ""),
+                    polars=np.array(pl.__version__),
+                )
+
+        files.atomic_write(self.path, write)
@@ -0,0 +1,201 @@
+# %%
+# Parallel HTTP download with range requests.
+#
+# The size and range support are probed first; the file is then preallocated
+# and fetched as N concurrent byte ranges, each written at its offset. A range
+# whose connection drops is resumed from the last byte it wrote instead of
+# starting over. Every range request carries If-Range with a strong validator,
+# so a file that changed meanwhile is never stitched from two versions. Servers
+# without range support, or without a strong validator, get a single stream,
+# which may come compressed on the fly.
+#
+# Compressed sources (by magic bytes, whatever the URL or Content-Encoding says)
+# are read through a decompressing stream, the plain CSV is never written out:
+# /tmp of a deployed function is memory, it would hold both versions at once.
+import contextlib
+import io
+import hashlib
+import http.client
+import os
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Iterator
+
+DOWNLOAD_PARTS = 8
+# Smaller files aren't worth splitting
+MIN_PART_BYTES = 4 * 2**20
+RETRIES = 3
+TIMEOUT_S = 60
+BLOCK_BYTES = 2**20
+# Encodings open_source() can undo
+ACCEPT_ENCODING = "gzip, zstd"
+MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd", b"PK\x03\x04": "zip"}
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass
+class Probe:
+    size: int | None
+    ranges: bool
+    etag: str | None
+    last_modified: str | None
+
+    @property
+    def validator(self) -> str | None:
+        # If-Range only matches strong ETags, a weak one (W/"...") would make every
+        # range come back as the whole file. Last-Modified is the fallback.
+        if self.etag is not None and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+
+def probe(url: str) -> Probe:
+    # One-byte range request: a 206 with Content-Range gives the size and proves
+    # ranges work, which a HEAD's Accept-Ranges alone doesn't
+    req = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(req, timeout=TIMEOUT_S) as response:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        content_range = response.headers.get("Content-Range", "")
+        if response.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            size = int(total) if total != "*" else None
+            return Probe(size, True, etag, last_modified)
+        length = response.headers.get("Content-Length")
+        return Probe(int(length) if length else None, False, etag, last_modified)
+
+
+def fetch_range(
+    url: str, fd: int, start: int, end: int, validator: str, retries: int = RETRIES
+):
+    # Bytes [start, end] (inclusive) written at their offset in `fd`
+    position = start
+    for attempt in range(retries + 1):
+        # The server answers with the whole (new) file if it changed meanwhile
+        headers = {"Range": f"bytes={position}-{end}", "If-Range": validator}
+        try:
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=TIMEOUT_S) as response:
+                # Some servers ignore If-Range, the validator still tells
+                header = "ETag" if validator.startswith('"') else "Last-Modified"
+                current = response.headers.get(header)
+                if response.status != 206 or current not in (None, validator):
+                    raise DownloadError(f"{url} changed while downloading it")
+                while position <= end:
+                    block = response.read(min(BLOCK_BYTES, end - position + 1))
+                    if not block:
+                        break
+                    os.pwrite(fd, block, position)
+                    position += len(block)
+            if position > end:
+                return
+        except (
+            urllib.error.URLError,
+            http.client.HTTPException,
+            ConnectionError,
+            TimeoutError,
+        ) as e:
+            if attempt == retries:
+                message = f"Range {start}-{end} of {url} failed: {e}"
+                raise DownloadError(message) from e
+    raise DownloadError(f"Range {start}-{end} of {url} ended early")
+
+
+def fetch_stream(url: str, path: Path) -> tuple[int, int | None]:
+    # Bytes written and bytes announced, unknown when the server compressed them
+    req = urllib.request.Request(url, headers={"Accept-Encoding": ACCEPT_ENCODING})
+    written = 0
+    with (
+        urllib.request.urlopen(req, timeout=TIMEOUT_S) as response,
+        open(path, "wb") as f,
+    ):
+        length = response.headers.get("Content-Length")
+        if response.headers.get("Content-Encoding", "identity") != "identity":
+            length = None
+        while block := response.read(BLOCK_BYTES):
+            f.write(block)
+            written += len(block)
+    return written, int(length) if length else None
+
+
+def fetch(
+    url: str,
+    path: Path,
+    parts: int = DOWNLOAD_PARTS,
+    sha256: str | None = None,
+    probed: Probe | None = None,
+) -> Path:
+    # `probed` is the probe of a caller that already made one
+    if probed is None:
+        probed = probe(url)
+    size, validator = probed.size, probed.validator
+
+    if (
+        not probed.ranges
+        or validator is None
+        or size is None
+        or size < 2 * MIN_PART_BYTES
+    ):
+        written, size = fetch_stream(url, path)
+    else:
+        parts = max(1, min(parts, size // MIN_PART_BYTES))
+        bounds = [size * i // parts for i in range(parts + 1)]
+        with open(path, "wb") as f:
+            f.truncate(size)
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(parts) as pool:
+                futures = [
+                    pool.submit(fetch_range, url, fd, lo, hi - 1, validator)
+                    for lo, hi in zip(bounds, bounds[1:])
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+        written = path.stat().st_size
+
+    if size is not None and written != size:
+        raise DownloadError(f"Expected {size} bytes from {url}, got {written}")
+    if sha256 is not None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while block := f.read(BLOCK_BYTES):
+                digest.update(block)
+        if digest.hexdigest() != sha256:
+            raise DownloadError(f"Checksum mismatch for {url}")
+    return path
+
+
+def compression(path: Path) -> str | None:
+    with open(path, "rb") as f:
+        head = f.read(4)
+    return next((kind for magic, kind in MAGIC.items() if head.startswith(magic)), None)
+
+
+@contextlib.contextmanager
+def open_source(path: Path) -> Iterator[IO[bytes]]:
+    # The plain bytes of a downloaded source, decompressed block by block as
+    # they are read if it came zipped, gzipped or zstd-compressed
+    kind = compression(path)
+    with contextlib.ExitStack() as stack:
+        if kind is None:
+            yield stack.enter_context(open(path, "rb"))
+        elif kind == "zip":
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            # Portals bundle the dump with small readmes or dictionaries
+            member = max(archive.infolist(), key=lambda m: m.file_size)
+            yield stack.enter_context(archive.open(member))
+        else:
+            import pyarrow as pa
+
+            # Concatenated gzip members read as one stream, as `zcat` does
+            stream = pa.CompressedInputStream(pa.OSFile(str(path)), kind)
+            yield stack.enter_context(io.BufferedReader(stream, BLOCK_BYTES))
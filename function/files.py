@@ -0,0 +1,22 @@
+# %%
+# Files that other runs may read while they are being written.
+#
+# A file is written under a hidden name of its own next to where it goes and
+# renamed over it once complete. Readers see the old version or the new one,
+# never half of a file, and concurrent writers of the same file never write into
+# each other's. On a mounted bucket the rename is a copy, the object it leaves
+# is still complete.
+import uuid
+from pathlib import Path
+from typing import Callable
+
+
+def atomic_write(path: Path, writer: Callable[[Path], object]):
+    # `writer` writes the whole file to the path it is given
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        writer(tmp)
+        tmp.replace(path)
+    finally:
+        tmp.unlink(missing_ok=True)
@@ -0,0 +1,296 @@
+# %%
+# Geohash cells and intersection matching for incident coordinates.
+#
+# Cells are kept as integers (the interleaved geohash bits) instead of base32
+# strings: they are a quarter of the size, cluster well in BigQuery and a cell
+# at a coarser precision is just a right shift of a finer one, so every
+# precision maps to a contiguous range of the finest IDs.
+import math
+from functools import reduce
+
+import numpy as np
+import polars as pl
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Precisions stored per event: ~4.9km, ~1.2km and ~150m cells
+PRECISIONS = [5, 6, 7]
+MAX_PRECISION = max(PRECISIONS)
+
+EARTH_RADIUS_M = 6_371_000
+
+
+def cell_bits(precision: int) -> tuple[int, int]:
+    # Geohash alternates longitude and latitude bits, starting with longitude
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+
+def cell_dtype(precision: int) -> type[pl.DataType]:
+    return pl.UInt32 if 5 * precision <= 32 else pl.UInt64
+
+
+def interleave(x: np.ndarray, y: np.ndarray, precision: int) -> np.ndarray:
+    lon_bits, lat_bits = cell_bits(precision)
+    cells = np.zeros(len(x), dtype=np.uint64)
+    for i in range(5 * precision):
+        # Even bits (from the most significant one) are longitude, odd are latitude
+        if i % 2 == 0:
+            bit = (x >> np.uint64(lon_bits - 1 - i // 2)) & np.uint64(1)
+        else:
+            bit = (y >> np.uint64(lat_bits - 1 - i // 2)) & np.uint64(1)
+        cells = (cells << np.uint64(1)) | bit
+    return cells
+
+
+def grid_index(
+    lat: np.ndarray, lon: np.ndarray, precision: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # Column/row of the cell containing each point on the precision's uniform grid
+    lon_bits, lat_bits = cell_bits(precision)
+    x = np.floor((lon + 180) / 360 * 2**lon_bits)
+    y = np.floor((lat + 90) / 180 * 2**lat_bits)
+    x = np.clip(x, 0, 2**lon_bits - 1).astype(np.uint64)
+    y = np.clip(y, 0, 2**lat_bits - 1).astype(np.uint64)
+    return x, y
+
+
+def encode(lat: np.ndarray, lon: np.ndarray, precision: int) -> np.ndarray:
+    return interleave(*grid_index(lat, lon, precision), precision)
+
+
+def to_string(cells: np.ndarray, precision: int) -> np.ndarray:
+    # Base32 geohash strings, only meant for display and interoperability
+    chars = np.array(list(BASE32))
+    groups = [
+        chars[(cells >> np.uint64(5 * (precision - 1 - i))) & np.uint64(31)]
+        for i in range(precision)
+    ]
+    return reduce(np.char.add, groups)
+
+
+def cell_center(cells: np.ndarray, precision: int) -> tuple[np.ndarray, np.ndarray]:
+    lon_bits, lat_bits = cell_bits(precision)
+    x = np.zeros(len(cells), dtype=np.uint64)
+    y = np.zeros(len(cells), dtype=np.uint64)
+    for i in range(5 * precision):
+        bit = (cells >> np.uint64(5 * precision - 1 - i)) & np.uint64(1)
+        if i % 2 == 0:
+            x = (x << np.uint64(1)) | bit
+        else:
+            y = (y << np.uint64(1)) | bit
+    lon = (x.astype(np.float64) + 0.5) / 2**lon_bits * 360 - 180
+    lat = (y.astype(np.float64) + 0.5) / 2**lat_bits * 180 - 90
+    return lat, lon
+
+
+def add_cells(df: pl.DataFrame) -> pl.DataFrame:
+    lat = df["latitud"].fill_null(0).to_numpy().astype(np.float64)
+    lon = df["longitud"].fill_null(0).to_numpy().astype(np.float64)
+    cells = encode(lat, lon, MAX_PRECISION)
+
+    # Events without coordinates get null cells
+    valid = pl.col("latitud").is_not_null() & pl.col("longitud").is_not_null()
+    return df.with_columns(
+        pl.when(valid)
+        .then(
+            pl.Series(cells >> np.uint64(5 * (MAX_PRECISION - precision))).cast(
+                cell_dtype(precision)
+            )
+        )
+        .alias(f"geohash_{precision}")
+        for precision in PRECISIONS
+    )
+
+
+def hotspots(df: pl.DataFrame, precision: int = 6) -> pl.DataFrame:
+    # Grid-level aggregates: one row per cell with its incident and victim counts
+    column = f"geohash_{precision}"
+    grid = (
+        df.lazy()
+        .filter(pl.col(column).is_not_null())
+        .group_by(column)
+        .agg(
+            pl.len().alias("eventos"),
+            pl.col("personas_fallecidas").sum().alias("fallecidos"),
+            pl.col("personas_lesionadas").sum().alias("lesionados"),
+        )
+        .sort("eventos", descending=True)
+        .collect()
+    )
+    cells = grid[column].to_numpy().astype(np.uint64)
+    lat, lon = cell_center(cells, precision)
+    return grid.with_columns(
+        pl.Series("geohash", to_string(cells, precision)),
+        pl.Series("latitud", lat),
+        pl.Series("longitud", lon),
+    )
+
+
+def haversine_m(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: float, lon2: float
+) -> np.ndarray:
+    phi1, lambda1 = np.radians(lat1), np.radians(lon1)
+    phi2, lambda2 = np.radians(lat2), np.radians(lon2)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin((lambda2 - lambda1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    # Events sorted by their finest cell. A bounding box is covered by a few
+    # coarser cells, each of which is a contiguous slice of the sorted IDs, so a
+    # query is a handful of binary searches plus an exact filter on the slices.
+    def __init__(self, df: pl.DataFrame, max_cells: int = 64):
+        column = f"geohash_{MAX_PRECISION}"
+        if column not in df.columns:
+            df = add_cells(df)
+        self.df = df.filter(pl.col(column).is_not_null()).sort(column)
+        self.cells = self.df[column].to_numpy().astype(np.uint64)
+        self.lat = self.df["latitud"].to_numpy()
+        self.lon = self.df["longitud"].to_numpy()
+        self.max_cells = max_cells
+
+    def covering(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> tuple[np.ndarray, int]:
+        # Finest precision whose cells cover the box with at most max_cells cells
+        for precision in range(MAX_PRECISION, 0, -1):
+            x0, y0 = grid_index(np.array([min_lat]), np.array([min_lon]), precision)
+            x1, y1 = grid_index(np.array([max_lat]), np.array([max_lon]), precision)
+            count = (int(x1[0]) - int(x0[0]) + 1) * (int(y1[0]) - int(y0[0]) + 1)
+            if count <= self.max_cells or precision == 1:
+                xs, ys = np.meshgrid(
+                    np.arange(x0[0], x1[0] + 1, dtype=np.uint64),
+                    np.arange(y0[0], y1[0] + 1, dtype=np.uint64),
+                )
+                return interleave(xs.ravel(), ys.ravel(), precision), precision
+        raise AssertionError("unreachable")
+
+    def candidates(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> np.ndarray:
+        cells, precision = self.covering(min_lat, min_lon, max_lat, max_lon)
+        shift = np.uint64(5 * (MAX_PRECISION - precision))
+        starts = np.searchsorted(self.cells, cells << shift, side="left")
+        ends = np.searchsorted(self.cells, (cells + np.uint64(1)) << shift, side="left")
+        return np.concatenate(
+            [np.arange(s, e) for s, e in zip(starts, ends) if e > s]
+            or [np.array([], dtype=np.int64)]
+        )
+
+    def bbox(
+        self, min_lat: float, min_lon: float, max_lat: float, max_lon: float
+    ) -> pl.DataFrame:
+        rows = self.candidates(min_lat, min_lon, max_lat, max_lon)
+        lat, lon = self.lat[rows], self.lon[rows]
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return self.df[rows[inside]]
+
+    def radius(self, lat: float, lon: float, meters: float) -> pl.DataFrame:
+        dlat = math.degrees(meters / EARTH_RADIUS_M)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-12)
+        rows = self.candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        distance = haversine_m(self.lat[rows], self.lon[rows], lat, lon)
+        inside = distance <= meters
+        return self.df[rows[inside]].with_columns(
+            pl.Series("distancia_m", distance[inside])
+        )
+
+
+# Events farther than this from every known intersection stay unmatched
+MATCH_MAX_DISTANCE_M = 75
+
+
+def project_m(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    # Equirectangular projection around CDMX, accurate to centimeters at city scale
+    lat0 = math.radians(19.4)
+    x = np.radians(lon) * math.cos(lat0) * EARTH_RADIUS_M
+    y = np.radians(lat) * EARTH_RADIUS_M
+    return np.column_stack([x, y])
+
+
+def build_intersections(
+    df: pl.DataFrame, previous: pl.DataFrame | None = None
+) -> pl.DataFrame:
+    # Canonical intersections from the events that name both streets: the pair is
+    # order-insensitive and placed at the median of its reported coordinates.
+    # Intersections of `previous` (the published catalog) keep their IDs, also
+    # when this dump doesn't name them, and new ones are appended after them.
+    current = (
+        df.lazy()
+        .filter(
+            pl.col("punto_1").is_not_null()
+            & pl.col("punto_2").is_not_null()
+            & pl.col("latitud").is_not_null()
+            & pl.col("longitud").is_not_null()
+        )
+        .select(
+            pl.min_horizontal("punto_1", "punto_2").alias("calle_1"),
+            pl.max_horizontal("punto_1", "punto_2").alias("calle_2"),
+            "latitud",
+            "longitud",
+        )
+        .group_by("calle_1", "calle_2")
+        .agg(
+            pl.col("latitud").median(),
+            pl.col("longitud").median(),
+            pl.len().alias("eventos"),
+        )
+        .sort("calle_1", "calle_2")
+        .collect()
+    )
+    if previous is None or previous.height == 0:
+        return current.with_row_index("id")
+
+    pair = ["calle_1", "calle_2"]
+    known = (
+        previous.sort("id")
+        .select(*pair, "latitud", "longitud")
+        .with_columns(pl.col(pair).cast(pl.Utf8))
+        .join(current, on=pair, how="left", suffix="_dump")
+        .select(
+            *pair,
+            pl.coalesce("latitud_dump", "latitud").alias("latitud"),
+            pl.coalesce("longitud_dump", "longitud").alias("longitud"),
+            pl.col("eventos").fill_null(0).cast(current.schema["eventos"]),
+        )
+    )
+    new = current.join(known, on=pair, how="anti")
+    return pl.concat([known, new]).with_row_index("id")
+
+
+def match_intersections(
+    df: pl.DataFrame,
+    intersections: pl.DataFrame,
+    max_distance_m: float = MATCH_MAX_DISTANCE_M,
+) -> pl.DataFrame:
+    # Nearest intersection for every event in one batched KD-tree query
+    from scipy.spatial import KDTree
+
+    tree = KDTree(
+        project_m(
+            intersections["latitud"].to_numpy(), intersections["longitud"].to_numpy()
+        )
+    )
+
+    valid = (df["latitud"].is_not_null() & df["longitud"].is_not_null()).to_numpy()
+    points = project_m(
+        df["latitud"].fill_null(0).to_numpy(), df["longitud"].fill_null(0).to_numpy()
+    )
+    distance, index = tree.query(
+        points[valid], distance_upper_bound=max_distance_m, workers=-1
+    )
+
+    # Misses come back as index == len(intersections)
+    ids = np.full(df.height, len(intersections), dtype=np.int64)
+    ids[valid] = index
+    matched = ids < len(intersections)
+    return df.with_columns(
+        pl.when(pl.Series(matched))
+        .then(pl.Series(np.where(matched, ids, 0)))
+        .cast(intersections.schema["id"])
+        .alias("interseccion_id")
+    )
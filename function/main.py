@@ -1,58 +1,214 @@
 # %%
+from __future__ import annotations
+
+import time
+
+_MODULE_START = time.perf_counter()
+
 import base64
-from io import BufferedReader
-import polars as pl
-import urllib.request
-import functions_framework
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Iterator
+
+# Seconds spent on each import/initialization step, reported on cold start
+STARTUP: dict[str, float] = {}
+
+
+@contextmanager
+def startup_timer(name: str):
+    start = time.perf_counter()
+    yield
+    STARTUP[name] = STARTUP.get(name, 0.0) + time.perf_counter() - start
+
+
+with startup_timer("polars"):
+    import polars as pl
+
+with startup_timer("functions_framework"):
+    import functions_framework
+
+with startup_timer("modules"):
+    import anomalies
+    import checkpoints
+    import dates
+    import dedup
+    import download
+    import geo
+    import profiling
+    import quality
+    import singleflight
+    import stream
+    import telemetry
+
+# BigQuery (and its google-auth/requests stack) is only imported on first use
+if TYPE_CHECKING:
+    from cloudevents.http import CloudEvent
+    from google.cloud import bigquery
+
+# Shared BigQuery client, built on first use and kept alive across warm invocations
+_client: bigquery.Client | None = None
+_cold_start = True
+HTTP_POOL_SIZE = 16
+
+
+def get_client() -> bigquery.Client:
+    global _client
+    if _client is None:
+        with startup_timer("google.cloud.bigquery"):
+            import google.auth
+            import requests.adapters
+            from google.auth.transport.requests import AuthorizedSession
+            from google.cloud import bigquery
+
+        with startup_timer("bigquery_client"):
+            credentials, project = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
 
-from google.cloud import bigquery
-from cloudevents.http import CloudEvent
+            # One keep-alive connection pool for every table instead of a new
+            # session (TLS handshake + token fetch) per upload
+            session = AuthorizedSession(credentials)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+
+            _client = bigquery.Client(
+                project=project, credentials=credentials, _http=session
+            )
+    return _client
+
+
+def report_cold_start():
+    # Print the startup breakdown once per instance, on its first invocation
+    global _cold_start
+    if not _cold_start:
+        return
+    _cold_start = False
+
+    breakdown = {name: round(seconds, 4) for name, seconds in STARTUP.items()}
+    print(
+        json.dumps(
+            {
+                "event": "cold_start",
+                "module_init_s": round(_MODULE_INIT, 4),
+                "first_invocation_s": round(time.perf_counter() - _MODULE_START, 4),
+                "breakdown_s": breakdown,
+            }
+        )
+    )
 
 
 # %%
+# Smallest unsigned type able to hold `n` distinct IDs
+ID_TYPES = [(pl.UInt8, 2**8), (pl.UInt16, 2**16), (pl.UInt32, 2**32), (pl.UInt64, 2**64)]
+
+
+def id_dtype(n: int) -> pl.DataType:
+    for dtype, size in ID_TYPES:
+        if n <= size:
+            return dtype
+    raise OverflowError(f"Too many values to encode: {n}")
+
+
 def create_table(df: pl.DataFrame, column: str) -> tuple[pl.DataFrame, pl.DataFrame]:
-    # Create new dataframe with ID and column values
-    new_df = (
-        df.lazy()
-        .select(
-            pl.col(column).unique().rank("min").alias("id").cast(pl.UInt16) - 1,
-            pl.col(column).unique(),
-        )
-        .sort("id")
-        .collect()
+    df, tables = create_tables(df, [column])
+    return (df, tables[column])
+
+
+def create_tables(
+    df: pl.DataFrame,
+    columns: list[str],
+    previous: dict[str, pl.DataFrame] | None = None,
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame]]:
+    # Create one dataframe per column with ID and column values, on a first load
+    # IDs follow the sorted values. All of them are built in a single parallel
+    # pass.
+    #
+    # Values of a `previous` table (the published one) keep their IDs and new
+    # values are appended after them, so IDs never change meaning across loads:
+    # events of the last load decode right with these tables.
+    previous = previous or {}
+    uniques = pl.collect_all(
+        [
+            df.lazy().select(pl.col(column).unique().drop_nulls().sort())
+            for column in columns
+        ]
     )
+    tables = {}
+    for column, values in zip(columns, uniques):
+        labels = values
+        if column in previous:
+            known = previous[column].sort("id")
+            if known["id"].cast(pl.Int64).to_list() != list(range(known.height)):
+                raise ValueError(f"IDs of the published {column} table have gaps")
+            known = known.select(pl.col(column).cast(pl.Utf8))
+            labels = pl.concat([known, values.join(known, on=column, how="anti")])
+        tables[column] = labels.with_row_index("id").with_columns(
+            pl.col("id").cast(id_dtype(labels.height))
+        )
 
-    # Replace values in original df with IDs
-    value_map = dict(zip(new_df[column], new_df["id"]))
-    df = (
-        df.lazy()
-        .with_columns(pl.col(column).replace_strict(value_map, return_dtype=pl.UInt16))
-        .collect()
+    # Replace values in original df with IDs. Casting to an Enum of the values in
+    # ID order is a hash lookup whose physical codes are exactly those IDs; nulls
+    # stay null.
+    df = df.with_columns(
+        pl.col(column)
+        .cast(pl.Enum(new_df[column]))
+        .to_physical()
+        .cast(new_df.schema["id"])
+        for column, new_df in tables.items()
     )
 
-    return (df, new_df)
+    return (df, tables)
 
 
 # %%
-def print_columns(df):
-    for column in df.get_columns():
-        uniques = column.n_unique()
-        print(f"Uniques for col {column.name}: {uniques}", end="")
-        if uniques < 250:
-            uniques = column.unique().to_list()
-            print(f": {uniques[:10]}")
+def print_columns(profiles: list[profiling.ColumnProfile]):
+    for profile in profiles:
+        print(f"Uniques for col {profile.name}: {profile.n_unique}", end="")
+        if profile.top:
+            print(f": {[value for value, _ in profile.top]}")
         else:
             print("")
 
 
+def to_parquet(df: pl.DataFrame) -> io.BytesIO:
+    with startup_timer("pyarrow"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+    # BigQuery only reads Parquet TIME columns with up to microsecond precision
+    table = df.to_arrow()
+    schema = pa.schema(
+        [
+            pa.field(field.name, pa.time64("us")) if pa.types.is_time(field.type) else field
+            for field in table.schema
+        ]
+    )
+
+    buffer = io.BytesIO()
+    pq.write_table(table.cast(schema), buffer)
+    buffer.seek(0)
+    return buffer
+
+
 def df_to_bigquery(
     df: pl.DataFrame,
     project_id: str,
     dataset_id: str,
     table_id: str,
     clustered_by: list[str] | None = None,
-):
-    client = bigquery.Client()
+    profiles: dict[str, profiling.ColumnProfile] | None = None,
+) -> bigquery.LoadJob:
+    from google.cloud import bigquery
+
+    client = get_client()
     table_ref = f"{project_id}.{dataset_id}.{table_id}"
 
     # Delete table if it exists
@@ -80,8 +236,11 @@ def df_to_bigquery(
         else:
             bq_type = "STRING"
 
-        # Check if column has null values
-        is_nullable = df[name].null_count() > 0
+        # Check if column has null values, reusing the ingest profile when there is one
+        if profiles is not None and name in profiles:
+            is_nullable = profiles[name].nullable
+        else:
+            is_nullable = df[name].null_count() > 0
 
         # Make id columns non-nullable primary keys
         schema.append(
@@ -99,143 +258,666 @@ def df_to_bigquery(
 
     table = client.create_table(table)
 
-    # Convert to pandas and upload (BigQuery client doesn't support Polars directly)
-    job_config = bigquery.LoadJobConfig(schema=schema)
-    client.load_table_from_dataframe(df.to_pandas(), table_ref, job_config=job_config)
+    # Upload as Parquet (BigQuery client doesn't support Polars directly)
+    with telemetry.span("serialize", table=table_id) as span:
+        parquet = to_parquet(df)
+        span.record(rows=df.height, nbytes=parquet.getbuffer().nbytes)
+
+    job_config = bigquery.LoadJobConfig(
+        schema=schema, source_format=bigquery.SourceFormat.PARQUET
+    )
+    return client.load_table_from_file(parquet, table_ref, job_config=job_config)
 
 
-# Create traffic_data dataset if it doesn't exist
+# Create traffic_data dataset if it doesn't exist. Tables are replaced through
+# versions (see publish), the dataset itself is never dropped.
 def create_dataset(client: bigquery.Client, dataset_name: str):
-    dataset_id = f"{client.project}.{dataset_name}"
-    try:
-        client.delete_dataset(dataset_id, delete_contents=True, not_found_ok=True)
-        print(f"Deleted existing dataset {dataset_id}")
-    except Exception as e:
-        print(f"Error deleting dataset {dataset_id}: {e}")
+    from google.cloud import bigquery
 
+    dataset_id = f"{client.project}.{dataset_name}"
     dataset = bigquery.Dataset(dataset_id)
     dataset.location = "US"
     client.create_dataset(dataset, exists_ok=True)
-    print(f"Created dataset {dataset_id}")
-
-def get_response(URL: str) -> BufferedReader:
-    # cache_filename = "downloaded_data.csv"
-    # try:
-    #     # Try to open cached file first
-    #     response = open(cache_filename, "rb")
-    #     print("Using cached file")
-    # except FileNotFoundError:
-    #     # If cache doesn't exist, download and save
-    #     print("Downloading fresh copy")
-    #     req = urllib.request.Request(url=URL)
-    #     response = urllib.request.urlopen(req)
-    #     with open(cache_filename, "wb") as f:
-    #         f.write(response.read())
-    #     response = open(cache_filename, "rb")
+    print(f"Dataset {dataset_id} ready")
 
-    print(f"Downloading fresh copy of {URL}")
-    req = urllib.request.Request(url=URL)
-    response = urllib.request.urlopen(req)
 
-    return response.read()
+# Every load goes to `<table>__v<version>` tables; readers query `<table>`, a view
+# on the current version, which is swapped once all tables of a load are in.
+# Older versions are kept for TABLE_RETENTION_HOURS to allow rolling back.
+VERSION_SEPARATOR = "__v"
+TABLE_RETENTION_HOURS = float(os.environ.get("TABLE_RETENTION_HOURS", 72))
+
+
+def table_version() -> str:
+    return checkpoints.new_version()
+
+
+def versioned(name: str, version: str) -> str:
+    return f"{name}{VERSION_SEPARATOR}{version}"
+
+
+def publish(
+    client: bigquery.Client, dataset_name: str, names: list[str], version: str
+):
+    dataset_id = f"{client.project}.{dataset_name}"
+    legacy = {
+        table.table_id
+        for table in client.list_tables(dataset_id)
+        if table.table_id in names and table.table_type == "TABLE"
+    }
+
+    # Each CREATE OR REPLACE VIEW is atomic, but BigQuery transactions take no
+    # DDL, so the views move one at a time in a single script. Dimension IDs
+    # are never reassigned (see create_tables): the events of the old version
+    # decode right with the new dimensions, which go first, and events last.
+    statements = []
+    for name in sorted(names, key=lambda name: name == "events"):
+        if name in legacy:
+            # A table from before versioning is in the way of its view, it goes
+            # right before the view takes its place
+            statements.append(f"DROP TABLE `{dataset_id}.{name}`;")
+        statements.append(
+            f"CREATE OR REPLACE VIEW `{dataset_id}.{name}` AS "
+            f"SELECT * FROM `{dataset_id}.{versioned(name, version)}`;"
+        )
+    client.query("\n".join(statements)).result()
+    print(f"Published version {version} of {len(names)} tables")
+
+
+def prune(client: bigquery.Client, dataset_name: str, current: str):
+    cutoff = time.strftime(
+        "%Y%m%d%H%M%S", time.gmtime(time.time() - TABLE_RETENTION_HOURS * 3600)
+    )
+    for table in client.list_tables(f"{client.project}.{dataset_name}"):
+        _, separator, version = table.table_id.rpartition(VERSION_SEPARATOR)
+        if separator and version != current and version < cutoff:
+            client.delete_table(table)
+            print(f"Deleted expired table {table.table_id}")
+
+
+# The source as it was downloaded into `directory`, zipped, gzipped or
+# zstd-compressed if it came so: decode_file() reads through the compression
+def get_source(
+    URL: str, directory: Path, probed: download.Probe | None = None
+) -> Path:
+    print(f"Downloading fresh copy of {URL}")
+    return download.fetch(URL, directory / "source", probed=probed)
 
 # %%
 @functions_framework.cloud_event
 def my_cloudevent_function(
     cloud_event: CloudEvent,
 ):
+    report_cold_start()
+
     URL = base64.b64decode(cloud_event.data["message"]["data"]).decode()
-    response = get_response(URL)
 
+    # Duplicate deliveries and overlapping publishes of a URL share one run, runs
+    # for other URLs wait for it
+    with telemetry.trace(), telemetry.span("ingest", url=URL) as span:
+        ran = singleflight.run(
+            URL, lambda: ingest(URL), lambda: get_sink().published()
+        )
+        span.record(coalesced=not ran)
+
+
+# Small batches of incidents as a JSON list of records with the CSV's columns,
+# appended to the loaded tables without waiting for the next dump
+@functions_framework.cloud_event
+def my_microbatch_function(
+    cloud_event: CloudEvent,
+):
+    report_cold_start()
+
+    records = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+
+    with telemetry.trace(), telemetry.span("microbatch", records=len(records)):
+        ingest_records(records)
+
+
+# Where loads and micro-batches go, and where the published dimensions come from
+_sink: stream.LocalSink | stream.BigQuerySink | None = None
+_sink_lock = threading.Lock()
+
+
+def get_sink() -> stream.LocalSink | stream.BigQuerySink:
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            if stream.SINK_DIR:
+                _sink = stream.LocalSink(Path(stream.SINK_DIR))
+            else:
+                _sink = stream.BigQuerySink(get_client())
+    return _sink
+
+
+# Batches of concurrent invocations are written together, one Batcher per instance
+_batcher: stream.Batcher | None = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> stream.Batcher:
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = stream.Batcher(get_sink(), dedup.SeenIndex())
+    return _batcher
+
+
+def ingest_records(records: list[dict]):
+    df = decode_records(records)
+
+    with telemetry.span("geo") as span:
+        df = geo.add_cells(df)
+        span.record(df)
+    df = dates.add_keys(df)
+
+    with telemetry.span("submit") as span:
+        get_batcher().submit(df)
+        span.record(df)
+
+
+def ingest(URL: str):
+    # A retry of a failed run resumes from its checkpoint, past the download and
+    # every stage that already finished
+    checkpoint = checkpoints.pending(URL)
+    sink = get_sink()
+    df = None
+    etag = None
+    if checkpoint is None:
+        # Content that was already loaded is neither downloaded nor parsed again,
+        # unless a load of another URL replaced it since or micro-batch rows are
+        # waiting for a load
+        previous = singleflight.last(URL, sink.published())
+        if stream.deferred():
+            previous = None
+        probed = download.probe(URL)
+        etag = probed.etag
+        if previous is not None and etag is not None and etag == previous["etag"]:
+            print(">> Source unchanged since the last load, skipping")
+            return
+
+        # The CSV is parsed straight from disk, it is never held in memory as bytes
+        with tempfile.TemporaryDirectory() as tmp:
+            with telemetry.span("download") as span:
+                source = get_source(URL, Path(tmp), probed)
+                span.record(nbytes=source.stat().st_size)
+            checkpoint = checkpoints.start(URL, source)
+            if previous is not None and checkpoint.key == previous["sha256"]:
+                print(">> Same content as the last load, skipping")
+                singleflight.record(URL, checkpoint.key, etag, previous["version"])
+                checkpoint.finish()
+                return
+            if not checkpoint.has("decoded"):
+                df = decode_file(str(source))
+                checkpoint.save("decoded", {"events": df})
+
+    # What readers see now: the dimensions whose IDs this load keeps, and the
+    # version the seen index has to describe for anything to be skipped
+    published = sink.dimensions()
+
+    if checkpoint.has("encoded"):
+        with telemetry.span("resume", stage="encoded") as span:
+            tables = checkpoint.load("encoded")
+            df = tables.pop("events")
+            state = anomalies.State(**checkpoint.load("anomalies"))
+            span.record(df, tables=len(tables))
+        profiles = None
+    else:
+        state = None
+        if df is None:
+            with telemetry.span("resume", stage="decoded") as span:
+                df = checkpoint.load("decoded")["events"]
+                span.record(df)
+        deferred = take_deferred(checkpoint, df.columns)
+        df = pl.concat([df, deferred], how="diagonal_relaxed")
+        df, tables, profiles = build(df, published)
+
+    # Re-ingesting a dump whose incidents are all in the tables is a no-op
+    with telemetry.span("seen") as span:
+        seen = dedup.SeenIndex()
+        keys = dedup.keys(df, tables)
+        new = int((~seen.contains(keys)).sum())
+        current = seen.describes(sink.version)
+        span.record(df, new=new, seen=len(seen), current=current)
+    if new == 0 and current:
+        print(">> No new incidents, skipping upload")
+        singleflight.record(URL, checkpoint.key, etag, sink.version)
+        checkpoint.finish()
+        return
+
+    if state is None:
+        # Baselines only advance once the upload went through
+        with telemetry.span("anomalies") as span:
+            state = anomalies.load()
+            tables["anomalias"], state = anomalies.detect(df, tables, state)
+            span.record(tables["anomalias"], last_day=str(state.last_day))
+
+        with telemetry.span("checkpoint") as span:
+            checkpoint.save("encoded", {"events": df, **tables})
+            checkpoint.save(
+                "anomalies",
+                {"baselines": state.baselines, "anomalies": state.anomalies},
+            )
+            span.record(df, tables=len(tables))
+
+    version = upload(df, tables, profiles, checkpoint)
+    anomalies.save(state)
+    # The tables hold this dump now, and nothing that was there before
+    seen.reset(keys, version)
+    seen.save()
+    singleflight.record(URL, checkpoint.key, etag, version)
+    checkpoint.finish()
+    print("Done!")
+
+
+# Micro-batch rows whose labels had no ID yet, loaded with this dump. They move
+# into the checkpoint, a retry loads the same ones. Only the decoded `columns`,
+# what the micro-batch derived from them is derived again.
+def take_deferred(
+    checkpoint: checkpoints.Checkpoint, columns: list[str]
+) -> pl.DataFrame:
+    if not checkpoint.has("deferred"):
+        paths = stream.deferred()
+        with telemetry.span("deferred", files=len(paths)) as span:
+            frames = [pl.read_parquet(path) for path in paths]
+            rows = pl.concat(frames, how="diagonal_relaxed") if frames else None
+            checkpoint.save("deferred", {} if rows is None else {"events": rows})
+            for path in paths:
+                path.unlink(missing_ok=True)
+            span.record(rows)
+    rows = checkpoint.load("deferred").get("events", pl.DataFrame())
+    return rows.select(name for name in rows.columns if name in columns)
+
+
+# Parse the raw CSV into the encoded fact table, its dimension tables and the
+# column profile of the decoded data
+def transform(
+    response: bytes,
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame], dict[str, profiling.ColumnProfile]]:
+    return build(decode(response))
+
+
+def build(
+    df: pl.DataFrame,
+    published: tuple[dict[str, pl.DataFrame], pl.DataFrame] | None = None,
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame], dict[str, profiling.ColumnProfile]]:
+    # `published` are the dimensions and intersections readers see now, whose
+    # IDs this load keeps
+    dimensions, known = published if published is not None else ({}, None)
+
+    with telemetry.span("geo") as span:
+        df = geo.add_cells(df)
+        span.record(df)
+
+    with telemetry.span("dedup") as span:
+        df, dropped = dedup.deduplicate(df)
+        span.record(df, **dropped)
+
+    with telemetry.span("intersections") as span:
+        intersections = geo.build_intersections(df, known)
+        df = geo.match_intersections(df, intersections)
+        span.record(
+            df,
+            intersections=intersections.height,
+            unmatched=df["interseccion_id"].null_count(),
+        )
+
+    with telemetry.span("profile") as span:
+        profiles = profiling.profile(df)
+        span.record(df)
+
+    with telemetry.span("narrow") as span:
+        # The intersection key keeps the type of interseccion.id
+        df, saved = profiling.narrow(df, profiles, keep=["interseccion_id"])
+        span.record(df, saved_bytes=saved)
+        print(f">> Narrowed numeric columns, {saved / 2**20:.1f}MB saved")
+
+    df, tables = extract_dimensions(df, profiles, dimensions)
+    tables["interseccion"] = intersections
+
+    with telemetry.span("calendar") as span:
+        df = dates.add_keys(df)
+        tables["calendario"] = dates.calendar(df)
+        span.record(tables["calendario"])
+
+    with telemetry.span("hotspots") as span:
+        tables["hotspots"] = geo.hotspots(df)
+        span.record(tables["hotspots"])
+
+    return df, tables, profiles
+
+
+# Parse the raw CSV, decode dates/booleans/enums and normalize column names
+def decode(response: bytes) -> pl.DataFrame:
+    with telemetry.span("parse") as span:
+        df = pl.read_csv(
+            response, infer_schema_length=2 ** (64 - 1), null_values=["NA"]
+        )
+        span.record(df)
+
+    with telemetry.span("decode") as span:
+        decoded = convert(df)
+        span.record(decoded)
+
+    return clean(decoded, df.with_row_index(quality.ROW))
+
+
+# Same as decode() for records that came as JSON instead of CSV
+def decode_records(records: list[dict]) -> pl.DataFrame:
+    with telemetry.span("parse") as span:
+        # Every value as text, as in the CSV, whatever type the JSON gave it
+        columns = dict.fromkeys(name for record in records for name in record)
+        df = pl.from_dicts(
+            records, schema={name: pl.Utf8 for name in columns}, strict=False
+        )
+        span.record(df)
+
+    with telemetry.span("decode") as span:
+        decoded = convert(df)
+        span.record(decoded)
+
+    return clean(decoded, df.with_row_index(quality.ROW))
+
+
+# Same as decode() for a large CSV on disk, maybe compressed, parsed and
+# converted in parallel newline-aligned chunks as they are read. Fields with
+# embedded newlines are not supported.
+PARSE_CHUNK_BYTES = 16 * 2**20
+PARSE_SCHEMA_ROWS = 100_000
+
+
+def csv_chunks(f: IO[bytes], chunk_bytes: int) -> Iterator[bytes]:
+    # Blocks of about `chunk_bytes`, each extended to the end of its last line
+    while block := f.read(chunk_bytes):
+        yield block + f.readline()
+
+
+def decode_file(
+    path: str, workers: int | None = None, chunk_bytes: int = PARSE_CHUNK_BYTES
+) -> pl.DataFrame:
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+    def parse_chunk(
+        header: bytes, data: bytes, schema: pl.Schema
+    ) -> tuple[pl.DataFrame, pl.DataFrame]:
+        try:
+            df = pl.read_csv(data, has_header=False, schema=schema, null_values=["NA"])
+        except pl.exceptions.ComputeError:
+            # A value the first chunk didn't have, like 2.5 in a column of integers
+            # so far: this chunk infers its own types and concat widens them.
+            # Columns it has no values for keep the first chunk's type.
+            df = pl.read_csv(
+                header + data, infer_schema_length=None, null_values=["NA"]
+            )
+            df = df.with_columns(
+                pl.col(name).cast(schema[name])
+                for name in df.columns
+                if df[name].null_count() == df.height
+            )
+        decoded = convert(df)
+        # Only the raw values of rows the gate will quarantine outlive the chunk
+        return df.with_row_index(quality.ROW).filter(quality.failing(decoded)), decoded
+
+    # Polars releases the GIL while parsing. Chunks are read while earlier ones
+    # parse, with a few of them in flight so a compressed source never has to
+    # be held decompressed as a whole.
+    with (
+        download.open_source(Path(path)) as f,
+        telemetry.span("parse") as span,
+        ThreadPoolExecutor(workers) as pool,
+    ):
+        header = f.readline()
+        chunks = csv_chunks(f, chunk_bytes)
+        first = next(chunks, b"")
+        # Chunks are parsed with the schema of the first one, so they concatenate
+        # without casts
+        schema = pl.read_csv(
+            header + first,
+            n_rows=PARSE_SCHEMA_ROWS,
+            infer_schema_length=None,
+            null_values=["NA"],
+        ).schema
+
+        parts: list[tuple[pl.DataFrame, pl.DataFrame]] = []
+        in_flight: list[Future] = []
+        for data in itertools.chain([first], chunks):
+            in_flight.append(pool.submit(parse_chunk, header, data, schema))
+            if len(in_flight) >= 2 * workers:
+                parts.append(in_flight.pop(0).result())
+        parts += [future.result() for future in in_flight]
+
+        # Row numbers restart in every chunk, the gate needs them global
+        offsets = itertools.accumulate((d.height for _, d in parts), initial=0)
+        failed = pl.concat(
+            [
+                raw.with_columns(pl.col(quality.ROW) + offset)
+                for (raw, _), offset in zip(parts, offsets)
+            ],
+            how="vertical_relaxed",
+        )
+        # Chunks are kept as they are, no copy into one contiguous buffer. The
+        # relaxed concat only casts when a chunk had to widen a type.
+        decoded = pl.concat(
+            [decoded for _, decoded in parts], how="vertical_relaxed", rechunk=False
+        )
+        span.record(decoded, chunks=len(parts))
+
+    decoded = decoded.drop(quality.ROW).with_row_index(quality.ROW)
+    return clean(decoded, failed)
+
+
+def convert(df: pl.DataFrame) -> pl.DataFrame:
     DIAS = { "Lunes": 0, "Martes": 1, "Miércoles": 2, "Miercoles": 2, \
                      "Jueves": 3, "Viernes": 4, "Sabado": 5, "Sábado": 5, "Domingo": 6 }  # fmt: skip
     SINO = {"SI": True, "NO": False}
     PRIORIDAD = {"ALTA": 2, "MEDIA": 1, "BAJA": 0}
-
-    df = (
-        pl.read_csv(response, infer_schema_length=2 ** (64 - 1), null_values=["NA"])
-        .lazy()
-        .filter(pl.col("dia").is_in(DIAS.keys()))
+    # What the CSV reader infers for these, unless a value isn't a number
+    NUMERIC = {"latitud": pl.Float64, "longitud": pl.Float64, "zona_vial": pl.Int64,
+               "personas_fallecidas": pl.Int64, "personas_lesionadas": pl.Int64}  # fmt: skip
+
+    # Unknown values become nulls here and are flagged for the quality gate
+    conversions = {
+        name: pl.col(name).str.strip_chars().cast(dtype, strict=False)
+        for name, dtype in NUMERIC.items()
+        if df.schema.get(name) == pl.Utf8
+    }
+    conversions |= {
+        "prioridad": pl.col("prioridad").replace_strict(
+            PRIORIDAD, default=None, return_dtype=pl.UInt8
+        ),
+        "dia": pl.col("dia").replace_strict(DIAS, default=None, return_dtype=pl.UInt8),
+        "fecha_evento": pl.col("fecha_evento").str.strptime(
+            pl.Date, format="%Y-%m-%d", strict=False
+        ),
+        "hora_evento": pl.col("hora_evento").str.strptime(
+            pl.Time, format="%H:%M:%S", strict=False
+        ),
+        "fecha_captura": pl.col("fecha_captura").str.strptime(
+            pl.Date, format="%Y-%m-%d", strict=False
+        ),
+        "trasladado_lesionados": pl.col("trasladado_lesionados").replace_strict(
+            SINO, default=None, return_dtype=pl.Boolean
+        ),
+        "interseccion_semaforizada": pl.col(
+            "interseccion_semaforizada"
+        ).replace_strict(SINO, default=None, return_dtype=pl.Boolean),
+    }
+    return (
+        df.lazy()
+        .with_row_index(quality.ROW)
         .with_columns(
-            pl.col("prioridad").replace_strict(PRIORIDAD).cast(pl.UInt8),
-            pl.col("dia").replace_strict(DIAS).cast(pl.UInt8),
-            pl.col("fecha_evento").str.strptime(
-                pl.Date, format="%Y-%m-%d", strict=False
-            ),
-            pl.col("hora_evento").str.strptime(
-                pl.Time, format="%H:%M:%S", strict=False
-            ),
-            pl.col("fecha_captura").str.strptime(
-                pl.Date, format="%Y-%m-%d", strict=False
-            ),
-            pl.col("trasladado_lesionados").replace_strict(
-                SINO, default=False, return_dtype=pl.Boolean
-            ),
-            pl.col("interseccion_semaforizada").replace_strict(
-                SINO, default=False, return_dtype=pl.Boolean
-            ),
+            *(expr.alias(name) for name, expr in conversions.items()),
+            *(quality.unparsed(name, expr) for name, expr in conversions.items()),
         )
     ).collect()
 
-    for column in df.get_columns():
-        name = column.name
-        ws = ["_de_", "_la_", "_a_"]
-        while sum((1 if w in name else 0 for w in ws)) != 0:
-            for w in ws:
-                name = name.replace(w, "_")
-        df = df.rename({column.name: name})
-
-    table_names = [
-        col.name
-        for col in df.get_columns()
-        if col.n_unique() < 50 and col.name not in ["dia"] and col.dtype == pl.Utf8
+
+# Quality gate and column names, on the whole converted frame. `raw` has the
+# CSV values by ROW, of every row or at least of the failing ones.
+def clean(decoded: pl.DataFrame, raw: pl.DataFrame) -> pl.DataFrame:
+    with telemetry.span("quality") as span:
+        decoded, summary = quality.gate(decoded, raw)
+        del raw
+        df = decoded.with_columns(
+            pl.col("trasladado_lesionados", "interseccion_semaforizada").fill_null(False)
+        )
+        span.record(df, **summary)
+        if summary["quarantined"]:
+            print(f">> Quarantined {summary['quarantined']} rows: {summary}")
+
+    with telemetry.span("rename") as span:
+        for column in df.get_columns():
+            name = column.name
+            ws = ["_de_", "_la_", "_a_"]
+            while sum((1 if w in name else 0 for w in ws)) != 0:
+                for w in ws:
+                    name = name.replace(w, "_")
+            df = df.rename({column.name: name})
+        span.record(df)
+
+    return df
+
+
+# Low-cardinality columns (tipo_evento, alcaldia, ...) become small lookup tables
+def dimension_columns(profiles: dict[str, profiling.ColumnProfile]) -> list[str]:
+    return [
+        p.name
+        for p in profiles.values()
+        if p.n_unique < 50 and p.name not in ["dia"] and p.dtype == pl.Utf8
     ]
-    print(f">> Processing {len(table_names)} columns: {table_names}")
-    print_columns(df[table_names])
-    print("\n")
 
-    tables = {}
-    for name in table_names:
-        df, tables[name] = create_table(df, name)
-
-    tables["dia"] = pl.DataFrame(
-        {
-            "id": [0, 1, 2, 3, 4, 5, 6],
-            "dia": [
-                "Lunes",
-                "Martes",
-                "Miercoles",
-                "Jueves",
-                "Viernes",
-                "Sabado",
-                "Domingo",
-            ],
-        }
-    ).with_columns(pl.col("id").cast(pl.UInt8))
-
-    tables["prioridad"] = pl.DataFrame(
-        {
-            "id": [0, 1, 2],
-            "prioridad": ["BAJA", "MEDIA", "ALTA"],
-        }
-    ).with_columns(pl.col("id").cast(pl.UInt8))
-
-    print(">> Result:")
-    print_columns(df[table_names])
-    print("\n")
-
-    client = bigquery.Client()
-    create_dataset(client, "traffic_data")
-
-    # Upload tables
-    df_to_bigquery(
-        df,
-        client.project,
-        "traffic_data",
-        "events",
-        clustered_by=["fecha_evento", "alcaldia", "tipo_evento", "sector"],
-    )
-    for name, df in tables.items():
-        df_to_bigquery(df, client.project, "traffic_data", name)
 
-    print("Done!")
+# String columns that repeat enough to be worth a dictionary (colonia, sector,
+# punto_1, ...). Near-unique columns like folio would only duplicate themselves.
+DICTIONARY_MAX_RATIO = 0.5
+
+
+def dictionary_columns(
+    profiles: dict[str, profiling.ColumnProfile], rows: int
+) -> list[str]:
+    return [
+        p.name
+        for p in profiles.values()
+        if p.dtype == pl.Utf8
+        and p.n_unique >= 50
+        and p.n_unique <= rows * DICTIONARY_MAX_RATIO
+    ]
+
+
+def extract_dimensions(
+    df: pl.DataFrame,
+    profiles: dict[str, profiling.ColumnProfile],
+    previous: dict[str, pl.DataFrame] | None = None,
+) -> tuple[pl.DataFrame, dict[str, pl.DataFrame]]:
+    with telemetry.span("dimensions") as span:
+        table_names = dimension_columns(profiles)
+        print(f">> Processing {len(table_names)} columns: {table_names}")
+        print_columns([profiles[name] for name in table_names])
+        print("\n")
+
+        dictionary_names = dictionary_columns(profiles, df.height)
+        print(f">> Dictionary encoding {len(dictionary_names)} columns: {dictionary_names}")
+        print_columns([profiles[name] for name in dictionary_names])
+        print("\n")
+
+        df, tables = create_tables(df, table_names + dictionary_names, previous)
+
+        tables["dia"] = pl.DataFrame(
+            {
+                "id": [0, 1, 2, 3, 4, 5, 6],
+                "dia": [
+                    "Lunes",
+                    "Martes",
+                    "Miercoles",
+                    "Jueves",
+                    "Viernes",
+                    "Sabado",
+                    "Domingo",
+                ],
+            }
+        ).with_columns(pl.col("id").cast(pl.UInt8))
+
+        tables["prioridad"] = pl.DataFrame(
+            {
+                "id": [0, 1, 2],
+                "prioridad": ["BAJA", "MEDIA", "ALTA"],
+            }
+        ).with_columns(pl.col("id").cast(pl.UInt8))
+
+        print(">> Result:")
+        for name in table_names + dictionary_names:
+            print(
+                f"Encoded col {name}: ids 0..{tables[name].height - 1} "
+                f"({df.schema[name]})"
+            )
+        print("\n")
+        span.record(df, tables=len(tables))
+
+    return df, tables
+
+
+def upload(
+    df: pl.DataFrame,
+    tables: dict[str, pl.DataFrame],
+    profiles: dict[str, profiling.ColumnProfile] | None = None,
+    checkpoint: checkpoints.Checkpoint | None = None,
+) -> str:
+    # Returns the version that was published
+    version = checkpoint.version if checkpoint is not None else table_version()
+    sink = get_sink()
+    if isinstance(sink, stream.LocalSink):
+        with telemetry.span("upload", sink=str(sink.root), version=version):
+            sink.replace(df, tables, version)
+        return version
+
+    # Tables loaded by an earlier attempt of this checkpoint are kept as they are
+    uploaded = checkpoint.uploaded if checkpoint is not None else set()
+
+    with telemetry.span("upload", version=version):
+        client = get_client()
+        create_dataset(client, "traffic_data")
+
+        # Upload tables
+        jobs = {}
+        if "events" not in uploaded:
+            with telemetry.span("upload_table", table="events") as span:
+                span.record(df)
+                jobs["events"] = df_to_bigquery(
+                    df,
+                    client.project,
+                    "traffic_data",
+                    versioned("events", version),
+                    clustered_by=[
+                        "fecha_evento",
+                        "alcaldia",
+                        "tipo_evento",
+                        "geohash_6",
+                    ],
+                    profiles=profiles,
+                )
+        for name, table in tables.items():
+            if name in uploaded:
+                continue
+            with telemetry.span("upload_table", table=name) as span:
+                span.record(table)
+                jobs[name] = df_to_bigquery(
+                    table, client.project, "traffic_data", versioned(name, version)
+                )
+
+        # The load jobs run concurrently, a table only counts once its job is done
+        with telemetry.span("wait", tables=len(jobs)):
+            for name, job in jobs.items():
+                job.result()
+                if checkpoint is not None:
+                    checkpoint.mark_uploaded(name)
+
+        with telemetry.span("publish"):
+            publish(client, "traffic_data", ["events", *tables], version)
+            prune(client, "traffic_data", version)
+    return version
+
+
+_MODULE_INIT = time.perf_counter() - _MODULE_START
@@ -0,0 +1,129 @@
+# %%
+from dataclasses import dataclass, field
+from typing import Any, Collection
+
+import polars as pl
+
+# Number of most frequent values kept per column
+TOP_K = 10
+# Columns with more distinct values than this don't get a top-k
+TOP_K_MAX_UNIQUE = 250
+
+# Narrowest integer types first, unsigned ones only for non-negative columns
+INT_RANGES = [
+    (pl.UInt8, 0, 2**8 - 1),
+    (pl.Int8, -(2**7), 2**7 - 1),
+    (pl.UInt16, 0, 2**16 - 1),
+    (pl.Int16, -(2**15), 2**15 - 1),
+    (pl.UInt32, 0, 2**32 - 1),
+    (pl.Int32, -(2**31), 2**31 - 1),
+]
+# Float columns that may be stored as Float32, with the largest error they
+# tolerate: ~1m for coordinates
+FLOAT32_TOLERANCE = {"latitud": 1e-5, "longitud": 1e-5}
+
+
+@dataclass
+class ColumnProfile:
+    name: str
+    dtype: pl.DataType
+    n_unique: int
+    null_count: int
+    min: Any = None
+    max: Any = None
+    top: list[tuple[Any, int]] = field(default_factory=list)
+
+    @property
+    def nullable(self) -> bool:
+        return self.null_count > 0
+
+
+def profile(
+    df: pl.DataFrame, top_k: int = TOP_K, approx: bool = False
+) -> dict[str, ColumnProfile]:
+    # All per-column statistics are computed in a single query, so Polars scans
+    # each column once (columns in parallel) instead of once per statistic
+    exprs = []
+    for name, dtype in df.schema.items():
+        col = pl.col(name)
+        # HyperLogLog only hashes primitive values, dates and times use their integers
+        n_unique = col.to_physical().approx_n_unique() if approx else col.n_unique()
+        exprs += [
+            n_unique.alias(f"{name}:n_unique"),
+            col.null_count().alias(f"{name}:null_count"),
+        ]
+        # Ranges are only needed for numbers and dates, string comparisons are slow
+        if dtype != pl.Utf8:
+            exprs += [col.min().alias(f"{name}:min"), col.max().alias(f"{name}:max")]
+    stats = df.lazy().select(exprs).collect().row(0, named=True)
+
+    profiles = {
+        name: ColumnProfile(
+            name=name,
+            dtype=dtype,
+            n_unique=stats[f"{name}:n_unique"],
+            null_count=stats[f"{name}:null_count"],
+            min=stats.get(f"{name}:min"),
+            max=stats.get(f"{name}:max"),
+        )
+        for name, dtype in df.schema.items()
+    }
+
+    # Value counts are only worth it for low-cardinality columns, where they are cheap
+    small = [p.name for p in profiles.values() if p.n_unique <= TOP_K_MAX_UNIQUE]
+    if small:
+        exprs = []
+        for name in small:
+            counts = pl.col(name).drop_nulls().value_counts(name="count")
+            exprs.append(counts.top_k_by(counts.struct.field("count"), top_k).implode())
+        tops = df.lazy().select(exprs).collect().row(0, named=True)
+        for name in small:
+            profiles[name].top = [(v[name], v["count"]) for v in tops[name]]
+
+    return profiles
+
+
+def int_dtype(lo: int, hi: int) -> pl.DataType | None:
+    for dtype, min_value, max_value in INT_RANGES:
+        if lo >= min_value and hi <= max_value:
+            return dtype
+    return None
+
+
+def narrow(
+    df: pl.DataFrame,
+    profiles: dict[str, ColumnProfile],
+    keep: Collection[str] = (),
+) -> tuple[pl.DataFrame, int]:
+    # Narrowest type that holds every value of each numeric column, from the
+    # profile's ranges. Returns the frame and the bytes saved. Columns in `keep`
+    # (keys into other tables) keep the type of what they refer to.
+    casts = {}
+    for name, p in profiles.items():
+        if name in keep:
+            continue
+        if p.dtype.is_integer() and p.min is not None:
+            dtype = int_dtype(p.min, p.max)
+            if dtype is not None and dtype != p.dtype:
+                casts[name] = dtype
+
+    # Floats are only narrowed when the rounding error stays within tolerance
+    floats = [
+        name
+        for name in FLOAT32_TOLERANCE
+        if name in df.columns and df.schema[name] == pl.Float64 and name not in keep
+    ]
+    if floats:
+        errors = df.select(
+            (pl.col(name) - pl.col(name).cast(pl.Float32).cast(pl.Float64)).abs().max()
+            for name in floats
+        ).row(0, named=True)
+        for name in floats:
+            if errors[name] is None or errors[name] <= FLOAT32_TOLERANCE[name]:
+                casts[name] = pl.Float32
+
+    before = df.select(list(casts)).estimated_size()
+    df = df.cast(casts)
+    for name, dtype in casts.items():
+        profiles[name].dtype = dtype
+    return df, int(before - df.select(list(casts)).estimated_size())
@@ -0,0 +1,103 @@
+# %%
+# Validation of decoded incidents before they are loaded.
+#
+# Rules are Polars expressions that are true for a failing row. They are all
+# evaluated in one pass over the decoded frame together with the parse failures
+# flagged while decoding, and only the (few) failing rows are materialized with
+# their reasons. Those rows go to a quarantine Parquet file, with their values
+# as they appeared in the CSV, instead of being loaded.
+import datetime
+import os
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import polars as pl
+
+import files
+
+QUARANTINE_DIR = Path(
+    os.environ.get("QUARANTINE_DIR", Path(tempfile.gettempdir()) / "quarantine")
+)
+
+# Row number in the CSV, used to recover the raw values of failing rows
+ROW = "__row"
+UNPARSED = "__unparsed_"
+
+# CDMX with some margin
+MIN_LAT, MAX_LAT = 19.0, 19.65
+MIN_LON, MAX_LON = -99.4, -98.9
+MIN_DATE = datetime.date(2014, 1, 1)
+
+
+def rules() -> dict[str, pl.Expr]:
+    lat, lon = pl.col("latitud"), pl.col("longitud")
+    return {
+        "coordenadas_fuera_de_cdmx": ~(
+            lat.is_between(MIN_LAT, MAX_LAT) & lon.is_between(MIN_LON, MAX_LON)
+        ),
+        "conteo_negativo": (pl.col("personas_fallecidas") < 0)
+        | (pl.col("personas_lesionadas") < 0),
+        "fecha_fuera_de_rango": ~pl.col("fecha_evento").is_between(
+            MIN_DATE, datetime.date.today()
+        ),
+    }
+
+
+def unparsed(name: str, converted: pl.Expr) -> pl.Expr:
+    # A value that was there in the CSV but didn't convert. Meant to sit in the
+    # same context as `converted`, where pl.col(name) is still the raw column.
+    return (converted.is_null() & pl.col(name).is_not_null()).alias(
+        f"{UNPARSED}{name}"
+    )
+
+
+def checks(df: pl.DataFrame) -> dict[str, pl.Expr]:
+    # Every reason a decoded row can fail for, true where it does
+    flags = [c for c in df.columns if c.startswith(UNPARSED)]
+    found = {f"{c.removeprefix(UNPARSED)}_invalido": pl.col(c) for c in flags}
+    # Missing values are not failures, only values that are there and wrong
+    return found | {reason: check.fill_null(False) for reason, check in rules().items()}
+
+
+def failing(df: pl.DataFrame) -> pl.Series:
+    return df.select(pl.any_horizontal(checks(df).values())).to_series()
+
+
+def gate(
+    df: pl.DataFrame, raw: pl.DataFrame, path: Path = QUARANTINE_DIR
+) -> tuple[pl.DataFrame, dict[str, int]]:
+    # `raw` holds the rows as they were in the CSV with their ROW, at least the
+    # failing ones: decoders that go by chunks keep only those
+    flags = [c for c in df.columns if c.startswith(UNPARSED)]
+    found = checks(df)
+    failed = df.select(pl.any_horizontal(found.values())).to_series()
+    bad = df.filter(failed).select(
+        ROW, *(check.alias(reason) for reason, check in found.items())
+    )
+    df = df.filter(~failed).drop(ROW, *flags)
+
+    summary = {"rows": df.height + bad.height, "quarantined": bad.height}
+    if bad.height:
+        counts = bad.select(pl.col(list(found)).sum()).row(0, named=True)
+        summary |= {reason: count for reason, count in counts.items() if count}
+
+        reasons = bad.select(
+            ROW,
+            pl.concat_list(
+                pl.when(pl.col(reason)).then(pl.lit(reason)) for reason in found
+            )
+            .list.drop_nulls()
+            .alias("motivos"),
+        )
+        quarantine(raw.join(reasons, on=ROW).drop(ROW), path)
+    return df, summary
+
+
+def quarantine(rows: pl.DataFrame, path: Path = QUARANTINE_DIR):
+    # Rows with the `motivos` they failed for, to a file of their own
+    # Gates of concurrent invocations finish within the same second
+    stamp = time.strftime("%Y%m%dT%H%M%S")
+    name = f"cuarentena-{stamp}-{uuid.uuid4().hex[:8]}.parquet"
+    files.atomic_write(path / name, rows.write_parquet)
@@ -0,0 +1,243 @@
+# %%
+# One ingest at a time into the dataset, shared by duplicate deliveries.
+#
+# A run holds the lease of the dataset: a load keeps the dimension IDs readers
+# see and appends new ones after them, so two loads at once, even of different
+# URLs, would hand out the same IDs. Events that find the lease held wait for it
+# to be released and reuse the outcome of a run of their URL that succeeded
+# meanwhile.
+# The lease outlives the function timeout, so the lease of a run that was killed
+# is taken over once it expires. Deployed instances share leases as objects in
+# LEASE_BUCKET, created and deleted with generation preconditions, so the bucket
+# decides which of several instances gets one. Without it leases are files under
+# LEASE_DIR guarded by an flock, which only excludes processes of one host.
+#
+# Every successful run leaves a record of the content it loaded (SHA-256 and
+# ETag) and the version of the tables it published, so a later event for
+# unchanged content can stop before parsing, or even before downloading, while
+# that version is still the one readers see.
+import datetime
+import fcntl
+import json
+import os
+import tempfile
+import time
+import urllib.parse
+import uuid
+from pathlib import Path
+from typing import Any, Callable
+
+import checkpoints
+import files
+import telemetry
+
+LEASE_DIR = Path(os.environ.get("LEASE_DIR", Path(tempfile.gettempdir()) / "leases"))
+LEASE_BUCKET = os.environ.get("LEASE_BUCKET")
+# Longer than the function timeout: a holder can't still be running after it
+LEASE_TTL_S = float(os.environ.get("LEASE_TTL_S", 600))
+POLL_S = 1.0
+# Key of the one lease every load takes
+DATASET_LEASE = "dataset"
+STORAGE_API = "https://storage.googleapis.com/storage/v1/b"
+STORAGE_UPLOAD = "https://storage.googleapis.com/upload/storage/v1/b"
+
+
+class FileLease:
+    def __init__(self, key: str, root: Path = LEASE_DIR, ttl_s: float = LEASE_TTL_S):
+        self.path = root / f"{key}.lease"
+        self.ttl_s = ttl_s
+        self.owner = uuid.uuid4().hex
+
+    def expired(self) -> bool:
+        try:
+            return self.path.stat().st_mtime + self.ttl_s < time.time()
+        except FileNotFoundError:
+            return True
+
+    def guard(self):
+        # Checking a lease and taking it happen under this lock, or two waiters
+        # could both find it expired and both take it
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path.parent / ".lock", "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def acquire(self) -> bool:
+        with self.guard():
+            if not self.expired():
+                return False
+            self.path.write_text(self.owner)
+            return True
+
+    def release(self):
+        # Never drop a lease that expired and was taken over by another run
+        with self.guard():
+            try:
+                if self.path.read_text() == self.owner:
+                    self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def wait(self, poll_s: float = POLL_S):
+        while not self.expired():
+            time.sleep(poll_s)
+
+
+_session = None
+
+
+def storage_session():
+    global _session
+    if _session is None:
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+
+        credentials, _ = google.auth.default(
+            scopes=["https://www.googleapis.com/auth/devstorage.read_write"]
+        )
+        _session = AuthorizedSession(credentials)
+    return _session
+
+
+class GcsLease:
+    # An object in `bucket`, through the Cloud Storage JSON API. Creating it
+    # requires that no generation exists (ifGenerationMatch=0), and an expired
+    # one is only deleted as the generation that was seen expired, so of several
+    # waiters exactly one takes it over.
+    def __init__(
+        self,
+        key: str,
+        bucket: str,
+        ttl_s: float = LEASE_TTL_S,
+        session: Any = None,
+    ):
+        self.name = f"leases/{key}.lease"
+        self.bucket = bucket
+        self.ttl_s = ttl_s
+        self.session = session if session is not None else storage_session()
+        self.generation: str | None = None
+
+    @property
+    def url(self) -> str:
+        name = urllib.parse.quote(self.name, safe="")
+        return f"{STORAGE_API}/{self.bucket}/o/{name}"
+
+    def stat(self) -> dict[str, Any] | None:
+        response = self.session.get(self.url)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def expired(self, meta: dict[str, Any]) -> bool:
+        created = datetime.datetime.fromisoformat(
+            meta["timeCreated"].replace("Z", "+00:00")
+        )
+        return created.timestamp() + self.ttl_s < time.time()
+
+    def acquire(self) -> bool:
+        meta = self.stat()
+        if meta is not None:
+            if not self.expired(meta):
+                return False
+            # 412 or 404 when another waiter got there first, its create wins
+            self.session.delete(
+                self.url, params={"ifGenerationMatch": meta["generation"]}
+            )
+        response = self.session.post(
+            f"{STORAGE_UPLOAD}/{self.bucket}/o",
+            params={"uploadType": "media", "name": self.name, "ifGenerationMatch": 0},
+            data=uuid.uuid4().hex.encode(),
+            headers={"Content-Type": "text/plain"},
+        )
+        if response.status_code == 412:
+            return False
+        response.raise_for_status()
+        self.generation = response.json()["generation"]
+        return True
+
+    def release(self):
+        # Only the generation this run created, never one that took over after it
+        if self.generation is None:
+            return
+        response = self.session.delete(
+            self.url, params={"ifGenerationMatch": self.generation}
+        )
+        self.generation = None
+        if response.status_code not in (204, 404, 412):
+            response.raise_for_status()
+
+    def wait(self, poll_s: float = POLL_S):
+        while (meta := self.stat()) is not None and not self.expired(meta):
+            time.sleep(poll_s)
+
+
+def lease(key: str, root: Path = LEASE_DIR) -> FileLease | GcsLease:
+    if LEASE_BUCKET:
+        return GcsLease(key, LEASE_BUCKET)
+    if checkpoints.DEPLOYED:
+        telemetry.warn(
+            "LEASE_BUCKET is not set, leases only exclude runs on the same instance",
+            lease_dir=str(root),
+        )
+    return FileLease(key, root)
+
+
+def record_path(url: str, root: Path = LEASE_DIR) -> Path:
+    return root / "loaded" / f"{checkpoints.url_key(url)}.json"
+
+
+def last(
+    url: str, published: str | None, root: Path = LEASE_DIR
+) -> dict[str, Any] | None:
+    # Content of the last successful run for the URL, as long as the version it
+    # published is still the `published` one: a load of another URL since then
+    # replaced what it loaded
+    try:
+        done = json.loads(record_path(url, root).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return done if done.get("version") == published else None
+
+
+def record(
+    url: str,
+    sha256: str,
+    etag: str | None,
+    version: str | None,
+    root: Path = LEASE_DIR,
+):
+    done = {
+        "url": url,
+        "sha256": sha256,
+        "etag": etag,
+        "version": version,
+        "finished": time.time(),
+    }
+    text = json.dumps(done)
+    files.atomic_write(record_path(url, root), lambda f: f.write_text(text))
+
+
+def run(
+    url: str,
+    fn: Callable[[], Any],
+    published: Callable[[], str | None],
+    root: Path = LEASE_DIR,
+) -> bool:
+    # Runs fn under the dataset's lease, or reuses a run of the URL that was in
+    # flight. False when the event was coalesced into another run. `published`
+    # tells the version of the tables readers see now.
+    arrived = time.time()
+    held = lease(DATASET_LEASE, root)
+    while not held.acquire():
+        print(f">> Another ingest is running, {url} waits for it")
+        held.wait()
+        done = last(url, published(), root)
+        if done is not None and done["finished"] >= arrived:
+            return False
+        # It failed, was killed or was replaced since, this event runs it again
+    try:
+        fn()
+    finally:
+        held.release()
+    return True
@@ -0,0 +1,413 @@
+# %%
+# Micro-batch appends of incidents between full dumps.
+#
+# Batches arrive as small lists of records and are encoded with the dimension
+# tables of the last full ingest, so they land in the same fact table with the
+# same IDs. Concurrent invocations of a warm instance hand their rows to one
+# Batcher, which coalesces them into a single write once enough rows are waiting
+# or the oldest has waited long enough; every invocation returns only after the
+# write holding its rows is committed. Labels the dimensions don't know yet have
+# no ID: their rows are deferred to DEFERRED_DIR, and the next full ingest loads
+# them with the dump and gives the labels their IDs.
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Mapping
+
+import numpy as np
+import polars as pl
+
+import dedup
+import files
+import geo
+import quality
+import telemetry
+
+STREAM_MAX_ROWS = int(os.environ.get("STREAM_MAX_ROWS", 5000))
+STREAM_MAX_WAIT_S = float(os.environ.get("STREAM_MAX_WAIT_S", 0.5))
+# Loads and appends go to local Parquet files instead of BigQuery when set
+SINK_DIR = os.environ.get("SINK_DIR")
+DEFERRED_DIR = Path(
+    os.environ.get("DEFERRED_DIR", Path(tempfile.gettempdir()) / "deferred")
+)
+
+KEY = "__key"
+
+# Tables of the dataset that aren't dictionaries of an events column
+NOT_DIMENSIONS = {"events", "interseccion", "hotspots", "anomalias", "calendario"}
+
+# Column types of the loaded tables (see main.upload_table), as Polars reads them
+BIGQUERY_DTYPES: dict[str, type[pl.DataType]] = {
+    "INTEGER": pl.Int64,
+    "FLOAT": pl.Float64,
+    "BOOLEAN": pl.Boolean,
+    "DATE": pl.Date,
+    "TIME": pl.Time,
+    "STRING": pl.Utf8,
+}
+
+
+def labels(df: pl.DataFrame, dimensions: dict[str, pl.DataFrame]) -> list[str]:
+    # Columns of `df` that hold labels of a dimension, not its IDs yet
+    return [
+        name
+        for name in dimensions
+        if name in df.columns and df.schema[name] in (pl.Utf8, pl.Null)
+    ]
+
+
+def encode(df: pl.DataFrame, dimensions: dict[str, pl.DataFrame]) -> pl.DataFrame:
+    # Labels to IDs through the existing tables
+    return df.with_columns(
+        pl.col(name).replace_strict(
+            dimensions[name][name], dimensions[name]["id"], default=None
+        )
+        for name in labels(df, dimensions)
+    )
+
+
+def prepare(
+    df: pl.DataFrame,
+    dimensions: dict[str, pl.DataFrame],
+    intersections: pl.DataFrame,
+    seen: dedup.SeenIndex,
+) -> tuple[pl.DataFrame, pl.DataFrame, dict[str, int]]:
+    # Decoded rows with their cells to the encoded rows never loaded before, and
+    # the rows with a label the dimensions don't have, as they came
+    rows = df.height
+    df, dropped = dedup.deduplicate(df)
+
+    # Rows without a key can't be told apart, they are always appended
+    df = df.with_columns(dedup.incident_key().alias(KEY))
+    unseen = pl.Series(~seen.contains(df[KEY].fill_null(0).to_numpy()))
+    df = df.filter(pl.col(KEY).is_null() | unseen)
+    seen_rows = rows - sum(dropped.values()) - df.height
+
+    known = pl.all_horizontal(
+        pl.lit(True),
+        *(
+            pl.col(name).is_null() | pl.col(name).is_in(dimensions[name][name])
+            for name in labels(df, dimensions)
+        ),
+    )
+    deferred = df.filter(~known)
+    df = df.filter(known)
+    summary = {"rows": rows, **dropped, "seen": seen_rows, "deferred": deferred.height}
+
+    if df.height and intersections.height:
+        df = geo.match_intersections(df, intersections)
+    df = encode(df, dimensions)
+
+    # Deferred rows stay unseen, they aren't in the tables until a full ingest
+    seen.add(df[KEY].drop_nulls().to_numpy())
+    return df.drop(KEY), deferred.drop(KEY), summary
+
+
+def defer(df: pl.DataFrame, path: Path = DEFERRED_DIR):
+    name = f"diferidos-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+    files.atomic_write(path / name, df.write_parquet)
+
+
+def deferred(path: Path = DEFERRED_DIR) -> list[Path]:
+    # Rows waiting for a full ingest, oldest first
+    return sorted(path.glob("diferidos-*.parquet"))
+
+
+def conform(
+    df: pl.DataFrame,
+    schema: Mapping[str, type[pl.DataType] | pl.DataType],
+    required: set[str] = set(),
+) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # Rows cast to the columns of the table they go to, and the rows that can't
+    # be with their `motivos`: a value that doesn't convert to the column's type,
+    # or none for a column that requires one
+    casts = {
+        name: pl.col(name).cast(dtype, strict=False)
+        if name in df.columns
+        else pl.lit(None, dtype)
+        for name, dtype in schema.items()
+    }
+    checks = {
+        f"{name}_invalido": quality.unparsed(name, expr)
+        for name, expr in casts.items()
+        if name in df.columns
+    }
+    checks |= {f"{name}_requerido": casts[name].is_null() for name in required}
+    extra = [name for name in df.columns if name not in schema]
+    if extra:
+        telemetry.warn("Columns the table doesn't have are dropped", columns=extra)
+
+    converted = df.select(
+        *(expr.alias(name) for name, expr in casts.items()),
+        *(check.alias(reason) for reason, check in checks.items()),
+    )
+    failed = converted.select(pl.any_horizontal(pl.lit(False), *checks)).to_series()
+    rejected = pl.concat(
+        [df, converted.select(list(checks))], how="horizontal"
+    ).filter(failed)
+    if checks:
+        rejected = rejected.select(
+            *df.columns,
+            pl.concat_list(
+                pl.when(pl.col(reason)).then(pl.lit(reason)) for reason in checks
+            )
+            .list.drop_nulls()
+            .alias("motivos"),
+        )
+    return converted.filter(~failed).select(list(schema)), rejected
+
+
+class LocalSink:
+    # Dimensions as <name>.parquet files in `root`, every write one more file in
+    # root/events, renamed into place once complete. A full load replaces both,
+    # and the version in root/version last.
+    def __init__(self, root: Path):
+        self.root = root
+        self.version: str | None = None
+        (root / "events").mkdir(parents=True, exist_ok=True)
+
+    def publish(self, tables: dict[str, pl.DataFrame]):
+        for name, table in tables.items():
+            files.atomic_write(self.root / f"{name}.parquet", table.write_parquet)
+
+    def replace(
+        self, df: pl.DataFrame, tables: dict[str, pl.DataFrame], version: str
+    ):
+        for part in (self.root / "events").glob("*.parquet"):
+            part.unlink()
+        self.publish(tables)
+        self.write(df)
+        files.atomic_write(self.root / "version", lambda f: f.write_text(version))
+
+    def published(self) -> str | None:
+        # Version of the last full load, None before any
+        version = self.root / "version"
+        return version.read_text() if version.exists() else None
+
+    def dimensions(self) -> tuple[dict[str, pl.DataFrame], pl.DataFrame]:
+        # Also refreshes `version`, the one these tables are from
+        self.version = self.published()
+        tables = {
+            file.stem: pl.read_parquet(file) for file in self.root.glob("*.parquet")
+        }
+        intersections = tables.pop("interseccion", pl.DataFrame({"id": []}))
+        return {
+            name: table for name, table in tables.items() if name not in NOT_DIMENSIONS
+        }, intersections
+
+    def write(self, df: pl.DataFrame) -> int:
+        # Appends take the types of the parts already there, the rows that don't
+        # fit them are quarantined. Returns how many.
+        part = next((self.root / "events").glob("*.parquet"), None)
+        rejected = 0
+        if part is not None:
+            df, bad = conform(df, pl.read_parquet_schema(part))
+            if bad.height:
+                quality.quarantine(bad)
+            rejected = bad.height
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        files.atomic_write(self.root / "events" / name, df.write_parquet)
+        return rejected
+
+
+def version_of(table: str | None) -> str | None:
+    if table is None:
+        return None
+    return table.rsplit(".", 1)[-1].partition("__v")[2] or None
+
+
+class BigQuerySink:
+    # Streaming inserts into the table the events view currently points at.
+    # Dimensions are read from the tables of that same version, and reloaded
+    # whenever a full ingest publishes a new one. Rows appended to a version are
+    # replaced with the next one, by then they are part of the dump.
+    def __init__(self, client, dataset: str = "traffic_data"):
+        self.client = client
+        self.dataset = f"{client.project}.{dataset}"
+        self.table: str | None = None
+        self.schema: list = []
+        self.cached: tuple[dict[str, pl.DataFrame], pl.DataFrame] | None = None
+
+    @property
+    def version(self) -> str | None:
+        # Of the table dimensions() last found the events view on, None for
+        # tables from before versioning
+        return version_of(self.table)
+
+    def published(self) -> str | None:
+        # Version the events view is on right now
+        return version_of(self.current())
+
+    def current(self) -> str | None:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            view = self.client.get_table(f"{self.dataset}.events")
+        except NotFound:
+            # Nothing was loaded yet
+            return None
+        if view.table_type != "VIEW":
+            return f"{self.dataset}.events"
+        target = re.search(r"FROM `([^`]+)`", view.view_query or "")
+        if target is None:
+            raise RuntimeError(f"Can't tell which table {self.dataset}.events reads")
+        return target.group(1)
+
+    def select(self, table: str) -> pl.DataFrame:
+        rows = self.client.query(f"SELECT * FROM `{table}` ORDER BY id").result()
+        return pl.DataFrame(pl.from_arrow(rows.to_arrow()))
+
+    def dimensions(self) -> tuple[dict[str, pl.DataFrame], pl.DataFrame]:
+        table = self.current()
+        if table is None:
+            self.table = self.cached = None
+            return {}, pl.DataFrame({"id": []})
+        if self.cached is None or table != self.table:
+            # Tables of a version share its suffix (events__v<version>, ...), the
+            # views of the dimensions may already be on another one
+            suffix = table.rsplit(".", 1)[-1].removeprefix("events")
+            self.schema = self.client.get_table(table).schema
+            columns = {f.name for f in self.schema}
+            tables = {t.table_id for t in self.client.list_tables(self.dataset)}
+
+            def find(name: str) -> str | None:
+                # Tables loaded before versioning have no suffix. Without either,
+                # rows with labels of the dimension are deferred to the next load.
+                found = [t for t in [f"{name}{suffix}", name] if t in tables]
+                return f"{self.dataset}.{found[0]}" if found else None
+
+            found = {name: find(name) for name in columns - NOT_DIMENSIONS}
+            intersections = find("interseccion")
+            self.cached = (
+                {name: self.select(t) for name, t in found.items() if t is not None},
+                self.select(intersections)
+                if intersections is not None
+                else pl.DataFrame({"id": []}),
+            )
+            self.table = table
+        return self.cached
+
+    def write(self, df: pl.DataFrame) -> int:
+        # Rows are cast to the schema of the events table and checked against
+        # it first, those that still fail the insert are skipped by BigQuery.
+        # Both are quarantined, returns how many.
+        df, bad = conform(
+            df,
+            {f.name: BIGQUERY_DTYPES.get(f.field_type, pl.Utf8) for f in self.schema},
+            {f.name for f in self.schema if f.mode == "REQUIRED"},
+        )
+        rows = df.with_columns(
+            pl.col(pl.Date, pl.Time, pl.Datetime).cast(pl.Utf8)
+        ).to_dicts()
+        errors = self.client.insert_rows_json(self.table, rows, skip_invalid_rows=True)
+        invalid = {
+            error["index"]: [e.get("message", e["reason"]) for e in error["errors"]]
+            for error in errors
+            if all(e["reason"] == "invalid" for e in error["errors"])
+        }
+        if len(invalid) < len(errors):
+            message = f"Streaming insert into {self.table} failed: {errors[:3]}"
+            raise RuntimeError(message)
+        if invalid:
+            failed = df[sorted(invalid)].with_columns(
+                pl.Series("motivos", [invalid[i] for i in sorted(invalid)])
+            )
+            bad = pl.concat([bad, failed], how="diagonal_relaxed")
+        if bad.height:
+            quality.quarantine(bad)
+        return bad.height
+
+
+@dataclass
+class Pending:
+    # Rows waiting for the same write, and how that write went
+    frames: list[pl.DataFrame] = field(default_factory=list)
+    rows: int = 0
+    opened: float = field(default_factory=time.monotonic)
+    done: bool = False
+    error: Exception | None = None
+
+
+class Batcher:
+    def __init__(
+        self,
+        sink: LocalSink | BigQuerySink,
+        seen: dedup.SeenIndex,
+        max_rows: int = STREAM_MAX_ROWS,
+        max_wait_s: float = STREAM_MAX_WAIT_S,
+    ):
+        self.sink = sink
+        self.seen = seen
+        self.max_rows = max_rows
+        self.max_wait_s = max_wait_s
+        self.cond = threading.Condition()
+        self.writing = threading.Lock()
+        self.pending: Pending | None = None
+
+    def submit(self, df: pl.DataFrame):
+        # Blocks until the write that includes `df` is committed, or raises its error
+        with self.cond:
+            if self.pending is None:
+                self.pending = Pending()
+            batch = self.pending
+            batch.frames.append(df)
+            batch.rows += df.height
+
+            writer = False
+            while batch is self.pending:
+                remaining = batch.opened + self.max_wait_s - time.monotonic()
+                if batch.rows >= self.max_rows or remaining <= 0:
+                    # This submitter writes the batch, later ones open the next
+                    self.pending = None
+                    writer = True
+                else:
+                    self.cond.wait(remaining)
+
+        if writer:
+            self.flush(batch)
+        else:
+            with self.cond:
+                while not batch.done:
+                    self.cond.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+    def flush(self, batch: Pending):
+        # Without the condition's lock, so submitters keep filling the next
+        # batch meanwhile; writes still go one at a time, in order
+        with self.writing:
+            try:
+                with telemetry.span("flush", batches=len(batch.frames)) as span:
+                    df = pl.concat(batch.frames, how="diagonal_relaxed")
+                    dimensions, intersections = self.sink.dimensions()
+                    if not self.seen.describes(self.sink.version):
+                        # A full load published another version: its index if it
+                        # was loaded here, else nothing is known of that version
+                        self.seen = dedup.SeenIndex(self.seen.path)
+                        if not self.seen.describes(self.sink.version):
+                            self.seen.reset(np.empty(0, np.uint64), self.sink.version)
+                    df, waiting, summary = prepare(
+                        df, dimensions, intersections, self.seen
+                    )
+                    if df.height:
+                        summary["rejected"] = self.sink.write(df)
+                    if waiting.height:
+                        defer(waiting)
+                    # Unless a full load replaced the version meanwhile, its
+                    # index is the one to keep
+                    if self.seen.describes(self.sink.published()):
+                        self.seen.save()
+                    span.record(df, **summary)
+            except Exception as e:
+                batch.error = e
+                # The rows weren't written, a redelivery has to find them unseen
+                self.seen = dedup.SeenIndex(self.seen.path)
+        with self.cond:
+            batch.done = True
+            self.cond.notify_all()
@@ -0,0 +1,150 @@
+# %%
+import json
+import os
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import polars as pl
+
+# Append every finished trace as JSON lines to this file when set
+TRACE_FILE = os.environ.get("TRACE_FILE")
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start: float
+    wall_s: float = 0.0
+    rows: int | None = None
+    nbytes: int | None = None
+    # Resident memory the stage left behind, and the process high-water mark
+    # when it ended (since the instance started, not of the stage alone)
+    rss_delta_mb: float | None = None
+    process_peak_rss_mb: float = 0.0
+    attrs: dict[str, Any] = field(default_factory=dict)
+
+    def record(
+        self,
+        data: pl.DataFrame | bytes | None = None,
+        *,
+        rows: int | None = None,
+        nbytes: int | None = None,
+        **attrs: Any,
+    ):
+        # Attach output size of the stage (a frame or a raw payload) and extra attributes
+        if isinstance(data, pl.DataFrame):
+            rows, nbytes = data.height, int(data.estimated_size())
+        elif data is not None:
+            nbytes = len(data)
+        if rows is not None:
+            self.rows = rows
+        if nbytes is not None:
+            self.nbytes = nbytes
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "event": "span",
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "wall_s": round(self.wall_s, 4),
+            "rows": self.rows,
+            "bytes": self.nbytes,
+            "rss_delta_mb": (
+                round(self.rss_delta_mb, 1) if self.rss_delta_mb is not None else None
+            ),
+            "process_peak_rss_mb": round(self.process_peak_rss_mb, 1),
+            **self.attrs,
+        }
+
+
+@dataclass
+class Trace:
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    spans: list[Span] = field(default_factory=list)
+    stack: list[Span] = field(default_factory=list)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb() -> float | None:
+    # Current resident memory, only where /proc is available
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * resource.getpagesize() / 2**20
+
+
+@contextmanager
+def trace() -> Iterator[Trace]:
+    current = Trace()
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+        if TRACE_FILE is not None:
+            export(current, TRACE_FILE)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Span]:
+    # Spans opened outside of a trace get a throwaway one so callers never need to check
+    current = _trace.get() or Trace()
+    parent = current.stack[-1] if current.stack else None
+    item = Span(
+        name=name,
+        trace_id=current.trace_id,
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        start=time.time(),
+        attrs=dict(attrs),
+    )
+    current.stack.append(item)
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield item
+    except Exception as e:
+        item.attrs["error"] = repr(e)
+        raise
+    finally:
+        item.wall_s = time.perf_counter() - start
+        rss_end = rss_mb()
+        if rss_start is not None and rss_end is not None:
+            item.rss_delta_mb = rss_end - rss_start
+        item.process_peak_rss_mb = peak_rss_mb()
+        current.stack.pop()
+        current.spans.append(item)
+        print(json.dumps(item.to_dict(), default=str))
+
+
+def warn(message: str, **attrs: Any):
+    # A log entry Cloud Logging files under WARNING, not a span
+    entry = {"event": "warning", "severity": "WARNING", "message": message}
+    print(json.dumps({**entry, **attrs}))
+
+
+def export(current: Trace, path: str):
+    with open(path, "a") as f:
+        for item in sorted(current.spans, key=lambda s: s.start):
+            f.write(json.dumps({**item.to_dict(), "start": item.start}, default=str))
+            f.write("\n")
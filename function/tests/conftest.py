@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Modules of the function are imported as top-level modules, as in main.py
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# Everything the function keeps between invocations goes to a directory of its
+# own, set before the modules read their configuration. Loads go to local
+# Parquet files instead of BigQuery.
+STATE = Path(tempfile.mkdtemp(prefix="function-tests-"))
+for name in [
+    "SINK_DIR",
+    "CHECKPOINT_DIR",
+    "LEASE_DIR",
+    "ANOMALY_STATE_DIR",
+    "QUARANTINE_DIR",
+    "DEFERRED_DIR",
+]:
+    os.environ[name] = str(STATE / name.lower())
+os.environ["DEDUP_INDEX"] = str(STATE / "seen_keys.npz")
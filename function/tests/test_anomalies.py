@@ -0,0 +1,53 @@
+import datetime
+
+import polars as pl
+
+import anomalies
+
+
+def events(days: int, spike: int = 0) -> pl.DataFrame:
+    # One "CHOQUE" per day in one alcaldia, `spike` extra ones on the last day
+    start = datetime.date(2024, 1, 1)
+    dates = [start + datetime.timedelta(days=i) for i in range(days)]
+    dates += [dates[-1]] * spike
+    return pl.DataFrame(
+        {
+            "fecha_evento": dates,
+            "alcaldia": ["COYOACAN"] * len(dates),
+            "tipo_evento": ["CHOQUE"] * len(dates),
+            "personas_fallecidas": [0] * len(dates),
+        }
+    )
+
+
+def empty_state() -> anomalies.State:
+    return anomalies.State(
+        pl.DataFrame(schema=anomalies.BASELINE_SCHEMA),
+        pl.DataFrame(schema=anomalies.ANOMALY_SCHEMA),
+    )
+
+
+def test_detects_spike():
+    found, state = anomalies.detect(events(60, spike=20), {}, empty_state())
+    assert found.filter(pl.col("metrica") == "eventos").height == 1
+    assert state.last_day == datetime.date(2024, 2, 29)
+
+
+def test_null_date_on_first_run():
+    df = events(60, spike=20)
+    df = pl.concat([df, df.head(1).with_columns(pl.lit(None).alias("fecha_evento"))])
+    found, state = anomalies.detect(df, {}, empty_state())
+    assert found.filter(pl.col("metrica") == "eventos").height == 1
+    assert state.last_day == datetime.date(2024, 2, 29)
+
+
+def test_incremental_matches_full_run():
+    df = events(60, spike=20)
+    full, _ = anomalies.detect(df, {}, empty_state())
+
+    cutoff = datetime.date(2024, 2, 1)
+    _, state = anomalies.detect(
+        df.filter(pl.col("fecha_evento") < cutoff), {}, empty_state()
+    )
+    incremental, _ = anomalies.detect(df, {}, state)
+    assert incremental.equals(full)
@@ -0,0 +1,25 @@
+import polars as pl
+
+import checkpoints
+
+URL = "http://example.com/dump.csv"
+
+
+def test_a_retry_resumes_from_the_stages_of_the_failed_run(tmp_path):
+    source = tmp_path / "dump.csv"
+    source.write_bytes(b"folio\na\n")
+    # Nothing to resume until the source is parsed
+    failed = checkpoints.start(URL, source, tmp_path / "checkpoints")
+    assert checkpoints.pending(URL, tmp_path / "checkpoints") is None
+
+    failed.save("decoded", {"events": pl.DataFrame({"folio": ["a"]})})
+    failed.mark_uploaded("colonia")
+
+    retry = checkpoints.pending(URL, tmp_path / "checkpoints")
+    assert retry is not None and retry.key == failed.key
+    assert retry.has("decoded") and not retry.has("encoded")
+    assert retry.load("decoded")["events"]["folio"].to_list() == ["a"]
+    assert retry.uploaded == {"colonia"}
+
+    retry.finish()
+    assert checkpoints.pending(URL, tmp_path / "checkpoints") is None
@@ -0,0 +1,29 @@
+import datetime
+
+import polars as pl
+
+import dates
+
+
+def test_calendar_covers_whole_years_with_holidays():
+    df = pl.DataFrame(
+        {"fecha_evento": [datetime.date(2023, 12, 31), datetime.date(2024, 3, 1)]}
+    )
+
+    calendario = dates.calendar(df)
+
+    assert calendario["fecha"].min() == datetime.date(2023, 1, 1)
+    assert calendario["fecha"].max() == datetime.date(2024, 12, 31)
+    assert calendario["date_key"].is_unique().all()
+    festivos = calendario.filter("es_festivo")
+    # Third Monday of March 2024 and the 2024 inauguration on October 1st
+    assert datetime.date(2024, 3, 18) in festivos["fecha"].to_list()
+    assert datetime.date(2024, 10, 1) in festivos["fecha"].to_list()
+
+
+def test_calendar_without_dates_covers_this_year():
+    df = pl.DataFrame({"fecha_evento": [None]}, schema={"fecha_evento": pl.Date})
+
+    calendario = dates.calendar(df)
+
+    assert calendario["anio"].unique().to_list() == [datetime.date.today().year]
@@ -0,0 +1,76 @@
+import gzip
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+import main
+import quality
+from bench import synth
+
+
+def write_csv(path, df: pl.DataFrame):
+    df.write_csv(path, null_value="NA")
+    return str(path)
+
+
+def test_decode_file_matches_decode(tmp_path):
+    path = write_csv(tmp_path / "dump.csv", synth.generate(5000))
+
+    chunked = main.decode_file(path, chunk_bytes=64 * 2**10)
+
+    assert_frame_equal(chunked, main.decode(open(path, "rb").read()))
+
+
+def test_decode_file_reads_through_compression(tmp_path):
+    path = write_csv(tmp_path / "dump.csv", synth.generate(5000))
+    compressed = tmp_path / "dump.csv.gz"
+    compressed.write_bytes(gzip.compress(open(path, "rb").read()))
+
+    chunked = main.decode_file(str(compressed), chunk_bytes=64 * 2**10)
+
+    assert_frame_equal(chunked, main.decode(open(path, "rb").read()))
+
+
+def test_decode_file_widens_types_a_later_chunk_needs(tmp_path):
+    # zona_vial holds integers in the first chunk and a fraction near the end
+    df = synth.generate(5000).with_columns(pl.col("zona_vial").cast(pl.Utf8))
+    df[4900, "zona_vial"] = "2.5"
+    path = write_csv(tmp_path / "dump.csv", df)
+
+    chunked = main.decode_file(path, chunk_bytes=64 * 2**10)
+
+    assert chunked.schema["zona_vial"] == pl.Float64
+    assert 2.5 in chunked["zona_vial"].to_list()
+    assert_frame_equal(chunked, main.decode(open(path, "rb").read()))
+
+
+def test_decode_file_quarantines_the_raw_values_of_failing_rows(tmp_path):
+    # Bad rows in different chunks, each with its raw value as it was in the CSV
+    df = synth.generate(5000).with_columns(pl.col("latitud").cast(pl.Utf8))
+    df[10, "latitud"] = "diecinueve"
+    df[4900, "latitud"] = "25.0"
+    path = write_csv(tmp_path / "dump.csv", df)
+
+    def quarantined(decode) -> pl.DataFrame:
+        before = set(quality.QUARANTINE_DIR.glob("*.parquet"))
+        decode()
+        [file] = set(quality.QUARANTINE_DIR.glob("*.parquet")) - before
+        return pl.read_parquet(file)
+
+    chunked = quarantined(lambda: main.decode_file(path, chunk_bytes=64 * 2**10))
+    whole = quarantined(lambda: main.decode(open(path, "rb").read()))
+
+    assert {"diecinueve", "25.0"} <= set(chunked["latitud"])
+    assert_frame_equal(chunked, whole)
+
+
+def test_records_of_strings_decode_as_the_csv():
+    df = synth.generate(500)
+    # JSON producers quote numbers as often as not
+    records = df.cast(pl.Utf8).to_dicts()
+    expected = main.decode(df.write_csv(null_value="NA").encode())
+
+    assert_frame_equal(main.decode_records(records), expected)
+
+    records[0]["personas_lesionadas"] = "uno"
+    assert main.decode_records(records).height == expected.height - 1
@@ -0,0 +1,187 @@
+import gzip
+import hashlib
+import http.server
+import os
+import threading
+import zipfile
+
+import pyarrow as pa
+import pytest
+
+import download
+
+
+class Source:
+    # What the test server serves, and what it was asked for
+    def __init__(self):
+        self.data = os.urandom(256 * 2**10)
+        self.etag: str | None = '"v1"'
+        self.last_modified: str | None = None
+        self.drops = 0
+        self.change_after: int | None = None
+        self.requests: list[dict[str, str]] = []
+        self.url = ""
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    source: Source
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        source = self.source
+        source.requests.append(dict(self.headers))
+        if source.change_after and len(source.requests) > source.change_after:
+            source.data, source.etag = os.urandom(len(source.data)), '"v2"'
+
+        data = source.data
+        ranged = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        # A date is compared with Last-Modified, weak ETags never match
+        matches = if_range is None or if_range in (
+            source.last_modified,
+            source.etag if source.etag and not source.etag.startswith("W/") else None,
+        )
+        if ranged and matches:
+            lo, hi = ranged.removeprefix("bytes=").split("-")
+            lo, hi = int(lo), int(hi) if hi else len(data) - 1
+            body = data[lo : hi + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {lo}-{hi}/{len(data)}")
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if source.etag is not None:
+            self.send_header("ETag", source.etag)
+        if source.last_modified is not None:
+            self.send_header("Last-Modified", source.last_modified)
+        self.end_headers()
+
+        if len(body) > 1 and source.drops > 0:
+            # Half of the body, then the connection goes away
+            source.drops -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def source(monkeypatch):
+    monkeypatch.setattr(download, "MIN_PART_BYTES", 16 * 2**10)
+    monkeypatch.setattr(download, "BLOCK_BYTES", 4 * 2**10)
+    served = Source()
+    handler = type("Handler", (Handler,), {"source": served})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    served.url = f"http://127.0.0.1:{server.server_port}/dump.csv"
+    yield served
+    server.shutdown()
+
+
+def ranged(source: Source) -> list[dict[str, str]]:
+    return [r for r in source.requests if r.get("Range", "bytes=0-0") != "bytes=0-0"]
+
+
+def test_downloads_in_ranges(source, tmp_path):
+    digest = hashlib.sha256(source.data).hexdigest()
+
+    path = download.fetch(source.url, tmp_path / "dump", parts=4, sha256=digest)
+
+    assert path.read_bytes() == source.data
+    assert len(ranged(source)) == 4
+    assert {r["If-Range"] for r in ranged(source)} == {'"v1"'}
+
+
+def test_resumes_dropped_ranges(source, tmp_path):
+    source.drops = 2
+
+    path = download.fetch(source.url, tmp_path / "dump", parts=4)
+
+    assert path.read_bytes() == source.data
+    # Two retries, each starting where its dropped range stopped
+    assert len(ranged(source)) == 6
+    starts = [int(r["Range"][6:].split("-")[0]) for r in ranged(source)]
+    assert len(set(starts)) == 6
+
+
+def test_fails_when_the_file_changes_midway(source, tmp_path):
+    source.change_after = 2
+
+    with pytest.raises(download.DownloadError, match="changed"):
+        download.fetch(source.url, tmp_path / "dump", parts=4)
+
+
+def test_checksum_mismatch(source, tmp_path):
+    with pytest.raises(download.DownloadError, match="Checksum"):
+        download.fetch(source.url, tmp_path / "dump", sha256="0" * 64)
+
+
+def test_weak_etag_falls_back_to_last_modified(source, tmp_path):
+    source.etag = 'W/"v1"'
+    source.last_modified = "Mon, 19 Oct 2026 07:00:00 GMT"
+
+    path = download.fetch(source.url, tmp_path / "dump", parts=4)
+
+    assert path.read_bytes() == source.data
+    assert {r["If-Range"] for r in ranged(source)} == {source.last_modified}
+
+
+def test_without_validator_streams_once(source, tmp_path):
+    source.etag = None
+
+    path = download.fetch(source.url, tmp_path / "dump", parts=4)
+
+    assert path.read_bytes() == source.data
+    assert [r.get("Range") for r in source.requests] == ["bytes=0-0", None]
+
+
+def test_reuses_the_callers_probe(source, tmp_path):
+    probed = download.probe(source.url)
+
+    download.fetch(source.url, tmp_path / "dump", parts=4, probed=probed)
+
+    assert [r.get("Range") for r in source.requests].count("bytes=0-0") == 1
+
+
+CSV = b"folio,zona_vial\n" + b"".join(b"C5/%d,%d\n" % (i, i % 7) for i in range(5000))
+
+
+def read_source(path) -> bytes:
+    with download.open_source(path) as f:
+        return f.read()
+
+
+def test_plain_sources_are_read_as_they_are(tmp_path):
+    (tmp_path / "dump").write_bytes(CSV)
+
+    assert read_source(tmp_path / "dump") == CSV
+
+
+def test_reads_gzip_members_as_one_stream(tmp_path):
+    path = tmp_path / "dump"
+    path.write_bytes(gzip.compress(CSV[:1000]) + gzip.compress(CSV[1000:]))
+
+    assert read_source(path) == CSV
+
+
+def test_reads_zstd(tmp_path):
+    path = tmp_path / "dump"
+    with pa.CompressedOutputStream(str(path), "zstd") as f:
+        f.write(CSV)
+
+    assert read_source(path) == CSV
+
+
+def test_reads_the_largest_member_of_a_zip(tmp_path):
+    path = tmp_path / "dump"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("LEEME.txt", b"Diccionario de datos")
+        archive.writestr("incidentes.csv", CSV)
+        archive.writestr("licencia.txt", b"CC-BY 4.0")
+
+    assert read_source(path) == CSV
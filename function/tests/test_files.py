@@ -0,0 +1,25 @@
+import threading
+
+import files
+
+
+def test_concurrent_writers_each_leave_a_whole_file(tmp_path):
+    path = tmp_path / "state" / "version"
+    start = threading.Barrier(8)
+
+    def write(i: int):
+        def slowly(tmp):
+            with open(tmp, "w") as f:
+                f.write(str(i) * 1000)
+                start.wait()
+
+        files.atomic_write(path, slowly)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert path.read_text() in {str(i) * 1000 for i in range(8)}
+    assert [p.name for p in path.parent.iterdir()] == ["version"]
@@ -0,0 +1,41 @@
+import numpy as np
+import polars as pl
+
+import geo
+
+
+def events(n: int = 5000) -> pl.DataFrame:
+    rng = np.random.default_rng(0)
+    return pl.DataFrame(
+        {
+            "latitud": rng.uniform(19.2, 19.6, n),
+            "longitud": rng.uniform(-99.3, -98.9, n),
+        }
+    ).with_row_index("id")
+
+
+def test_coarser_cells_are_prefixes_of_finer_ones():
+    df = geo.add_cells(events(100))
+
+    finest = df["geohash_7"].to_numpy()
+    assert (finest >> np.uint64(5) == df["geohash_6"].to_numpy()).all()
+    assert (finest >> np.uint64(10) == df["geohash_5"].to_numpy()).all()
+
+
+def test_spatial_index_finds_what_a_scan_finds():
+    df = events()
+    index = geo.SpatialIndex(df)
+
+    found = index.bbox(19.40, -99.15, 19.45, -99.10)
+    scanned = df.filter(
+        pl.col("latitud").is_between(19.40, 19.45)
+        & pl.col("longitud").is_between(-99.15, -99.10)
+    )
+    assert sorted(found["id"]) == sorted(scanned["id"])
+
+    near = index.radius(19.43, -99.13, 1000)
+    distance = geo.haversine_m(
+        df["latitud"].to_numpy(), df["longitud"].to_numpy(), 19.43, -99.13
+    )
+    assert sorted(near["id"]) == sorted(df.filter(pl.Series(distance <= 1000))["id"])
+    assert (near["distancia_m"] <= 1000).all()
@@ -0,0 +1,92 @@
+import contextlib
+import functools
+import http.server
+import io
+import os
+import threading
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+import main
+import stream
+from bench import synth
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def serve(tmp_path):
+    # Dumps written to `tmp_path`, served over HTTP
+    handler = functools.partial(QuietHandler, directory=str(tmp_path))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def dump(name: str, seed: int) -> str:
+        synth.generate(2000, seed).write_csv(tmp_path / name, null_value="NA")
+        return f"http://127.0.0.1:{server.server_port}/{name}"
+
+    yield dump
+    server.shutdown()
+
+
+def ingest(url: str):
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.ingest(url)
+
+
+def loaded_folios() -> set[str]:
+    events = Path(os.environ["SINK_DIR"]) / "events" / "*.parquet"
+    return set(pl.read_parquet(events)["folio"])
+
+
+def test_reloads_a_dump_another_load_replaced(serve):
+    first, second = serve("first.csv", 0), serve("second.csv", 1)
+    ingest(first)
+    folios = loaded_folios()
+    ingest(second)
+    assert loaded_folios().isdisjoint(folios)
+
+    # The same incidents as the first dump, which are no longer in the tables
+    ingest(serve("first-again.csv", 0))
+
+    assert loaded_folios() == folios
+
+
+def test_reloads_the_same_url_after_another_load(serve):
+    first, second = serve("first.csv", 0), serve("second.csv", 1)
+    ingest(first)
+    folios = loaded_folios()
+    ingest(second)
+
+    # Unchanged since it was loaded, but no longer what the tables hold
+    ingest(first)
+
+    assert loaded_folios() == folios
+
+
+def test_batch_rows_with_new_labels_wait_for_the_next_load(serve):
+    # Rows other tests deferred would be loaded too
+    for path in stream.deferred():
+        path.unlink()
+    url = serve("dump.csv", 0)
+    ingest(url)
+    folios = loaded_folios()
+
+    # Colonias of another dump are mostly unknown to this one's dimensions
+    batch = synth.generate(200, 1).cast(pl.Utf8).to_dicts()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.ingest_records(batch)
+    appended = loaded_folios() - folios
+    deferred = set(pl.read_parquet(stream.deferred())["folio"])
+    assert deferred and appended | deferred == {record["folio"] for record in batch}
+
+    # The dump didn't change, but the deferred rows are loaded with it
+    ingest(url)
+
+    assert loaded_folios() == folios | deferred
+    assert not stream.deferred()
@@ -0,0 +1,20 @@
+import polars as pl
+
+import profiling
+
+
+def test_narrow_keeps_key_columns():
+    df = pl.DataFrame(
+        {
+            "personas_lesionadas": [0, 3, 1],
+            "interseccion_id": pl.Series([5, 700, None], dtype=pl.UInt32),
+        }
+    )
+    profiles = profiling.profile(df)
+
+    narrowed, saved = profiling.narrow(df, profiles, keep=["interseccion_id"])
+
+    assert narrowed.schema["personas_lesionadas"] == pl.UInt8
+    assert narrowed.schema["interseccion_id"] == pl.UInt32
+    assert profiles["interseccion_id"].dtype == pl.UInt32
+    assert saved > 0
@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+from typing import Any, cast
+
+import polars as pl
+import pytest
+
+import geo
+import main
+
+
+def test_published_ids_are_kept_and_new_values_appended():
+    previous = {
+        "colonia": pl.DataFrame({"id": [0, 1], "colonia": ["ROMA", "CENTRO"]})
+    }
+    df = pl.DataFrame({"colonia": ["ROMA", "AJUSCO", None, "CENTRO", "ZAPOTLA"]})
+
+    encoded, tables = main.create_tables(df, ["colonia"], previous)
+
+    assert tables["colonia"].rows() == [
+        (0, "ROMA"),
+        (1, "CENTRO"),
+        (2, "AJUSCO"),
+        (3, "ZAPOTLA"),
+    ]
+    assert encoded["colonia"].to_list() == [0, 2, None, 1, 3]
+
+
+def test_published_ids_with_gaps_are_refused():
+    previous = {"colonia": pl.DataFrame({"id": [0, 2], "colonia": ["ROMA", "CENTRO"]})}
+    df = pl.DataFrame({"colonia": ["ROMA"]})
+
+    with pytest.raises(ValueError, match="gaps"):
+        main.create_tables(df, ["colonia"], previous)
+
+
+def events(pairs: list[tuple[str, str, float]]) -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "punto_1": [a for a, _, _ in pairs],
+            "punto_2": [b for _, b, _ in pairs],
+            "latitud": [lat for _, _, lat in pairs],
+            "longitud": [-99.1] * len(pairs),
+        }
+    )
+
+
+def test_published_intersections_keep_their_ids():
+    first = geo.build_intersections(events([("B", "C", 19.41), ("A", "D", 19.42)]))
+    assert first.select("id", "calle_1").rows() == [(0, "A"), (1, "B")]
+
+    # The next dump no longer names A/D and brings A/B
+    second = geo.build_intersections(
+        events([("C", "B", 19.43), ("A", "B", 19.44)]), first
+    )
+
+    assert second.select("id", "calle_1", "calle_2", "latitud").rows() == [
+        (0, "A", "D", 19.42),
+        (1, "B", "C", 19.43),
+        (2, "A", "B", 19.44),
+    ]
+
+
+class Client:
+    project = "project"
+
+    def __init__(self, tables: dict[str, str]):
+        self.tables = tables
+        self.queries: list[str] = []
+
+    def list_tables(self, dataset: str):
+        return [
+            SimpleNamespace(table_id=name, table_type=kind)
+            for name, kind in self.tables.items()
+        ]
+
+    def query(self, sql: str):
+        self.queries.append(sql)
+        return SimpleNamespace(result=lambda: None)
+
+
+def test_publish_swaps_dimensions_before_events():
+    client = Client({"events": "VIEW", "colonia": "TABLE"})
+
+    main.publish(cast(Any, client), "traffic_data", ["events", "colonia", "dia"], "1")
+
+    [script] = client.queries
+    statements = script.splitlines()
+    assert [s.split()[0:2] for s in statements] == [
+        ["DROP", "TABLE"],
+        ["CREATE", "OR"],
+        ["CREATE", "OR"],
+        ["CREATE", "OR"],
+    ]
+    # The legacy table goes right before its view, events are last
+    assert "`project.traffic_data.colonia`" in statements[0]
+    assert "`project.traffic_data.colonia`" in statements[1]
+    assert "VIEW `project.traffic_data.events`" in statements[-1]
@@ -0,0 +1,40 @@
+import datetime
+
+import polars as pl
+
+import quality
+
+
+def decoded(latitudes: list[float]) -> pl.DataFrame:
+    n = len(latitudes)
+    return pl.DataFrame(
+        {
+            "latitud": latitudes,
+            "longitud": [-99.1] * n,
+            "personas_fallecidas": [0] * n,
+            "personas_lesionadas": [1] * n,
+            "fecha_evento": [datetime.date(2024, 5, 1)] * n,
+        }
+    ).with_row_index(quality.ROW)
+
+
+def test_quarantines_failing_rows_with_raw_values(tmp_path):
+    df = decoded([19.4, 25.0, 19.3])
+    raw = df.with_columns(pl.col("latitud").cast(pl.Utf8))
+
+    kept, summary = quality.gate(df, raw, tmp_path)
+
+    assert kept["latitud"].to_list() == [19.4, 19.3]
+    assert summary == {"rows": 3, "quarantined": 1, "coordenadas_fuera_de_cdmx": 1}
+    [file] = tmp_path.glob("*.parquet")
+    quarantine = pl.read_parquet(file)
+    assert quarantine["latitud"].to_list() == ["25.0"]
+    assert quarantine["motivos"].to_list() == [["coordenadas_fuera_de_cdmx"]]
+
+
+def test_gates_in_the_same_second_keep_their_files(tmp_path):
+    df = decoded([25.0])
+    for _ in range(3):
+        quality.gate(df, df, tmp_path)
+
+    assert len(list(tmp_path.glob("*.parquet"))) == 3
@@ -0,0 +1,159 @@
+import datetime
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import singleflight
+
+
+def test_one_waiter_takes_over_an_expired_lease(tmp_path):
+    stale = singleflight.FileLease("key", tmp_path)
+    assert stale.acquire()
+    os.utime(stale.path, (0, 0))
+
+    waiters = [singleflight.FileLease("key", tmp_path) for _ in range(8)]
+    start = threading.Barrier(len(waiters))
+    won = []
+
+    def take(lease: singleflight.FileLease):
+        start.wait()
+        if lease.acquire():
+            won.append(lease)
+
+    threads = [threading.Thread(target=take, args=(w,)) for w in waiters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+
+    # The run that lost its lease doesn't drop the one that took it over
+    stale.release()
+    assert not singleflight.FileLease("key", tmp_path).acquire()
+    won[0].release()
+    assert singleflight.FileLease("key", tmp_path).acquire()
+
+
+class Bucket:
+    # Just enough of the Cloud Storage JSON API: objects with generations and
+    # ifGenerationMatch preconditions
+    def __init__(self):
+        self.objects: dict[str, dict[str, Any]] = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, url: str) -> Any:
+        name = url.rsplit("/", 1)[-1].replace("%2F", "/")
+        meta = self.objects.get(name)
+        return SimpleNamespace(
+            status_code=200 if meta else 404,
+            json=lambda: meta,
+            raise_for_status=lambda: None,
+        )
+
+    def post(self, url: str, params: dict[str, Any], **kwargs) -> Any:
+        with self.lock:
+            name = params["name"]
+            if name in self.objects:
+                return SimpleNamespace(status_code=412)
+            self.generation += 1
+            now = datetime.datetime.now(datetime.timezone.utc)
+            meta = {
+                "generation": str(self.generation),
+                "timeCreated": now.isoformat().replace("+00:00", "Z"),
+            }
+            self.objects[name] = meta
+            return SimpleNamespace(
+                status_code=200, json=lambda: meta, raise_for_status=lambda: None
+            )
+
+    def delete(self, url: str, params: dict[str, Any]) -> Any:
+        with self.lock:
+            name = url.rsplit("/", 1)[-1].replace("%2F", "/")
+            meta = self.objects.get(name)
+            if meta is None:
+                return SimpleNamespace(status_code=404)
+            if meta["generation"] != str(params["ifGenerationMatch"]):
+                return SimpleNamespace(status_code=412)
+            del self.objects[name]
+            return SimpleNamespace(status_code=204)
+
+
+def test_bucket_leases_exclude_each_other():
+    bucket = Bucket()
+    lease = singleflight.GcsLease("key", "bucket", session=bucket)
+    assert lease.acquire()
+    assert not singleflight.GcsLease("key", "bucket", session=bucket).acquire()
+    bucket.objects["leases/key.lease"]["timeCreated"] = "2000-01-01T00:00:00Z"
+
+    waiters = [
+        singleflight.GcsLease("key", "bucket", session=bucket) for _ in range(8)
+    ]
+    start = threading.Barrier(len(waiters))
+    won = []
+
+    def take(lease: singleflight.GcsLease):
+        start.wait()
+        if lease.acquire():
+            won.append(lease)
+
+    threads = [threading.Thread(target=take, args=(w,)) for w in waiters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+
+    lease.release()
+    assert "leases/key.lease" in bucket.objects
+    won[0].release()
+    assert not bucket.objects
+
+
+def test_runs_again_once_another_version_is_published(tmp_path):
+    url = "http://example.com/dump.csv"
+    singleflight.record(url, "sha", None, "1", tmp_path)
+    assert singleflight.last(url, "1", tmp_path) is not None
+    assert singleflight.last(url, "2", tmp_path) is None
+
+    # A waiter finds the holder's run done, but another load published since
+    held = singleflight.FileLease(singleflight.DATASET_LEASE, tmp_path)
+    assert held.acquire()
+    runs = []
+
+    def finish():
+        time.sleep(0.2)
+        singleflight.record(url, "sha", None, "1", tmp_path)
+        held.release()
+
+    threading.Thread(target=finish).start()
+    ran = singleflight.run(url, lambda: runs.append(1), lambda: "2", tmp_path)
+    assert ran and runs == [1]
+
+
+def test_runs_of_different_urls_take_turns(tmp_path):
+    # Each would append dimension IDs after the same published ones
+    running = []
+    overlapped = []
+
+    def load():
+        running.append(1)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.2)
+        running.pop()
+
+    runs = [
+        threading.Thread(
+            target=singleflight.run,
+            args=(f"http://example.com/{name}.csv", load, lambda: None, tmp_path),
+        )
+        for name in ["a", "b"]
+    ]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+
+    assert overlapped == [False, False]
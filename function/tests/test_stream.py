@@ -0,0 +1,221 @@
+import contextlib
+import io
+import re
+import threading
+from types import SimpleNamespace
+from typing import Any
+
+import polars as pl
+
+import dates
+import dedup
+import geo
+import main
+import quality
+import stream
+from bench import synth
+
+
+class Dataset:
+    # Just enough of a BigQuery client: tables, views on them and SELECT *
+    project = "project"
+
+    def __init__(self):
+        self.tables: dict[str, pl.DataFrame] = {}
+        self.views: dict[str, str] = {}
+        self.selects: list[str] = []
+
+    def load(self, version: str, tables: dict[str, pl.DataFrame]):
+        for name, table in tables.items():
+            self.tables[f"project.traffic_data.{name}__v{version}"] = table
+
+    def publish(self, version: str, names: list[str]):
+        for name in names:
+            self.views[f"project.traffic_data.{name}"] = (
+                f"SELECT * FROM `project.traffic_data.{name}__v{version}`"
+            )
+
+    def get_table(self, name: str) -> Any:
+        if name in self.views:
+            return SimpleNamespace(table_type="VIEW", view_query=self.views[name])
+        types = {pl.Int64: "INTEGER", pl.Float64: "FLOAT", pl.Utf8: "STRING"}
+        schema = [
+            SimpleNamespace(name=c, field_type=types[dtype], mode="NULLABLE")
+            for c, dtype in self.tables[name].schema.items()
+        ]
+        return SimpleNamespace(table_type="TABLE", schema=schema)
+
+    def insert_rows_json(self, table: str, rows: list[dict], **kwargs) -> list:
+        # Folios of the form BAD-... fail as invalid rows
+        assert kwargs["skip_invalid_rows"]
+        invalid = [i for i, row in enumerate(rows) if row["folio"].startswith("BAD")]
+        kept = [row for i, row in enumerate(rows) if i not in invalid]
+        self.tables[table] = pl.concat([self.tables[table], pl.DataFrame(kept)])
+        error = {"reason": "invalid", "message": "folio rechazado"}
+        return [{"index": i, "errors": [error]} for i in invalid]
+
+    def list_tables(self, dataset: str) -> list[Any]:
+        return [
+            SimpleNamespace(table_id=name.rsplit(".", 1)[-1])
+            for name in [*self.tables, *self.views]
+        ]
+
+    def query(self, sql: str) -> Any:
+        self.selects.append(sql)
+        match = re.search(r"FROM `([^`]+)`", sql)
+        assert match is not None
+        table = self.tables[match.group(1)]
+        return SimpleNamespace(
+            result=lambda: SimpleNamespace(to_arrow=lambda: table.to_arrow())
+        )
+
+
+def version(colonias: list[str]) -> dict[str, pl.DataFrame]:
+    return {
+        "events": pl.DataFrame({"colonia": [0], "folio": ["a"]}),
+        "colonia": pl.DataFrame({"id": range(len(colonias)), "colonia": colonias}),
+        "interseccion": pl.DataFrame({"id": [0], "calle_1": ["A"], "calle_2": ["B"]}),
+    }
+
+
+def test_dimensions_follow_the_version_of_the_events_view():
+    dataset = Dataset()
+    dataset.load("1", version(["ROMA"]))
+    dataset.publish("1", ["events", "colonia", "interseccion"])
+    sink = stream.BigQuerySink(dataset)
+
+    dimensions, _ = sink.dimensions()
+    assert dimensions["colonia"]["colonia"].to_list() == ["ROMA"]
+    selects = len(dataset.selects)
+    sink.dimensions()
+    assert len(dataset.selects) == selects
+
+    # Mid-publish: the dimension views moved, events still on version 1
+    dataset.load("2", version(["ROMA", "CENTRO"]))
+    dataset.publish("2", ["colonia", "interseccion"])
+    dimensions, _ = sink.dimensions()
+    assert dimensions["colonia"]["colonia"].to_list() == ["ROMA"]
+    # Also for an instance that starts right then
+    dimensions, _ = stream.BigQuerySink(dataset).dimensions()
+    assert dimensions["colonia"]["colonia"].to_list() == ["ROMA"]
+
+    dataset.publish("2", ["events"])
+    dimensions, _ = sink.dimensions()
+    assert dimensions["colonia"]["colonia"].to_list() == ["ROMA", "CENTRO"]
+    assert sink.table == "project.traffic_data.events__v2"
+
+
+def test_dimensions_fall_back_to_tables_from_before_versioning():
+    dataset = Dataset()
+    dataset.load("1", {"events": version(["ROMA"])["events"]})
+    dataset.publish("1", ["events"])
+    dataset.tables["project.traffic_data.colonia"] = version(["ROMA"])["colonia"]
+    sink = stream.BigQuerySink(dataset)
+
+    dimensions, intersections = sink.dimensions()
+
+    assert dimensions["colonia"]["colonia"].to_list() == ["ROMA"]
+    # No intersections at all: rows are matched to none instead of failing
+    assert intersections.height == 0
+
+
+def test_nothing_published_has_no_dimensions():
+    class Empty(Dataset):
+        def get_table(self, name: str) -> Any:
+            from google.api_core.exceptions import NotFound
+
+            raise NotFound(name)
+
+    dimensions, intersections = stream.BigQuerySink(Empty()).dimensions()
+
+    assert dimensions == {}
+    assert intersections.height == 0
+
+
+def test_rows_that_dont_fit_the_table_are_quarantined(tmp_path):
+    dataset = Dataset()
+    dataset.load("1", version(["ROMA"]))
+    dataset.publish("1", ["events", "colonia", "interseccion"])
+    sink = stream.BigQuerySink(dataset)
+    sink.dimensions()
+
+    quarantined = set(quality.QUARANTINE_DIR.glob("*.parquet"))
+    rejected = sink.write(
+        pl.DataFrame(
+            {"colonia": ["0", "uno", "0"], "folio": ["b", "c", "BAD-d"], "x": [1] * 3}
+        )
+    )
+
+    assert rejected == 2 and sink.table is not None
+    assert dataset.tables[sink.table]["folio"].to_list() == ["a", "b"]
+    new = set(quality.QUARANTINE_DIR.glob("*.parquet")) - quarantined
+    reasons = pl.concat([pl.read_parquet(path) for path in new])["motivos"]
+    assert sorted(reasons.to_list()) == [["colonia_invalido"], ["folio rechazado"]]
+
+
+def decoded(df: pl.DataFrame) -> pl.DataFrame:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main.decode(df.write_csv(null_value="NA").encode())
+
+
+def test_batches_are_deduplicated_against_the_published_version(tmp_path):
+    raw = synth.generate(400)
+    with contextlib.redirect_stdout(io.StringIO()):
+        df, tables, _ = main.build(decoded(raw.head(300)))
+    batch = dates.add_keys(geo.add_cells(decoded(raw.tail(100))))
+    sink = stream.LocalSink(tmp_path / "sink")
+    sink.replace(df, tables, "1")
+    seen = dedup.SeenIndex(tmp_path / "seen.npz")
+    batcher = stream.Batcher(sink, seen, max_wait_s=0)
+
+    def appended() -> int:
+        parts = (tmp_path / "sink" / "events").glob("*.parquet")
+        return sum(pl.read_parquet(part).height for part in parts) - 300
+
+    batcher.submit(batch)
+    written = appended()
+    assert written > 0
+    # A redelivery finds its rows seen
+    batcher.submit(batch)
+    assert appended() == written
+
+    # A full load of the same dump replaces the appended rows
+    sink.replace(df, tables, "2")
+    batcher.submit(batch)
+    assert appended() == written
+
+
+def test_batches_fill_while_a_write_is_in_flight(tmp_path):
+    class Slow(stream.LocalSink):
+        def __init__(self, root):
+            super().__init__(root)
+            self.writing = threading.Event()
+            self.release = threading.Event()
+
+        def write(self, df: pl.DataFrame) -> int:
+            self.writing.set()
+            self.release.wait()
+            return super().write(df)
+
+    raw = synth.generate(100)
+    with contextlib.redirect_stdout(io.StringIO()):
+        df, tables, _ = main.build(decoded(raw))
+    stream.LocalSink(tmp_path / "sink").replace(df, tables, "1")
+    sink = Slow(tmp_path / "sink")
+    # Rows of the dump, whose labels are all known and which no index has seen
+    batcher = stream.Batcher(sink, dedup.SeenIndex(tmp_path / "seen.npz"), 1)
+    batch = dates.add_keys(geo.add_cells(decoded(raw)))
+
+    first = threading.Thread(target=batcher.submit, args=(batch.head(50),))
+    first.start()
+    assert sink.writing.wait(5)
+    # The write holds no lock submitters need
+    assert batcher.cond.acquire(timeout=1)
+    batcher.cond.release()
+    second = threading.Thread(target=batcher.submit, args=(batch.tail(50),))
+    second.start()
+
+    sink.release.set()
+    first.join(5)
+    second.join(5)
+    assert not first.is_alive() and not second.is_alive()